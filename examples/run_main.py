@@ -4,11 +4,11 @@ import os
 import matplotlib.pyplot as plt
 import tzlocal
 
-from databroker.assets.handlers import AreaDetectorTiffHandler
 from databroker.broker import Broker
 # pull from local data, not needed at beamline
 from databroker.assets.sqlite import RegistryRO
 from databroker.headersource.sqlite import MDSRO
+from xpdan.handlers import MemmapTiffHandler
 from xpdan.pipelines.main import conf_main_pipeline
 from tempfile import TemporaryDirectory
 
@@ -19,7 +19,7 @@ d = {'directory': '/home/christopher/live_demo_data',
      'dbpath': os.path.join('/home/christopher/live_demo_data', 'filestore')}
 mds = MDSRO(d)
 fs = RegistryRO(d)
-fs.register_handler('AD_TIFF', AreaDetectorTiffHandler)
+fs.register_handler('AD_TIFF', MemmapTiffHandler)
 db = Broker(mds=mds, reg=fs)
 td = TemporaryDirectory()
 
@@ -16,7 +16,6 @@ import time
 import multiprocessing
 from shed.event_streams import istar
 from shed.utils import to_event_model
-import copy
 import numpy as np
 
 # from xpdan.tools import better_mask_img
@@ -30,7 +29,8 @@ fs.register_handler('AD_TIFF', AreaDetectorTiffHandler)
 db = Broker(mds=mds, reg=fs)
 
 p = Publisher('127.0.0.1:5567')  # noqa
-db.prepare_hook = lambda a, x: copy.deepcopy(x)
+# the publisher serializes the documents, no need to copy them
+db.prepare_hook = lambda name, doc: doc
 # '''
 for name, doc in db[-1].documents():
     p(name, doc)
@@ -8,5 +8,6 @@ setup(
     zip_safe=False,
     package_data={'xpdan': ['config/*']},
     include_package_data=True,
+    entry_points={'console_scripts': ['xpdan-serve = xpdan.server:main']},
     url='http:/github.com/xpdAcq/xpdAn'
 )
@@ -0,0 +1,391 @@
+"""Batch reduction of many runs as a dask task graph"""
+import os
+from operator import sub
+
+import numpy as np
+
+from xpdan.db_utils import (query_dark, query_nearest_background,
+                            average_background, broker_config, BrokerProxy)
+from xpdan.dev_utils import _timestampstr
+from xpdan.formatters import render_and_clean
+from xpdan.io import (pdf_saver, chi_saver, dump_yml, makedirs_for,
+                      retry_missing_dir)
+from xpdan.pipelines.main import base_template
+from xpdan.pipelines.pipeline_utils import (if_dark, if_calibration,
+                                            if_not_calibration)
+from xpdan.tools import (integrate, generate_binner, load_geo,
+                         polarization_correction, mask_img, pdf_getter,
+                         decompress_mask, StackIntegrator)
+
+
+def _freeze(d):
+    if isinstance(d, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in d.items()))
+    if isinstance(d, list):
+        return tuple(_freeze(v) for v in d)
+    return d
+
+
+def _shared(tasks, key, make):
+    """Get the task for ``key``, only making it the first time"""
+    if key not in tasks:
+        tasks[key] = make()
+    return tasks[key]
+
+
+def _primary_documents(hdr):
+    """The descriptors and the primary events of a run, without the data"""
+    descriptors = {}
+    events = []
+    for name, doc in hdr.documents(fill=False):
+        if name == 'descriptor':
+            descriptors[doc['uid']] = doc
+        elif (name == 'event' and
+                descriptors[doc['descriptor']].get('name') == 'primary'):
+            events.append(doc)
+    return descriptors, events
+
+
+def _latest_image(db, uid, image_data_key):
+    """The image of the last event of a run, eg. the dark frame"""
+    return [doc['data'][image_data_key] for name, doc in
+            db[uid].documents(fill=True) if name == 'event'][-1]
+
+
+def _event_image(db, event, descriptor, image_data_key):
+    """Fill a single event, so only its own frame is read"""
+    event = next(iter(db.fill_events([event], [descriptor])))
+    return event['data'][image_data_key]
+
+
+def _render(template, start, descriptor, event, analysis_stage, ext):
+    return render_and_clean(template,
+                            human_timestamp=_timestampstr(event['time']),
+                            raw_event=event,
+                            raw_start=start,
+                            raw_descriptor=descriptor,
+                            analyzed_start={'analysis_stage': analysis_stage},
+                            ext=ext)
+
+
+def _write(template, start, descriptor, event, outputs):
+    """Write the reduced data of one event
+
+    Parameters
+    ----------
+    template: str
+        The file name template of the main pipeline
+    start, descriptor, event: dict
+        The raw documents
+    outputs: list of tuple
+        The (analysis_stage, ext, writer, kwargs) to write, the file name
+        is passed to the writer as its ``filename_kwarg``
+
+    Returns
+    -------
+    list of str:
+        The rendered file names
+    """
+    import tifffile
+    from skbeam.io.fit2d import fit2d_save
+    writers = {'tiff': (tifffile.imsave, 'file'),
+               'mask': (fit2d_save, 'filename'),
+               'chi': (chi_saver, 'output_name'),
+               'pdf': (pdf_saver, 'filename')}
+    filenames = []
+    for analysis_stage, ext, kind, kwargs in outputs:
+        filename = _render(template, start, descriptor, event,
+                           analysis_stage, ext)
+        makedirs_for(filename)
+        writer, filename_kwarg = writers[kind]
+        retry_missing_dir(writer, filename_kwarg)(
+            **{filename_kwarg: filename}, **kwargs)
+        filenames.append(filename)
+    return filenames
+
+
+def _frame_outputs(dark_sub, q, iq, tth, r, pdf, config, mask=None):
+    """The outputs of an event, see ``_write``"""
+    outputs = [('dark_sub', '.tiff', 'tiff', {'data': dark_sub})]
+    if mask is not None:
+        outputs.append(('mask', '', 'mask', {'mask': mask}))
+    return outputs + [
+        ('iq_q', '_Q.chi', 'chi',
+         {'tth': q, 'intensity': iq, 'q_or_2theta': 'Q', 'ext': ''}),
+        ('iq_tth', '_tth.chi', 'chi',
+         {'tth': tth, 'intensity': iq, 'q_or_2theta': '2theta', 'ext': ''}),
+        ('pdf', '.gr', 'pdf', {'r': r, 'pdf': pdf, 'config': config})]
+
+
+def micro_batches(events, batch_size=None, window=None):
+    """Group consecutive events into micro-batches
+
+    Parameters
+    ----------
+    events: iterable of dict
+        The events
+    batch_size: int, optional
+        The maximum number of events in a batch, if None not limited
+    window: float, optional
+        The maximum time, in seconds, between the first and the last event
+        of a batch, if None not limited
+
+    Yields
+    ------
+    list of dict:
+        The events of a batch
+    """
+    batch = []
+    for event in events:
+        if batch and ((batch_size is not None and len(batch) >= batch_size)
+                      or (window is not None and
+                          event['time'] - batch[0]['time'] > window)):
+            yield batch
+            batch = []
+        batch.append(event)
+    if batch:
+        yield batch
+
+
+def _reduce_batch(db, template, start, descriptors, events, image_data_key,
+                  dark, bg, geo, integrator, polarization_factor, pdf_config,
+                  mask=None):
+    """Reduce and write a micro-batch of events as one image stack
+
+    The corrections and the integration are done on the whole stack, then
+    the results are written event by event, with the file names of the
+    original events.
+
+    Returns
+    -------
+    list of str:
+        The file names written
+    """
+    from skbeam.core.utils import q_to_twotheta
+    stack = np.stack([_event_image(db, event,
+                                   descriptors[event['descriptor']],
+                                   image_data_key) for event in events])
+    dark_subs = stack - dark
+    fg = dark_subs if bg is None else dark_subs - bg
+    img = fg / geo.polarization(fg.shape[1:], polarization_factor)
+    iqs = integrator(img)
+    q = integrator.bin_centers
+    tth = q_to_twotheta(q, start['bt_wavelength'])
+    filenames = []
+    for i, event in enumerate(events):
+        r, pdf, config = pdf_getter(q, iqs[i],
+                                    composition=start['sample_name'],
+                                    **pdf_config)
+        outputs = _frame_outputs(dark_subs[i], q, iqs[i], tth, r, pdf,
+                                 config, mask=mask if i == 0 else None)
+        filenames.extend(_write(template, start,
+                                descriptors[event['descriptor']], event,
+                                outputs))
+    return filenames
+
+
+def _write_md(template, start):
+    filename = render_and_clean(template, raw_start=start, ext='.yml')
+    dump_yml(filename, start)
+    return [filename]
+
+
+def reduce_headers_batch(headers, *, db, save_dir,
+                         polarization_factor=.99,
+                         mask_setting='default',
+                         mask_kwargs=None,
+                         image_data_key='pe1_image',
+                         pdf_config=None,
+                         bg_stack_method='mean',
+                         batch_size=None,
+                         batch_window=None,
+                         scheduler='processes',
+                         num_workers=None,
+                         db_config=None):
+    """Reduce many runs at once as a dask task graph
+
+    The same stages as ``conf_main_pipeline`` are run and the same files
+    are written as by ``integrate_and_save``. Inputs shared between runs,
+    the dark frames, averaged backgrounds, geometries, masks and binners,
+    are single tasks of the graph, so they are only computed once.
+
+    Parameters
+    ----------
+    headers : list
+        a list of databroker.header objects
+    db: databroker.broker.Broker instance
+        The databroker holding the data, this must be specified as a `db=` in
+        the function call (keyword only argument). The worker processes
+        open their own, see ``db_config``
+    save_dir: str
+        The folder in which to save the data, this must be specified as a
+        `save_dir=` in the function call (keyword only argument)
+    polarization_factor : float, optional
+        polarization correction factor, ranged from -1(vertical) to +1
+        (horizontal). default is 0.99. set to None for no
+        correction.
+    mask_setting : str optional
+        If 'default' reuse mask created for first image of each run, if
+        'auto' mask all images, if 'cache' use the mask in the start
+        document, if None use no mask. Defaults to 'default'
+    mask_kwargs : dict, optional
+        dictionary stores options for automasking functionality.
+        Please refer to documentation for more details
+    image_data_key: str, optional
+        The key for the image data, defaults to `pe1_image`
+    pdf_config: dict, optional
+        Configuration for making PDFs, see pdfgetx3 docs. Defaults to
+        ``dict(dataformat='QA', qmaxinst=28, qmax=22)``
+    bg_stack_method: {'mean', 'sigma_clip', 'median'}, optional
+        How to combine the background frames, defaults to 'mean'
+    batch_size: int, optional
+        If set, reduce up to this many consecutive frames of a run as one
+        image stack, with vectorized corrections and integration. Not
+        available with the 'auto' ``mask_setting``. Defaults to None, one
+        task per frame
+    batch_window: float, optional
+        If set, only batch frames taken within this many seconds of each
+        other, can be combined with ``batch_size``. Defaults to None
+    scheduler: str, optional
+        The dask scheduler, defaults to 'processes', the local
+        multiprocessing scheduler
+    num_workers: int, optional
+        The number of workers, defaults to the number of cores
+    db_config: str or dict, optional
+        The name or the configuration of the databroker, for the worker
+        processes to open their own. Defaults to the configuration of
+        ``db``, see ``xpdan.db_utils.broker_config``
+
+    Returns
+    -------
+    dict:
+        Maps the uids of the reduced runs to the files written for them
+
+    Notes
+    -----
+    Dark and calibration runs are skipped, as are runs without a
+    calibration, the interactive calibration needs the live pipeline.
+    """
+    try:
+        import dask
+    except ImportError:
+        raise ImportError('reduce_headers_batch requires dask')
+    from skbeam.core.utils import q_to_twotheta
+
+    if not isinstance(headers, list):
+        headers = [headers]
+    if pdf_config is None:
+        pdf_config = dict(dataformat='QA', qmaxinst=28, qmax=22)
+    if mask_kwargs is None:
+        mask_kwargs = {}
+    batching = batch_size is not None or batch_window is not None
+    if batching and mask_setting == 'auto':
+        raise ValueError("Micro-batching needs a mask shared by the frames, "
+                         "it can not be used with mask_setting='auto'")
+    template = os.path.join(save_dir, base_template)
+    delayed = dask.delayed
+    # the tasks get the configuration of the databroker when pickled, its
+    # connections can not be shared with other processes
+    db = BrokerProxy(db_config or broker_config(db), db)
+
+    # the tasks shared between runs, keyed by what they depend on
+    darks = {}
+    backgrounds = {}
+    geos = {}
+    binners = {}
+    integrators = {}
+
+    tasks = {}
+    for hdr in headers:
+        start = hdr['start']
+        if if_dark((start,)):
+            continue
+        if if_calibration(start) or not if_not_calibration((start,)):
+            print('skipping {}, it has no calibration'.format(
+                start['uid'][:6]))
+            continue
+        descriptors, events = _primary_documents(hdr)
+
+        dark_uid = query_dark(db, (start,))['start']['uid']
+        dark = _shared(darks, dark_uid, lambda: delayed(_latest_image)(
+            db, dark_uid, image_data_key))
+
+        bg_hdr = query_nearest_background(db, (start,))
+        bg = None
+        # an empty list if there is no background
+        if not isinstance(bg_hdr, list):
+            bg_uid = bg_hdr['start']['uid']
+            bg = _shared(backgrounds, bg_uid,
+                         lambda: delayed(average_background)(
+                             bg_uid, db, image_data_key=image_data_key,
+                             method=bg_stack_method))
+
+        cal_key = _freeze(start['calibration_md'])
+        geo = _shared(geos, cal_key, lambda: delayed(load_geo)(
+            start['calibration_md']))
+
+        run_tasks = [delayed(_write_md)(template, start)]
+        # the mask, and so the binner, is shared by all the runs with the
+        # same geometry unless it is made from the images
+        binner_key = None
+        if mask_setting is None:
+            mask = delayed(np.ones)((2048, 2048), dtype=bool)
+            binner_key = (cal_key, None)
+        elif mask_setting == 'cache':
+            mask = delayed(decompress_mask)(**start['mask_dict'])
+            binner_key = (cal_key, _freeze(start['mask_dict']))
+        if binner_key is not None:
+            binner = _shared(binners, binner_key,
+                             lambda: delayed(generate_binner)(
+                                 geo, (2048, 2048), mask))
+
+        # with micro-batching the first frame of a run is on its own if the
+        # mask is made from it
+        n_single = len(events)
+        if batching:
+            n_single = 1 if binner_key is None else 0
+        for i, event in enumerate(events[:n_single]):
+            descriptor = descriptors[event['descriptor']]
+            dark_sub = delayed(sub)(
+                delayed(_event_image)(db, event, descriptor, image_data_key),
+                dark)
+            fg = dark_sub
+            if bg is not None:
+                fg = delayed(sub)(dark_sub, bg)
+            img = delayed(polarization_correction)(
+                fg, geo, polarization_factor=polarization_factor)
+
+            if mask_setting == 'auto' or (binner_key is None and i == 0):
+                mask = delayed(mask_img)(img, geo, **mask_kwargs)
+                binner = delayed(generate_binner)(geo, (2048, 2048), mask)
+
+            q, iq = delayed(integrate, nout=2)(img, binner)
+            tth = delayed(q_to_twotheta)(q, start['bt_wavelength'])
+            r, pdf, config = delayed(pdf_getter, nout=3)(
+                q, iq, composition=start['sample_name'], **pdf_config)
+            # as in the pipeline the mask is saved when it is made
+            outputs = _frame_outputs(
+                dark_sub, q, iq, tth, r, pdf, config,
+                mask=mask if mask_setting == 'auto' or i == 0 else None)
+            run_tasks.append(delayed(_write)(template, start, descriptor,
+                                             event, outputs))
+
+        if batching and len(events) > n_single:
+            integrator = _shared(
+                integrators, binner_key or start['uid'],
+                lambda: delayed(StackIntegrator)(binner))
+            for j, batch in enumerate(micro_batches(
+                    events[n_single:], batch_size, batch_window)):
+                run_tasks.append(delayed(_reduce_batch)(
+                    db, template, start, descriptors, batch, image_data_key,
+                    dark, bg, geo, integrator, polarization_factor,
+                    pdf_config,
+                    mask=mask if n_single == 0 and j == 0 else None))
+        tasks[start['uid']] = run_tasks
+
+    kwargs = {'scheduler': scheduler}
+    if num_workers is not None:
+        kwargs['num_workers'] = num_workers
+    results, = dask.compute(tasks, **kwargs)
+    return {uid: [f for fs in run for f in fs]
+            for uid, run in results.items()}
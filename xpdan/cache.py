@@ -0,0 +1,497 @@
+"""Session level caches for the analysis pipelines"""
+import hashlib
+import inspect
+import os
+import pickle
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict, namedtuple
+from functools import wraps
+
+import numpy as np
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'evictions', 'size',
+                                     'currbytes', 'maxbytes'])
+
+_Run = namedtuple('_Run', ['start', 'stop', 'docs'])
+
+
+def _docs_nbytes(docs):
+    """Number of bytes held by the arrays in the events of ``docs``"""
+    return sum(v.nbytes for name, doc in docs if name == 'event'
+               for v in doc['data'].values() if isinstance(v, np.ndarray))
+
+
+class LRUCache(object):
+    """Least recently used cache with a memory budget
+
+    Parameters
+    ----------
+    max_bytes: int, optional
+        Memory budget for the cached values, in bytes. When the budget is
+        exceeded the least recently used values are evicted. Defaults to
+        1 GiB
+    """
+
+    def __init__(self, max_bytes=2 ** 30):
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._nbytes = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Get a cached value, marking it as recently used
+
+        Parameters
+        ----------
+        key: hashable
+            The key of the value
+        default: object, optional
+            Returned if the key is not cached, defaults to None
+
+        Returns
+        -------
+        object:
+            The cached value
+        """
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def peek(self, key):
+        """Get a cached value without touching the statistics"""
+        return self._data[key]
+
+    def put(self, key, value, nbytes):
+        """Add a value to the cache
+
+        Values which are larger than the whole budget are not cached.
+
+        Parameters
+        ----------
+        key: hashable
+            The key of the value
+        value: object
+            The value to cache
+        nbytes: int
+            The number of bytes the value accounts for in the budget
+        """
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                del self._data[key]
+                self._nbytes -= self._sizes.pop(key)
+            self._data[key] = value
+            self._sizes[key] = nbytes
+            self._nbytes += nbytes
+            while self._nbytes > self.max_bytes:
+                evicted, _ = self._data.popitem(last=False)
+                self._nbytes -= self._sizes.pop(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        """Empty the cache and reset the statistics"""
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self._nbytes = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def cache_info(self):
+        """Report the cache statistics
+
+        Returns
+        -------
+        CacheInfo:
+            The number of hits, misses and evictions, the number of cached
+            values and the bytes used out of the budget
+        """
+        return CacheInfo(self.hits, self.misses, self.evictions,
+                         len(self._data), self._nbytes, self.max_bytes)
+
+
+class RunCache(LRUCache):
+    """LRU cache of the filled documents of whole runs, keyed by start uid
+
+    Parameters
+    ----------
+    max_bytes: int, optional
+        Memory budget for the arrays held in the cache, in bytes. When the
+        budget is exceeded the least recently used runs are evicted.
+        Defaults to 1 GiB
+
+    Examples
+    --------
+    >>> cache = RunCache(max_bytes=2 ** 28)
+    >>> docs = cache.documents(db[dark_uid])  # loaded from disk
+    >>> docs = cache.documents(db[dark_uid])  # served from memory
+    >>> cache.cache_info()
+    CacheInfo(hits=1, misses=1, evictions=0, size=1, ...)
+    """
+
+    def add_run(self, docs):
+        """Add the documents of a run to the cache
+
+        Parameters
+        ----------
+        docs: list of tuple
+            The filled (name, doc) pairs of the run, starting with the start
+            document
+        """
+        docs = list(docs)
+        start = docs[0][1]
+        stop = docs[-1][1] if docs[-1][0] == 'stop' else None
+        self.put(start['uid'], _Run(start, stop, docs), _docs_nbytes(docs))
+
+    def documents(self, hdr):
+        """Filled documents of a header, only reading from disk on a miss
+
+        Parameters
+        ----------
+        hdr: databroker.broker.Header
+            The header to get the documents for
+
+        Returns
+        -------
+        list of tuple:
+            The filled (name, doc) pairs of the run
+        """
+        run = self.get(hdr['start']['uid'])
+        if run is None:
+            docs = list(hdr.documents(fill=True))
+            self.add_run(docs)
+            return docs
+        return run.docs
+
+    def header(self, uid):
+        """The start and stop documents of a cached run"""
+        run = self.peek(uid)
+        return {'start': run.start, 'stop': run.stop}
+
+
+class CachedHeader(object):
+    """Header look-alike which serves filled documents from a RunCache
+
+    Parameters
+    ----------
+    db: databroker.broker.Broker instance
+        The databroker holding the data
+    uid: str
+        The uid of the run start document
+    cache: RunCache
+        The cache to serve the filled documents from
+    hdr: databroker.broker.Header, optional
+        The header if it has already been fetched from the databroker
+    """
+
+    def __init__(self, db, uid, cache, hdr=None):
+        self.db = db
+        self.uid = uid
+        self.cache = cache
+        self._hdr = hdr
+
+    @property
+    def hdr(self):
+        if self._hdr is None:
+            self._hdr = self.db[self.uid]
+        return self._hdr
+
+    def __getitem__(self, key):
+        if self.uid in self.cache and key in ('start', 'stop'):
+            return self.cache.header(self.uid)[key]
+        return self.hdr[key]
+
+    def __getattr__(self, item):
+        return getattr(self.hdr, item)
+
+    def documents(self, fill=False, **kwargs):
+        if not fill or kwargs:
+            return self.hdr.documents(fill=fill, **kwargs)
+        run = self.cache.get(self.uid)
+        if run is None:
+            docs = list(self.hdr.documents(fill=True))
+            self.cache.add_run(docs)
+            return iter(docs)
+        return iter(run.docs)
+
+
+class CachedBroker(object):
+    """Databroker proxy which serves filled runs from a RunCache
+
+    Everything except looking up a run by its full uid is forwarded to the
+    underlying databroker.
+
+    Parameters
+    ----------
+    db: databroker.broker.Broker instance
+        The databroker holding the data
+    cache: RunCache
+        The cache to serve the filled documents from
+    """
+
+    def __init__(self, db, cache):
+        self.db = db
+        self.cache = cache
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key in self.cache:
+                return CachedHeader(self.db, key, self.cache)
+            hdr = self.db[key]
+            return CachedHeader(self.db, hdr['start']['uid'], self.cache,
+                                hdr)
+        return self.db[key]
+
+    def __call__(self, *args, **kwargs):
+        return self.db(*args, **kwargs)
+
+    def __getattr__(self, item):
+        return getattr(self.db, item)
+
+
+class DiskCache(object):
+    """On disk, content addressed, cache of the results of pipeline stages
+
+    Results are keyed by a hash of the stage's code, its parameters and
+    its inputs, so re-running a pipeline with different downstream
+    parameters only recomputes the stages whose inputs changed. The
+    results are pickled in ``directory``. When the files take more than
+    ``max_bytes`` the least recently used ones are removed.
+
+    Parameters
+    ----------
+    directory: str
+        The folder holding the cached results, created if needed
+    max_bytes: int, optional
+        Disk budget for the cached results, in bytes. Defaults to 10 GiB
+
+    Examples
+    --------
+    >>> stage_cache = DiskCache('/tmp/xpdan_cache')
+    >>> integrate = stage_cache.memoize(integrate)
+    >>> q, iq = integrate(img, binner)  # computed
+    >>> q, iq = integrate(img, binner)  # loaded from disk
+    """
+
+    def __init__(self, directory, max_bytes=10 * 2 ** 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.RLock()
+        # tokens of the results we returned, to not hash them again when
+        # they are passed on to the next stage
+        self._tokens = {}
+        os.makedirs(directory, exist_ok=True)
+        self._sizes = {}
+        for root, dirs, files in os.walk(directory):
+            for f in files:
+                if f.endswith('.pkl'):
+                    path = os.path.join(root, f)
+                    self._sizes[path] = os.path.getsize(path)
+
+    def __reduce__(self):
+        # for the worker processes, which open the cache again
+        return DiskCache, (self.directory, self.max_bytes)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.pkl')
+
+    def _remember(self, x, token):
+        if isinstance(x, (tuple, list)):
+            for j, v in enumerate(x):
+                self._remember(v, token + str(j))
+            return
+        i = id(x)
+        try:
+            ref = weakref.ref(x, lambda _: self._tokens.pop(i, None))
+        except TypeError:
+            return
+        self._tokens[i] = (ref, token)
+
+    def _update(self, h, x):
+        """Feed the content of ``x`` to the hash ``h``"""
+        known = self._tokens.get(id(x))
+        if known is not None and known[0]() is x:
+            h.update(known[1].encode())
+        elif isinstance(x, np.ndarray):
+            h.update(str((x.dtype.str, x.shape)).encode())
+            h.update(np.ascontiguousarray(x).data)
+        elif isinstance(x, dict):
+            h.update(b'dict')
+            for k in sorted(x, key=repr):
+                h.update(repr(k).encode())
+                self._update(h, x[k])
+        elif isinstance(x, (tuple, list)):
+            h.update(type(x).__name__.encode())
+            for v in x:
+                self._update(h, v)
+        elif hasattr(x, 'getPyFAI'):
+            # detector geometries are described by their pyFAI parameters
+            self._update(h, x.getPyFAI())
+        elif hasattr(x, '__dict__') and not callable(x):
+            h.update(type(x).__qualname__.encode())
+            self._update(h, vars(x))
+        else:
+            h.update(repr(x).encode())
+
+    def key(self, name, *args, **kwargs):
+        """The hash of a stage call
+
+        Parameters
+        ----------
+        name: str
+            Identifies the stage and the version of its code
+        args, kwargs:
+            The inputs and parameters of the stage
+
+        Returns
+        -------
+        str:
+            The hex digest
+        """
+        h = hashlib.sha1(name.encode())
+        self._update(h, args)
+        self._update(h, kwargs)
+        return h.hexdigest()
+
+    def get(self, key):
+        """Load a cached result
+
+        Returns
+        -------
+        bool:
+            Whether the result was cached
+        object:
+            The result, None if it was not cached
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            with self._lock:
+                self.misses += 1
+            return False, None
+        # mark as recently used
+        os.utime(path)
+        with self._lock:
+            self.hits += 1
+        return True, value
+
+    def put(self, key, value):
+        """Store a result, evicting the least recently used ones if needed"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write then move, so readers never see a partial file
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+        with self._lock:
+            self._sizes[path] = os.path.getsize(path)
+            if sum(self._sizes.values()) > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        def mtime(path):
+            try:
+                return os.path.getmtime(path)
+            except OSError:
+                return 0
+        total = sum(self._sizes.values())
+        for path in sorted(self._sizes, key=mtime):
+            if total <= self.max_bytes:
+                break
+            total -= self._sizes.pop(path)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.evictions += 1
+
+    def memoize(self, func, name=None):
+        """Make a version of a stage function which caches its results
+
+        Parameters
+        ----------
+        func: callable
+            The stage function
+        name: str, optional
+            Identifies the stage, defaults to the qualified name of the
+            function. The source code of the function is always part of
+            the key, so editing it invalidates the cached results
+
+        Returns
+        -------
+        callable:
+            The memoized function
+        """
+        if name is None:
+            name = '{}.{}'.format(getattr(func, '__module__', ''),
+                                  getattr(func, '__qualname__', repr(func)))
+        try:
+            code = inspect.getsource(func)
+        except (TypeError, OSError):
+            code = ''
+        name = name + hashlib.sha1(code.encode()).hexdigest()
+
+        @wraps(func)
+        def memoized(*args, **kwargs):
+            key = self.key(name, *args, **kwargs)
+            hit, value = self.get(key)
+            if not hit:
+                value = func(*args, **kwargs)
+                self.put(key, value)
+            self._remember(value, key)
+            return value
+
+        return memoized
+
+    def clear(self):
+        """Remove all the cached results"""
+        with self._lock:
+            for path in self._sizes:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._sizes.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def cache_info(self):
+        """Report the cache statistics
+
+        Returns
+        -------
+        CacheInfo:
+            The number of hits, misses and evictions, the number of cached
+            results and the bytes used out of the budget
+        """
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.evictions,
+                             len(self._sizes), sum(self._sizes.values()),
+                             self.max_bytes)
+
+
+# Darks and backgrounds are shared by many consecutive runs, so keep one
+# cache of each per session
+dark_cache = RunCache()
+background_cache = LRUCache(max_bytes=2 ** 29)
@@ -17,8 +17,6 @@ import os
 import time
 
 import yaml
-from pyFAI.calibration import Calibration, PeakPicker
-from pyFAI.gui.utils import update_fig
 
 from xpdan.dev_utils import _timestampstr
 
@@ -80,6 +78,9 @@ def _calibration(img, calibration, calib_ref_fp, **kwargs):
         additional keyword argument for calibration. please refer to
         pyFAI documentation for all options.
     """
+    # the pyFAI GUI modules are slow to import, only load them when needed
+    from pyFAI.calibration import PeakPicker
+    from pyFAI.gui.utils import update_fig
     print('{:=^20}'.format("INFO: you are able to perform calibration, "
                            "please refer to pictorial guide here:\n"))
     print('{:^20}'
@@ -174,6 +175,7 @@ def img_calibration(img, wavelength, calibrant=None,
         detector = 'perkin_elmer'
     if calibrant is None:
         calibrant = 'Ni'
+    from pyFAI.calibration import Calibration
     # configure calibration instance
     c = Calibration(calibrant, detector, wavelength)
     # pyFAI calibration
@@ -13,35 +13,67 @@
 # See LICENSE.txt for license information.
 #
 ##############################################################################
-from xpdan.data_reduction_core import (integrate_and_save, save_tiff,
-                                       integrate_and_save_last, save_last_tiff)
-from xpdan.glbl import an_glbl
-from functools import partial
+from functools import wraps, partial
 import inspect
 
+from xpdan import data_reduction_core
+from xpdan.dev_utils import import_attribute, lazy_attributes
+
 # We are going to do some inspection magic to make functions who's default
-# kwargs come from the globals
+# kwargs come from the globals. The globals and the pipelines are only
+# loaded when one of the functions is first called, as both are slow to
+# import.
+
+
+def _glbl_kwargs(func):
+    from xpdan.glbl import an_glbl
+    kwargs = {}
+    for k in inspect.signature(func).parameters.keys():
+        if k in an_glbl.keys():
+            kwargs[k] = an_glbl[k]
+    kwargs.update({'db': an_glbl['exp_db'],
+                   'save_dir': an_glbl['tiff_base']})
+    return kwargs
+
+
+def _with_glbl_defaults(func, signature_of=None):
+    """Give a function of data_reduction_core the defaults of the globals
+
+    The defaults are the globals named as the parameters of
+    ``signature_of``, defaults to ``func``. The function is looked up when
+    called.
+    """
+    name = func.__name__
+    if signature_of is None:
+        signature_of = func
+
+    @wraps(func)
+    def inner(*args, **kwargs):
+        return getattr(data_reduction_core, name)(
+            *args, **dict(_glbl_kwargs(signature_of), **kwargs))
 
-int_save_kwargs = {}
-for k in inspect.signature(integrate_and_save).parameters.keys():
-    if k in an_glbl.keys():
-        int_save_kwargs[k] = an_glbl[k]
+    return inner
 
-int_save_kwargs.update({'db': an_glbl['exp_db'],
-                        'save_dir': an_glbl['tiff_base']})
 
-tiff_save_kwargs = {}
-for k in inspect.signature(save_tiff).parameters.keys():
-    if k in an_glbl.keys():
-        tiff_save_kwargs[k] = an_glbl[k]
+integrate_and_save = _with_glbl_defaults(
+    data_reduction_core.integrate_and_save)
 
-tiff_save_kwargs.update({'db': an_glbl['exp_db'],
-                         'save_dir': an_glbl['tiff_base']})
+# the _last functions take ``**kwargs``, they get the defaults of the
+# functions they call
+integrate_and_save_last = _with_glbl_defaults(
+    data_reduction_core.integrate_and_save_last,
+    signature_of=data_reduction_core.integrate_and_save)
 
-integrate_and_save = partial(integrate_and_save, **int_save_kwargs)
+save_tiff = _with_glbl_defaults(data_reduction_core.save_tiff)
 
-integrate_and_save_last = partial(integrate_and_save_last, **int_save_kwargs)
+save_last_tiff = _with_glbl_defaults(
+    data_reduction_core.save_last_tiff,
+    signature_of=data_reduction_core.save_tiff)
 
-save_tiff = partial(save_tiff, **tiff_save_kwargs)
 
-save_last_tiff = partial(save_last_tiff, **tiff_save_kwargs)
+# still available from this module, resolved on first use
+lazy_attributes(__name__, {
+    'an_glbl': partial(import_attribute, 'xpdan.glbl', 'an_glbl'),
+    'int_save_kwargs': partial(_glbl_kwargs,
+                               data_reduction_core.integrate_and_save),
+    'tiff_save_kwargs': partial(_glbl_kwargs, data_reduction_core.save_tiff)})
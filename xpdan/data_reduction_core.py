@@ -14,8 +14,17 @@
 #
 ##############################################################################
 
-from xpdan.pipelines.main import conf_main_pipeline
-from xpdan.pipelines.save_tiff import conf_save_tiff_pipeline
+import multiprocessing
+import traceback
+
+from xpdan.cache import DiskCache
+from xpdan.db_utils import prefetch_documents, broker_config, open_broker
+
+# The pipelines pull in most of the dependencies, so they are imported when
+# they are configured to keep importing this module fast
+
+# state of the reprocessing worker processes
+_worker_state = {}
 
 
 def _prepare_header_list(headers):
@@ -28,10 +37,70 @@ def _prepare_header_list(headers):
     return header_list
 
 
+def _init_worker(db_config, save_dir, pipeline_kwargs):
+    # every worker has its own connections to the databases
+    _worker_state.update(db=open_broker(db_config), save_dir=save_dir,
+                         pipeline_kwargs=pipeline_kwargs, source=None)
+
+
+def _process_header(uid):
+    """Run one header through the worker's pipeline
+
+    Returns
+    -------
+    uid: str
+        The uid of the header
+    error: str or None
+        The traceback if the header failed, None otherwise
+    """
+    from xpdan.pipelines.executor import wait_for_writes
+    from xpdan.pipelines.main import conf_main_pipeline
+    db = _worker_state['db']
+    if _worker_state['source'] is None:
+        _worker_state['source'] = conf_main_pipeline(
+            db, _worker_state['save_dir'], **_worker_state['pipeline_kwargs'])
+    try:
+        for nd in db[uid].documents(fill=False):
+            _worker_state['source'].emit(nd)
+        wait_for_writes()
+    except Exception:
+        # the pipeline may hold part of the failed run, start fresh
+        _worker_state['source'] = None
+        return uid, traceback.format_exc()
+    return uid, None
+
+
+def _integrate_and_save_parallel(hdrs, db_config, save_dir, n_workers,
+                                 pipeline_kwargs):
+    uids = [hdr['start']['uid'] for hdr in hdrs]
+    summary = {'processed': [], 'failed': {}}
+    # spawn fresh interpreters, a fork would share the database clients,
+    # threads and locks of this process with the workers
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(n_workers, initializer=_init_worker,
+                  initargs=(db_config, save_dir, pipeline_kwargs)) as pool:
+        for i, (uid, error) in enumerate(
+                pool.imap_unordered(_process_header, uids), 1):
+            if error is None:
+                summary['processed'].append(uid)
+                status = 'done'
+            else:
+                summary['failed'][uid] = error
+                status = 'FAILED'
+            print('[{}/{}] {} {:.6}'.format(i, len(uids), status, uid))
+    print('processed {} headers, {} failed'.format(
+        len(summary['processed']), len(summary['failed'])))
+    for uid, error in summary['failed'].items():
+        print('header {} failed with:\n{}'.format(uid, error))
+    return summary
+
+
 def integrate_and_save(headers, *, db, save_dir, visualize=False,
                        polarization_factor=0.99, mask_setting='default',
                        mask_kwargs=None, image_data_key='pe1_image',
-                       pdf_config=None):
+                       pdf_config=None, n_workers=None, stage_cache=None,
+                       resume=False, prefetch=8, prefetch_bytes=2 ** 30,
+                       output_format='files', db_config=None):
     """Integrate and save dark subtracted images for given list of headers
 
     Parameters
@@ -62,6 +131,43 @@ def integrate_and_save(headers, *, db, save_dir, visualize=False,
     pdf_config: dict, optional
         Configuration for making PDFs, see pdfgetx3 docs. Defaults to
         ``dict(dataformat='QA', qmaxinst=28, qmax=22)``
+    n_workers: int, optional
+        If more than one, distribute the headers over this many worker
+        processes, each with its own pipeline. A header which fails does
+        not stop the others and visualization is disabled. The workers are
+        new processes (scripts must guard their code with
+        ``if __name__ == '__main__'``) which connect to the databroker
+        themselves, see ``db_config``. Defaults to None, process the
+        headers serially
+    stage_cache: str or xpdan.cache.DiskCache, optional
+        Cache the results of the stages up to the integration on disk, so
+        re-running with a different ``pdf_config`` only recomputes the
+        PDFs. If a str, the folder of the cache. Defaults to None, no
+        caching
+    resume: bool, optional
+        If True skip the events whose files were all written by an earlier
+        reduction (as recorded in ``save_dir/manifest``) and have not
+        changed since, without loading their images. Defaults to False
+    prefetch: int, optional
+        Number of documents read and filled ahead on a background thread,
+        continuing into the next header, while the current frame is
+        reduced. If 0 or None read the documents as they are reduced.
+        Only used without workers. Defaults to 8
+    prefetch_bytes: int, optional
+        Bytes of images which may be read ahead, defaults to 1 GiB
+    output_format: {'files', 'hdf5', 'both'}, optional
+        Write a file per frame and stage ('files'), a HDF5 file per run
+        ('hdf5') or both. Defaults to 'files'
+    db_config: str or dict, optional
+        The name or the configuration of the databroker, for the workers to
+        open their own. Defaults to the configuration of ``db``, see
+        ``xpdan.db_utils.broker_config``
+
+    Returns
+    -------
+    dict or None:
+        When using workers, the uids of the ``'processed'`` headers and a
+        mapping of the ``'failed'`` header uids to their tracebacks
 
     Note
     ----
@@ -72,17 +178,38 @@ def integrate_and_save(headers, *, db, save_dir, visualize=False,
     --------
     xpdan.tools.mask_img
     """
+    from xpdan.pipelines.executor import wait_for_writes
+    from xpdan.pipelines.main import conf_main_pipeline
     hdrs = _prepare_header_list(headers)
+    if isinstance(stage_cache, str):
+        stage_cache = DiskCache(stage_cache)
+    pipeline_kwargs = dict(write_to_disk=True,
+                           polarization_factor=polarization_factor,
+                           image_data_key=image_data_key,
+                           mask_setting=mask_setting,
+                           mask_kwargs=mask_kwargs,
+                           pdf_config=pdf_config,
+                           stage_cache=stage_cache,
+                           resume=resume,
+                           output_format=output_format)
+    if n_workers is not None and n_workers > 1:
+        if db_config is None:
+            db_config = broker_config(db)
+        return _integrate_and_save_parallel(
+            hdrs, db_config, save_dir, n_workers,
+            dict(vis=False, **pipeline_kwargs))
     source = conf_main_pipeline(db, save_dir, vis=visualize,
-                                write_to_disk=True,
-                                polarization_factor=polarization_factor,
-                                image_data_key=image_data_key,
-                                mask_setting=mask_setting,
-                                mask_kwargs=mask_kwargs,
-                                pdf_config=pdf_config)
-    for hdr in hdrs:
-        for nd in hdr.documents(fill=True):
-            source.emit(nd)
+                                **pipeline_kwargs)
+    if prefetch:
+        # when resuming the pipeline decides which images to read
+        docs = prefetch_documents(hdrs, depth=prefetch,
+                                  max_bytes=prefetch_bytes, fill=not resume)
+    else:
+        # the pipeline only loads the images it reduces
+        docs = (nd for hdr in hdrs for nd in hdr.documents(fill=False))
+    for nd in docs:
+        source.emit(nd)
+    wait_for_writes()
 
 
 def integrate_and_save_last(**kwargs):
@@ -149,6 +276,7 @@ def save_tiff(headers, *, db, save_dir,
     image_data_key: str, optional
         The key for the image data, defaults to `pe1_image`
     """
+    from xpdan.pipelines.save_tiff import conf_save_tiff_pipeline
     # normalize list
     hdrs = _prepare_header_list(headers)
     source = conf_save_tiff_pipeline(db=db, vis=visualize, save_dir=save_dir,
@@ -156,7 +284,8 @@ def save_tiff(headers, *, db, save_dir,
                                      image_data_key=image_data_key,
                                      )
     for hdr in hdrs:
-        for nd in hdr.documents(fill=True):
+        # the pipeline only loads the images it saves
+        for nd in hdr.documents(fill=False):
             source.emit(nd)
 
 
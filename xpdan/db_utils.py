@@ -1,8 +1,17 @@
-from itertools import islice
+import importlib
+import json
+import threading
+import time
+from bisect import bisect_left
 from pprint import pprint
+
+import numpy as np
+
 from .dev_utils import _timestampstr
+from .tools import ImageStack
+from .cache import (CachedHeader, CachedBroker, LRUCache, dark_cache as
+                    session_dark_cache, background_cache)
 import collections
-from databroker._core import Header
 
 
 def sort_scans_by_hdr_key(hdrs, key, verbose=True):
@@ -144,20 +153,508 @@ def query_dark(db, docs, schema=1):
         return db[doc['sc_dk_field_uid']]
 
 
+def _background_query(doc):
+    return dict(sample_name=doc['bkgd_sample_name'],
+                is_dark={'$exists': False})
+
+
 def query_background(db, docs, schema=1):
     if schema == 1:
         doc = docs[0]
-        return db(sample_name=doc['bkgd_sample_name'],
-                  is_dark={'$exists': False})
+        return db(**_background_query(doc))
 
 
 def temporal_prox(res, docs):
+    """Get the result closest in time to the first document
+
+    Parameters
+    ----------
+    res: Header or iterable of Header
+        The search results
+    docs: tuple of dict
+        The documents, the first of which has the reference time
+
+    Returns
+    -------
+    Header:
+        The closest header, None if there are no results
+    """
+    from databroker._core import Header
     # If there is only one result just use that one
-    if isinstance(res, Header):
+    if isinstance(res, (Header, CachedHeader)):
         return res
-    doc = docs[0]
-    t = doc['time']
-    dt_sq = [(t - r['start']['time']) ** 2 for r in res]
-    i = dt_sq.index(min(dt_sq))
-    min_r = next(islice(res, i, i + 1))
+    t = docs[0]['time']
+    # only walk the results once, as each walk re-runs the query
+    min_dt = None
+    min_r = None
+    for r in res:
+        dt = abs(t - r['start']['time'])
+        if min_dt is None or dt < min_dt:
+            min_dt, min_r = dt, r
     return min_r
+
+
+def _freeze(query):
+    if isinstance(query, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in query.items()))
+    return query
+
+
+def _find_run_starts(db, query):
+    mds = getattr(db, 'mds', None)
+    if hasattr(mds, 'find_run_starts'):
+        return mds.find_run_starts(**query)
+    return (hdr['start'] for hdr in db(**query))
+
+
+class TemporalIndex(object):
+    """Session cache of run start times for temporal proximity lookups
+
+    Only the start documents of the matching runs are retrieved, once per
+    query, and kept sorted by time so the nearest run is found with a
+    bisection. Only the winning header is fetched from the databroker.
+
+    Parameters
+    ----------
+    max_age: float, optional
+        Number of seconds after which the index of a query is rebuilt, so
+        runs taken during a live session are found. If None the index is
+        never rebuilt. Defaults to 60
+    max_entries: int, optional
+        Number of queries and of headers kept, the least recently used are
+        dropped so a long running session does not grow without bound.
+        Defaults to 256
+    """
+
+    def __init__(self, max_age=60, max_entries=256):
+        self.max_age = max_age
+        # the entries all count as one byte
+        self._index = LRUCache(max_entries)
+        self._hdrs = LRUCache(max_entries)
+
+    def _times_uids(self, db, query):
+        key = (id(db), _freeze(query))
+        entry = self._index.get(key)
+        now = time.time()
+        if entry is None or (self.max_age is not None and
+                             now - entry[1] > self.max_age):
+            pairs = sorted((start['time'], start['uid'])
+                           for start in _find_run_starts(db, query))
+            # hold on to the databroker so its id is not reused
+            entry = (db, now, [p[0] for p in pairs], [p[1] for p in pairs])
+            self._index.put(key, entry, 1)
+        return entry[2], entry[3]
+
+    def nearest(self, db, query, t):
+        """Get the run matching the query which started closest to ``t``
+
+        Parameters
+        ----------
+        db: Broker instance
+            The databroker holding the data
+        query: dict
+            The databroker query
+        t: float
+            The reference time
+
+        Returns
+        -------
+        Header or list:
+            The closest header, an empty list if no run matches
+        """
+        times, uids = self._times_uids(db, query)
+        if not times:
+            return []
+        i = bisect_left(times, t)
+        i = min((j for j in (i - 1, i) if 0 <= j < len(times)),
+                key=lambda j: abs(times[j] - t))
+        uid = uids[i]
+        hdr = self._hdrs.get(uid)
+        if hdr is None:
+            hdr = db[uid]
+            self._hdrs.put(uid, hdr, 1)
+        return hdr
+
+    def clear(self):
+        """Forget all the indexed queries"""
+        self._index.clear()
+        self._hdrs.clear()
+
+
+temporal_index = TemporalIndex()
+
+
+def query_nearest_background(db, docs, schema=1, index=None):
+    """Get the background run closest in time to the run
+
+    Parameters
+    ----------
+    db: Broker instance
+        The databroker holding the data
+    docs: tuple of dict
+        The documents, the first of which is the run start
+    schema: int
+        Schema version
+    index: TemporalIndex, optional
+        The index of the start times, defaults to the session wide
+        ``temporal_index``
+
+    Returns
+    -------
+    Header or list:
+        The closest background header, an empty list if there is none
+    """
+    if index is None:
+        index = temporal_index
+    if schema == 1:
+        doc = docs[0]
+        return index.nearest(db, _background_query(doc), doc['time'])
+
+
+def average_background(hdr_uids, db, image_data_key='pe1_image',
+                       dark_cache=None, bg_cache=None, method='mean',
+                       sigma=3.):
+    """Get the dark subtracted average of background runs
+
+    The average is memoized by the uids of the background runs, so runs
+    sharing a background only compute it, and find the darks of the
+    backgrounds, once.
+
+    Parameters
+    ----------
+    hdr_uids: str or list of str
+        The uids of the background runs
+    db: Broker instance
+        The databroker holding the data
+    image_data_key: str, optional
+        The key for the image data, defaults to `pe1_image`
+    dark_cache: xpdan.cache.RunCache, optional
+        Cache for the filled dark runs, defaults to
+        ``xpdan.cache.dark_cache``
+    bg_cache: xpdan.cache.LRUCache, optional
+        Cache for the averaged backgrounds, defaults to
+        ``xpdan.cache.background_cache``
+    method: {'mean', 'sigma_clip', 'median'}, optional
+        How to combine the background frames, the robust methods keep a
+        cosmic ray in a single frame out of the background. Defaults to
+        'mean'
+    sigma: float, optional
+        The clipping threshold for 'sigma_clip', defaults to 3
+
+    Returns
+    -------
+    np.ndarray:
+        The averaged background, read only as it is shared between runs
+    """
+    if isinstance(hdr_uids, str):
+        hdr_uids = [hdr_uids]
+    if dark_cache is None:
+        dark_cache = session_dark_cache
+    if bg_cache is None:
+        bg_cache = background_cache
+    # looked up before the databroker, so a hit costs no queries
+    key = (image_data_key, method, sigma, tuple(sorted(hdr_uids)))
+    ave = bg_cache.get(key)
+    if ave is not None:
+        return ave
+
+    dark_db = CachedBroker(db, dark_cache)
+    hdrs = [db[uid] for uid in hdr_uids]
+    darks = [temporal_prox(query_dark(dark_db, (hdr['start'],)),
+                           (hdr['start'],)) for hdr in hdrs]
+    stack = ImageStack(method, sigma=sigma)
+    for hdr, dark in zip(hdrs, darks):
+        # the latest dark frame is used, as in the foreground subtraction
+        dark_img = [doc['data'][image_data_key] for name, doc in
+                    dark.documents(fill=True) if name == 'event'][-1]
+        for name, doc in hdr.documents(fill=True):
+            if name == 'event':
+                stack.add(doc['data'][image_data_key], offset=dark_img)
+    ave = stack.result()
+    ave.setflags(write=False)
+    bg_cache.put(key, ave, ave.nbytes)
+    return ave
+
+
+class LazyData(dict):
+    """Event data which loads its external values when they are accessed
+
+    Until then the external keys hold their datum ids, as in an unfilled
+    event. The first access to any external key fills them all, once.
+
+    Parameters
+    ----------
+    data: dict
+        The data of the unfilled event
+    external: set of str
+        The keys which refer to external data
+    load: callable
+        Returns the filled data
+    """
+
+    def __init__(self, data, external, load):
+        dict.__init__(self, data)
+        self.external = set(external)
+        self._load = load
+
+    def _fill(self):
+        if self._load is not None:
+            load, self._load = self._load, None
+            dict.update(self, {k: v for k, v in load().items()
+                               if k in self.external})
+
+    @property
+    def filled(self):
+        """Whether the external data has been loaded"""
+        return self._load is None
+
+    def __getitem__(self, key):
+        if key in self.external:
+            self._fill()
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        if key in self.external:
+            self._fill()
+        return dict.get(self, key, default)
+
+
+class LazyFiller(object):
+    """Fill events on demand, when a stage accesses their external data
+
+    Used in place of eagerly filled documents, the images of the events
+    which are filtered out, eg. of dark runs, are never read.
+
+    Parameters
+    ----------
+    db: databroker.broker.Broker instance
+        The databroker to fill the events from
+
+    Examples
+    --------
+    >>> source.map(LazyFiller(db))
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.descriptors = {}
+
+    def __call__(self, nd):
+        name, doc = nd
+        if name == 'descriptor':
+            self.descriptors[doc['uid']] = doc
+        elif name == 'start':
+            self.descriptors = {}
+        if name != 'event' or isinstance(doc['data'], LazyData):
+            return nd
+        descriptor = self.descriptors.get(doc['descriptor'])
+        if descriptor is None:
+            return nd
+        external = [k for k, v in descriptor['data_keys'].items()
+                    if v.get('external') and
+                    not doc.get('filled', {}).get(k, False)]
+        if not external:
+            return nd
+        db = self.db
+
+        def load():
+            event = next(iter(db.fill_events([doc], [descriptor])))
+            return event['data']
+
+        return name, dict(doc, data=LazyData(doc['data'], external, load))
+
+
+def _nbytes(nd):
+    name, doc = nd
+    if name != 'event':
+        return 0
+    return sum(v.nbytes for v in dict.values(doc['data'])
+               if isinstance(v, np.ndarray))
+
+
+def prefetch_documents(hdrs, depth=8, max_bytes=2 ** 30, fill=True):
+    """Read the documents of headers ahead, on a background thread
+
+    The documents are read, and the events filled, while the previous ones
+    are processed. The reading continues into the next header. Dark runs
+    are not filled, the pipelines do not use their images.
+
+    Parameters
+    ----------
+    hdrs: list of Header
+        The headers
+    depth: int, optional
+        The maximum number of documents read ahead, defaults to 8
+    max_bytes: int, optional
+        The maximum number of bytes of images read ahead, at least one
+        document is always read ahead. Defaults to 1 GiB
+    fill: bool, optional
+        If True fill the events, defaults to True
+
+    Yields
+    ------
+    name: str
+        The name of the document
+    doc: dict
+        The document
+    """
+    cond = threading.Condition()
+    queue = collections.deque()
+    state = {'nbytes': 0, 'done': False, 'error': None, 'closed': False}
+
+    def has_room(nbytes):
+        return state['closed'] or not queue or (
+            len(queue) < depth and state['nbytes'] + nbytes <= max_bytes)
+
+    def read():
+        try:
+            for hdr in hdrs:
+                f = fill and not hdr['start'].get('dark_frame', False)
+                for nd in hdr.documents(fill=f):
+                    nbytes = _nbytes(nd)
+                    with cond:
+                        cond.wait_for(lambda: has_room(nbytes))
+                        if state['closed']:
+                            return
+                        queue.append((nd, nbytes))
+                        state['nbytes'] += nbytes
+                        cond.notify_all()
+        except Exception as e:
+            state['error'] = e
+        finally:
+            with cond:
+                state['done'] = True
+                cond.notify_all()
+
+    thread = threading.Thread(target=read, daemon=True)
+    thread.start()
+    try:
+        while True:
+            with cond:
+                cond.wait_for(lambda: queue or state['done'])
+                if not queue:
+                    break
+                nd, nbytes = queue.popleft()
+                state['nbytes'] -= nbytes
+                cond.notify_all()
+            yield nd
+        if state['error'] is not None:
+            raise state['error']
+    finally:
+        with cond:
+            state['closed'] = True
+            cond.notify_all()
+
+
+def _component_config(component):
+    cls = type(component)
+    return {'module': cls.__module__, 'class': cls.__name__,
+            'config': dict(component.config)}
+
+
+def broker_config(db):
+    """The configuration of a databroker, to connect to it again
+
+    The configuration is the one of ``Broker.from_config``, with the
+    handlers registered on ``db`` listed under ``'handlers'``. It lets
+    another process open its own connections to the databases, which can
+    not be shared with it.
+
+    Parameters
+    ----------
+    db: databroker.broker.Broker instance
+        The databroker
+
+    Returns
+    -------
+    dict:
+        The configuration
+    """
+    handlers = {}
+    for spec, handler in dict(getattr(db.reg, 'handler_reg', {})).items():
+        # only module level classes can be imported by name
+        if (isinstance(handler, type) and
+                handler.__qualname__ == handler.__name__):
+            handlers[spec] = {'module': handler.__module__,
+                              'class': handler.__name__}
+    return {'metadatastore': _component_config(db.mds),
+            'assets': _component_config(db.reg),
+            'handlers': handlers}
+
+
+def open_broker(config):
+    """Open a databroker from its name or its configuration
+
+    Parameters
+    ----------
+    config: str or dict
+        The name of the databroker configuration or the configuration, as
+        returned by ``broker_config``
+
+    Returns
+    -------
+    databroker.broker.Broker instance:
+        The databroker
+    """
+    from databroker import Broker
+    if isinstance(config, str):
+        return Broker.named(config)
+
+    def load(spec):
+        return getattr(importlib.import_module(spec['module']),
+                       spec['class'])
+
+    db = Broker(load(config['metadatastore'])(
+                    config['metadatastore']['config']),
+                load(config['assets'])(config['assets']['config']))
+    for spec, handler in config.get('handlers', {}).items():
+        db.reg.register_handler(spec, load(handler), overwrite=True)
+    return db
+
+
+# the databrokers opened by this process, keyed by their configuration
+_open_brokers = {}
+
+
+class BrokerProxy(object):
+    """A databroker which can be pickled, as its configuration
+
+    The proxy passes everything on to the databroker. Once unpickled, eg.
+    in a worker process, it opens the databroker from its configuration on
+    first use, once per process.
+
+    Parameters
+    ----------
+    config: str or dict
+        The name or the configuration of the databroker, see
+        ``open_broker``
+    db: databroker.broker.Broker instance, optional
+        The open databroker, used until the proxy is pickled
+    """
+
+    def __init__(self, config, db=None):
+        self.config = config
+        self._db = db
+
+    @property
+    def db(self):
+        if self._db is None:
+            key = json.dumps(self.config, sort_keys=True, default=repr)
+            if key not in _open_brokers:
+                _open_brokers[key] = open_broker(self.config)
+            self._db = _open_brokers[key]
+        return self._db
+
+    def __getstate__(self):
+        return {'config': self.config, '_db': None}
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name in ('config', '_db'):
+            raise AttributeError(name)
+        return getattr(self.db, name)
+
+    def __getitem__(self, key):
+        return self.db[key]
+
+    def __call__(self, *args, **kwargs):
+        return self.db(*args, **kwargs)
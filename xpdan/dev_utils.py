@@ -1,4 +1,7 @@
 import datetime
+import importlib
+import sys
+import types
 
 
 def _clean_info(input_str):
@@ -10,3 +13,37 @@ def _timestampstr(timestamp):
     timestring = datetime.datetime.fromtimestamp(float(timestamp)).strftime(
         '%Y%m%d-%H%M%S')
     return timestring
+
+
+def import_attribute(module, attr):
+    """Import a module and get one of its attributes"""
+    return getattr(importlib.import_module(module), attr)
+
+
+def lazy_attributes(name, attributes):
+    """Resolve attributes of a module when they are first used
+
+    This keeps names whose import is slow available from a module without
+    importing them with it. Module level ``__getattr__`` needs python 3.7,
+    so the class of the module is swapped instead.
+
+    Parameters
+    ----------
+    name: str
+        The name of the module, its ``__name__``
+    attributes: dict
+        Maps the attribute names to functions returning their value
+    """
+    class LazyModule(types.ModuleType):
+        def __getattr__(self, attr):
+            if attr not in attributes:
+                raise AttributeError('module {!r} has no attribute '
+                                     '{!r}'.format(name, attr))
+            value = attributes[attr]()
+            setattr(self, attr, value)
+            return value
+
+        def __dir__(self):
+            return sorted(set(super().__dir__()) | set(attributes))
+
+    sys.modules[name].__class__ = LazyModule
@@ -1,5 +1,6 @@
 import re
 import string
+from _string import formatter_field_name_split
 from collections import defaultdict
 from pathlib import Path
 
@@ -52,11 +53,9 @@ cfmt = CleanFormatter()
 pfmt = PartialFormatter()
 
 
-def clean_template(template, removals=None, cfmt=cfmt):
+def _clean(d, removals=None):
     if removals is None:
         removals = ['temp', 'dx', 'dy']
-    d = cfmt.format(template, defaultdict(str))
-
     for r in removals:
         d = d.replace('[{}=]'.format(r), '')
     z = re.sub(r"__+", "_", d)
@@ -70,6 +69,126 @@ def clean_template(template, removals=None, cfmt=cfmt):
     return f
 
 
-def render_and_clean(string, formatter=pfmt, **kwargs):
+def clean_template(template, removals=None, cfmt=cfmt):
+    d = cfmt.format(template, defaultdict(str))
+    return _clean(d, removals)
+
+
+def _render_and_clean(string, formatter=pfmt, **kwargs):
     formatted_string = formatter.format(string, **kwargs)
     return clean_template(formatted_string)
+
+
+_missing = object()
+
+
+class CompiledTemplate(object):
+    """A file name template parsed once
+
+    Calling it with the documents gives the same file name as
+    ``render_and_clean``, without parsing the template and the rendered
+    name again. The fields are rendered from the argument they are looked
+    up in, and reused while it is the same object as in the last call, so
+    the names of the outputs of an event, which only differ by their
+    analysis stage and extension, share the rendering of the event. The
+    documents must not be changed in between calls.
+
+    Values holding braces, which would be parsed again by the cleaning, and
+    templates with positional or nested fields are rendered as by
+    ``render_and_clean``.
+
+    Parameters
+    ----------
+    template: str
+        The template
+
+    Examples
+    --------
+    >>> render = compile_template(base_template)
+    >>> render(raw_start=start, raw_event=event, raw_descriptor=descriptor,
+    ...        human_timestamp=ts, analyzed_start={'analysis_stage': 'pdf'},
+    ...        ext='.gr')
+    """
+
+    def __init__(self, template):
+        self.template = template
+        self.fields = None
+        self.tail = ''
+        self._memo = {}
+        fields = []
+        try:
+            parsed = list(pfmt.parse(template))
+        except ValueError:
+            return
+        for literal, field_name, spec, conversion in parsed:
+            if '{' in literal or '}' in literal:
+                return
+            if field_name is None:
+                self.tail = literal
+                break
+            first, rest = formatter_field_name_split(field_name)
+            if not first or isinstance(first, int) or '{' in spec:
+                return
+            fields.append((literal, field_name, first, list(rest), spec,
+                           conversion))
+        self.fields = fields
+
+    @staticmethod
+    def _render_field(field, kwargs):
+        """The cleaned value of a field, None if it can not be done alone"""
+        literal, field_name, first, rest, spec, conversion = field
+        try:
+            obj = kwargs[first]
+            for is_attr, i in rest:
+                obj = getattr(obj, i) if is_attr else obj[i]
+        except (KeyError, AttributeError):
+            placeholder = '{' + field_name + '}'
+            value = pfmt.format_field(pfmt.convert_field(placeholder,
+                                                         conversion), spec)
+            if value in (placeholder, '{%s:%s}' % (field_name, spec)):
+                # left to the cleaning, which removes it
+                return cfmt.format(value, defaultdict(str))
+            return None
+        value = pfmt.format_field(pfmt.convert_field(obj, conversion), spec)
+        if '{' in value or '}' in value:
+            return None
+        return value
+
+    def __call__(self, **kwargs):
+        if self.fields is None:
+            return _render_and_clean(self.template, **kwargs)
+        parts = []
+        memo = self._memo
+        for i, field in enumerate(self.fields):
+            top = kwargs.get(field[2], _missing)
+            last = memo.get(i)
+            if last is not None and last[0] is top:
+                value = last[1]
+            else:
+                value = self._render_field(field, kwargs)
+                if value is None:
+                    return _render_and_clean(self.template, **kwargs)
+                memo[i] = (top, value)
+            parts.append(field[0])
+            parts.append(value)
+        parts.append(self.tail)
+        return _clean(''.join(parts))
+
+
+_compiled = {}
+
+
+def compile_template(template):
+    """The compiled version of a template, see ``CompiledTemplate``"""
+    compiled = _compiled.get(template)
+    if compiled is None:
+        if len(_compiled) >= 128:
+            _compiled.clear()
+        compiled = _compiled[template] = CompiledTemplate(template)
+    return compiled
+
+
+def render_and_clean(string, formatter=pfmt, **kwargs):
+    if formatter is pfmt:
+        return compile_template(string)(**kwargs)
+    return _render_and_clean(string, formatter, **kwargs)
@@ -3,14 +3,11 @@ import shutil
 import tempfile
 
 import yaml
-from databroker import Broker
-try:
-    db = Broker.named('xpd')
-except NameError:
-    from xpdsim import db
 import logging
 from pkg_resources import resource_filename as rs_fn
 
+from xpdan.dev_utils import lazy_attributes
+
 logger = logging.getLogger(__name__)
 pytest_dir = rs_fn('xpdan', 'tests')
 
@@ -62,6 +59,20 @@ def load_configuration(name):
     return config
 
 
+def _simulation_db():
+    # resolved on use, as looking up the databroker configuration is slow
+    from databroker import Broker
+    try:
+        return Broker.named('xpd')
+    except NameError:
+        from xpdsim import db
+        return db
+
+
+# still available from this module, looked up on first use
+lazy_attributes(__name__, {'db': _simulation_db})
+
+
 def make_glbl(config, env_code=0, db_xptal=None, db_an=None):
     """ make a glbl dict
 
@@ -92,7 +103,7 @@ def make_glbl(config, env_code=0, db_xptal=None, db_an=None):
     elif int(env_code) == 2:
         # simulation
         base_dir = os.getcwd()
-        db_xptal = db
+        db_xptal = _simulation_db()
     else:
         # beamline
         base_dir = os.path.abspath('/direct/XF28ID1/pe2_data')
@@ -0,0 +1,110 @@
+"""Databroker handlers for the detector files"""
+import os
+
+import numpy as np
+
+from xpdan.cache import LRUCache
+
+# the maps are all counted as one byte, so this bounds the number of maps
+# held open between calls
+open_maps = LRUCache(256)
+
+
+def _read_only(a):
+    a = a.view(np.ndarray)
+    a.flags.writeable = False
+    return a
+
+
+def read_tiff(fn, maps=None):
+    """Read a TIFF, memory mapping its pixels when they are not compressed
+
+    Parameters
+    ----------
+    fn: str
+        The name of the file
+    maps: xpdan.cache.LRUCache, optional
+        The cache of the open maps, defaults to the session wide
+        ``xpdan.handlers.open_maps``
+
+    Returns
+    -------
+    np.ndarray:
+        The read-only image, viewing the map if the file could be mapped
+    """
+    import tifffile
+    if maps is None:
+        maps = open_maps
+    st = os.stat(fn)
+    # a rewritten file is mapped again
+    key = (fn, st.st_mtime, st.st_size)
+    img = maps.get(key)
+    if img is None:
+        try:
+            img = _read_only(tifffile.memmap(fn, mode='r'))
+        except ValueError:
+            # compressed or tiled data, decode it
+            with tifffile.TiffFile(fn) as tif:
+                return _read_only(tif.asarray())
+        maps.put(key, img, 1)
+    return img
+
+
+class MemmapTiffHandler(object):
+    """Read AreaDetector TIFFs as read-only memory maps
+
+    A drop in for ``databroker.assets.handlers.AreaDetectorTiffHandler``.
+    Uncompressed files are memory mapped, so loading a frame does not read
+    or copy the pixels and only the pages which are used become resident.
+    The maps are kept open in a LRU cache, so reprocessing a run reuses
+    them. Compressed files are decoded as usual.
+
+    Parameters
+    ----------
+    fpath: str
+        The folder of the files
+    template: str
+        The template of the file names, formatted with the folder, the file
+        name and the frame number
+    filename: str
+        The file name
+    frame_per_point: int, optional
+        The number of frames per event, defaults to 1
+    maps: xpdan.cache.LRUCache, optional
+        The cache of the open maps, defaults to the session wide
+        ``xpdan.handlers.open_maps``
+
+    Examples
+    --------
+    >>> db.reg.register_handler('AD_TIFF', MemmapTiffHandler)
+    """
+    specs = {'AD_TIFF'}
+
+    def __init__(self, fpath, template, filename, frame_per_point=1,
+                 maps=None):
+        self._path = os.path.join(fpath, '')
+        self._fpp = frame_per_point
+        self._template = template
+        self._filename = filename
+        self._maps = maps
+
+    def _fnames_for_point(self, point_number):
+        start = int(point_number * self._fpp)
+        stop = int((point_number + 1) * self._fpp)
+        for j in range(start, stop):
+            yield self._template % (self._path, self._filename, j)
+
+    def __call__(self, point_number):
+        frames = [read_tiff(fn, self._maps)
+                  for fn in self._fnames_for_point(point_number)]
+        if len(frames) == 1:
+            # a view of the map, without copying the pixels
+            return frames[0].squeeze()
+        return _read_only(np.array(frames).squeeze())
+
+    def get_file_list(self, datum_kwargs):
+        return [fn for d in datum_kwargs
+                for fn in self._fnames_for_point(**d)]
+
+    def close(self):
+        pass
@@ -1,4 +1,6 @@
+import json
 import os
+from functools import wraps
 
 import numpy as np
 import yaml
@@ -38,22 +40,297 @@ ordereditems = '''args configfile configsection dataformat
             rmin rmax rstep plot interact verbose'''.split()
 
 
-def pdf_saver(r, pdf, filename, config):
+# the headers of the .gr files, keyed by the repr of their config
+_pdf_headers = {}
+
+_chi_descriptions = {
+    'Q': """First column represents Q values (Angstroms) and second
+        column represents intensities and if there is a third
+        column it represents the error values of intensities.""",
+    '2theta': """First column represents two theta values (degrees) and
+        second column represents intensities and if there is
+        a third column it represents the error values of intensities."""}
+
+_chi_header = """{out_name}
+        This file contains integrated powder x-ray diffraction
+        intensities.
+        {des}
+        Number of data points in the file : {n_pts}
+        ######################################################
+"""
+
+
+def _savetxt_rows(*columns):
+    """The text ``np.savetxt`` writes for the columns, formatted at once"""
+    data = np.column_stack(columns)
+    row = ' '.join(['%.18e'] * data.shape[1]) + '\n'
+    return (row * len(data)) % tuple(data.ravel().tolist())
+
+
+def _pdf_header(config):
     config_dict = {k: getattr(config, k, '') for k in ordereditems}
-    rpdf = np.vstack((r, pdf))
-    rpdf = rpdf.T
-    pfmt = PartialFormatter()
-    cfmt = CleanFormatter()
-    header = pfmt.format(template_hdr, **config_dict)
-    header = cfmt.format(header, defaultdict(str))
-    np.savetxt(filename, rpdf, header=header)
+    key = repr(config_dict)
+    header = _pdf_headers.get(key)
+    if header is None:
+        pfmt = PartialFormatter()
+        cfmt = CleanFormatter()
+        header = pfmt.format(template_hdr, **config_dict)
+        header = cfmt.format(header, defaultdict(str))
+        if len(_pdf_headers) >= 64:
+            _pdf_headers.clear()
+        _pdf_headers[key] = header
+    return header
+
+
+def _save_npz(filename, header, **arrays):
+    # through a file object so the name is not given a .npz suffix
+    with open(filename, 'wb') as f:
+        np.savez(f, header=header, **arrays)
+
+
+def pdf_saver(r, pdf, filename, config, binary=False):
+    """Save a PDF as a .gr file
+
+    The header is only formatted once per config and the rows are
+    formatted in one call, the file is identical to the one written by
+    ``np.savetxt``.
+
+    Parameters
+    ----------
+    r: np.ndarray
+        The distances
+    pdf: np.ndarray
+        The PDF
+    filename: str
+        The name of the file
+    config: diffpy.pdfgetx.PDFConfig
+        The configuration which made the PDF, written to the header
+    binary: bool, optional
+        If True save a npz file holding the ``r`` and ``pdf`` arrays and
+        the ``header``, defaults to False
+    """
+    header = _pdf_header(config)
+    if binary:
+        _save_npz(filename, header, r=r, pdf=pdf)
+        return
+    with open(filename, 'wb') as f:
+        # np.savetxt writes to the locale's encoding, utf-8 at the beamline
+        f.write(('# ' + header.replace('\n', '\n# ') + '\n').encode(
+            'utf-8'))
+        f.write(_savetxt_rows(r, pdf).encode('latin1'))
+
+
+def chi_saver(tth, intensity, output_name, q_or_2theta, ext='.chi',
+              binary=False):
+    """Save integrated intensities as a .chi file
+
+    A faster drop in for ``skbeam.io.save_powder_output.save_output``,
+    writing the same file.
+
+    Parameters
+    ----------
+    tth: np.ndarray
+        The Q or two theta values
+    intensity: np.ndarray
+        The intensities
+    output_name: str
+        The name of the file, without its extension
+    q_or_2theta: {'Q', '2theta'}
+        Whether ``tth`` holds Q or two theta values
+    ext: str, optional
+        The extension of the file, defaults to '.chi'
+    binary: bool, optional
+        If True save a npz file holding the ``q`` (or ``tth``) and ``iq``
+        arrays and the ``header``, defaults to False
+    """
+    if q_or_2theta not in _chi_descriptions:
+        raise ValueError("q_or_2theta must be 'Q' or '2theta', not "
+                         "{!r}".format(q_or_2theta))
+    if len(tth) != len(intensity):
+        raise ValueError('Number of intensities and the number of Q or two '
+                         'theta values are different')
+    header = _chi_header.format(out_name=output_name, n_pts=len(tth),
+                                des=_chi_descriptions[q_or_2theta])
+    if binary:
+        x = 'q' if q_or_2theta == 'Q' else 'tth'
+        _save_npz(output_name + ext, header, iq=intensity, **{x: tth})
+        return
+    with open(output_name + ext, 'wb') as f:
+        f.write(header.encode('utf-8'))
+        f.write(_savetxt_rows(tth, intensity).encode('latin1'))
+
+
+# the folders known to exist, so each is only created once per session
+made_dirs = set()
+
+
+def makedirs(path):
+    """Create a folder and its parents, if not done before in this session
+
+    On a network file system every ``os.makedirs`` is a round trip to the
+    server, this makes it once per folder.
+
+    Parameters
+    ----------
+    path: str
+        The folder
+    """
+    if path and path not in made_dirs:
+        os.makedirs(path, exist_ok=True)
+        made_dirs.add(path)
+
+
+def makedirs_for(filename):
+    """Create the folder of a file, see ``makedirs``"""
+    makedirs(os.path.dirname(filename))
+
+
+def retry_missing_dir(writer, filename_kwarg):
+    """Make a version of a writer which recreates a deleted folder
+
+    If the write fails as the folder of the file does not exist, eg. it was
+    deleted after ``makedirs`` created it, the folder is forgotten, created
+    again and the write retried once.
+
+    Parameters
+    ----------
+    writer: callable
+        The writer
+    filename_kwarg: str
+        The name of the writer's argument holding the file name, if it is
+        not passed as a keyword argument it must be the first argument
+
+    Returns
+    -------
+    callable:
+        The retrying writer
+    """
+    @wraps(writer)
+    def retrying_writer(*args, **kwargs):
+        try:
+            return writer(*args, **kwargs)
+        except FileNotFoundError:
+            filename = (kwargs[filename_kwarg] if filename_kwarg in kwargs
+                        else args[0])
+            path = os.path.dirname(filename)
+            made_dirs.discard(path)
+            if not path or os.path.isdir(path):
+                raise
+            makedirs(path)
+            return writer(*args, **kwargs)
+    return retrying_writer
 
 
 def dump_yml(filename, data):
-    os.makedirs(os.path.split(filename)[0], exist_ok=True)
+    makedirs_for(filename)
     with open(filename, 'w') as f:
         yaml.dump(data, f)
 
 
 def poni_saver(filename, calibration):
     calibration.geoRef.save(filename)
+
+
+class RunHDF5Writer(object):
+    """Write the reduced data of each run into a single HDF5 file
+
+    The data of every frame is appended to chunked, resizable datasets
+    ``<analysis stage>/<key>``, one chunk per frame, next to the
+    ``seq_num`` and ``time`` of the frames. The metadata of the run is
+    stored as attributes of the file, nested values json encoded. The file
+    is opened at the first frame of a run and closed at its stop document.
+
+    Parameters
+    ----------
+    template: str
+        The template of the file name, formatted with the start document of
+        the run as ``raw_start``
+    compression: str, optional
+        The compression of the datasets, eg. 'gzip' or 'lzf'. Defaults to
+        None, no compression
+
+    Examples
+    --------
+    >>> writer = RunHDF5Writer('/data/{raw_start[sample_name]}{ext}')
+    >>> raw_stream.sink(writer.observe)
+    >>> iq_stream.sink(writer.sink('iq_q'))
+    """
+    stages = {'dark_sub': ['img'], 'mask': ['mask'], 'iq_q': ['q', 'iq'],
+              'iq_tth': ['tth', 'iq'], 'pdf': ['r', 'pdf']}
+
+    def __init__(self, template, compression=None):
+        try:
+            import h5py  # noqa: F401
+        except ImportError:
+            raise ImportError('The HDF5 output requires h5py')
+        self.template = template
+        self.compression = compression
+        self.filename = None
+        self._start = None
+        self._file = None
+
+    def _open(self):
+        import h5py
+        from .formatters import render_and_clean
+        self.filename = render_and_clean(self.template,
+                                         raw_start=self._start, ext='.h5')
+        makedirs_for(self.filename)
+        self._file = retry_missing_dir(h5py.File, 'name')(self.filename, 'w')
+        for k, v in self._start.items():
+            if not isinstance(v, (str, int, float, bool)):
+                v = json.dumps(v, default=repr)
+            self._file.attrs[k] = v
+
+    def _append(self, name, value):
+        value = np.asarray(value)
+        ds = self._file.get(name)
+        if ds is None:
+            ds = self._file.create_dataset(
+                name, shape=(0,) + value.shape, maxshape=(None,) + value.shape,
+                chunks=(1,) + value.shape if value.shape else True,
+                dtype=value.dtype, compression=self.compression)
+        ds.resize(len(ds) + 1, axis=0)
+        ds[-1] = value
+
+    def append(self, stage, event):
+        """Append the data of a frame
+
+        Parameters
+        ----------
+        stage: str
+            The analysis stage of the data
+        event: dict
+            The event holding the data
+        """
+        if self._start is None:
+            return
+        if self._file is None:
+            self._open()
+        for key in self.stages[stage]:
+            self._append('{}/{}'.format(stage, key), event['data'][key])
+        self._append('{}/seq_num'.format(stage), event['seq_num'])
+        self._append('{}/time'.format(stage), event['time'])
+
+    def close(self):
+        """Close the file of the run"""
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+
+    def observe(self, nd):
+        """Follow the raw documents, to open and close the files"""
+        name, doc = nd
+        if name == 'start':
+            self.close()
+            self._start = doc
+        elif name == 'stop':
+            self.close()
+            self._start = None
+
+    def sink(self, stage):
+        """A callback appending the events of an analysis stage"""
+        def append(nd):
+            name, doc = nd
+            if name == 'event':
+                self.append(stage, doc)
+        return append
@@ -0,0 +1,248 @@
+"""Manifests of the files written by the pipelines, to resume reprocessing"""
+import hashlib
+import json
+import os
+import threading
+from functools import wraps
+
+from xpdan.dev_utils import _timestampstr
+from xpdan.formatters import render_and_clean
+from xpdan.io import makedirs
+
+# The files written for every event, as (analysis_stage, ext)
+EVENT_OUTPUTS = [('dark_sub', '.tiff'), ('iq_q', '_Q.chi'),
+                 ('iq_tth', '_tth.chi'), ('pdf', '.gr')]
+# The files written for every event with the binary outputs
+BINARY_EVENT_OUTPUTS = [('dark_sub', '.tiff'), ('iq_q', '_Q.npz'),
+                        ('iq_tth', '_tth.npz'), ('pdf', '_gr.npz')]
+
+
+def file_checksum(path, block_size=2 ** 20):
+    """The sha1 hex digest of a file"""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class OutputManifest(object):
+    """Per run record of the outputs written for each event
+
+    The entries (event uid, stage, path, checksum, size and modification
+    time) are appended, one json document per line, to
+    ``<directory>/<run uid>.jsonl`` as soon as a file is written, so the
+    record survives a crash.
+
+    Parameters
+    ----------
+    directory: str
+        The folder holding the manifests
+    checksums: bool, optional
+        If True record the checksum of every output, so an output whose
+        modification time changed but not its content is still current.
+        This reads every output back, if False an output is current only if
+        its size and modification time are unchanged. Defaults to False
+    """
+
+    def __init__(self, directory, checksums=False):
+        self.directory = directory
+        self.checksums = checksums
+        self._runs = {}
+        self._files = {}
+        self._expected = {}
+        self._lock = threading.Lock()
+
+    def _run(self, run_uid):
+        if run_uid not in self._runs:
+            entries = {}
+            try:
+                with open(self.path(run_uid)) as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            # the last line of a crashed run may be cut
+                            continue
+                        entries[entry['path']] = entry
+            except (IOError, OSError):
+                pass
+            self._runs[run_uid] = entries
+        return self._runs[run_uid]
+
+    def path(self, run_uid):
+        """The path of the manifest of a run"""
+        return os.path.join(self.directory, '{}.jsonl'.format(run_uid))
+
+    def entries(self, run_uid):
+        """The entries of a run, keyed by the path of the output"""
+        with self._lock:
+            return dict(self._run(run_uid))
+
+    def expect(self, run_uid, event_uid, stage, path):
+        """Announce an output, so it is recorded once it is written"""
+        with self._lock:
+            self._expected[path] = (run_uid, event_uid, stage)
+
+    def forget_expected(self):
+        """Forget the announced outputs which were never written"""
+        with self._lock:
+            self._expected.clear()
+
+    def close(self):
+        """Close the manifests and forget their entries
+
+        They are read back from disk if the runs are needed again.
+        """
+        with self._lock:
+            files, self._files = self._files, {}
+            self._runs.clear()
+        for f in files.values():
+            f.close()
+
+    def record(self, path):
+        """Record an output which has been written
+
+        Outputs which have not been announced with ``expect`` are ignored.
+
+        Parameters
+        ----------
+        path: str
+            The path of the output
+        """
+        with self._lock:
+            expected = self._expected.pop(path, None)
+        if expected is None:
+            return
+        run_uid, event_uid, stage = expected
+        st = os.stat(path)
+        entry = dict(event_uid=event_uid, stage=stage, path=path,
+                     checksum=file_checksum(path) if self.checksums else None,
+                     size=st.st_size, mtime=st.st_mtime)
+        line = json.dumps(entry) + '\n'
+        if run_uid not in self._files:
+            makedirs(self.directory)
+        with self._lock:
+            self._run(run_uid)[path] = entry
+            if run_uid not in self._files:
+                # line buffered, so every entry reaches the file
+                self._files[run_uid] = open(self.path(run_uid), 'a',
+                                            buffering=1)
+            self._files[run_uid].write(line)
+
+    def is_current(self, run_uid, path):
+        """Whether an output has been recorded and not changed since
+
+        If the modification time of the file changed, the file is only
+        current if its checksum was recorded and still matches.
+        """
+        with self._lock:
+            entry = self._run(run_uid).get(path)
+        if entry is None:
+            return False
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        if st.st_size != entry['size']:
+            return False
+        if st.st_mtime == entry['mtime']:
+            return True
+        if entry.get('checksum') is None:
+            return False
+        return file_checksum(path) == entry['checksum']
+
+    def recording(self, writer, filename_kwarg):
+        """Make a version of a writer which records what it wrote
+
+        Parameters
+        ----------
+        writer: callable
+            The writer
+        filename_kwarg: str
+            The name of the writer's argument holding the file name
+
+        Returns
+        -------
+        callable:
+            The recording writer
+        """
+        @wraps(writer)
+        def recording_writer(*args, **kwargs):
+            out = writer(*args, **kwargs)
+            self.record(kwargs[filename_kwarg])
+            return out
+        return recording_writer
+
+
+class ResumeFilter(object):
+    """Event filter which tracks the outputs of the events
+
+    Every event has its outputs announced to the manifest. In resume mode
+    the events whose outputs are all current are dropped, so they skip the
+    reduction. The first event of a run is always kept as the mask may be
+    made from it.
+
+    Parameters
+    ----------
+    manifest: OutputManifest
+        The manifest of the outputs
+    template: str
+        The file name template of the pipeline
+    resume: bool, optional
+        If True drop the events which are done, defaults to False
+    binary: bool, optional
+        If True the integrated data and PDFs are written as npz files,
+        defaults to False
+    """
+
+    def __init__(self, manifest, template, resume=False, binary=False):
+        self.manifest = manifest
+        self.template = template
+        self.resume = resume
+        self.event_outputs = BINARY_EVENT_OUTPUTS if binary else EVENT_OUTPUTS
+        self.start = None
+        self.descriptors = {}
+        self.skipped = 0
+
+    def observe(self, nd):
+        """Keep track of the run's start and descriptors"""
+        name, doc = nd
+        if name == 'start':
+            # the writes of the last run have been flushed at its stop
+            self.manifest.forget_expected()
+            self.manifest.close()
+            self.start = doc
+            self.descriptors = {}
+        elif name == 'descriptor':
+            self.descriptors[doc['uid']] = doc
+        elif name == 'stop' and self.skipped:
+            print('skipped {} reduced events of {}'.format(
+                self.skipped, self.start['uid'][:6]))
+            self.skipped = 0
+
+    def outputs(self, event):
+        """The paths of the outputs of an event, keyed by stage"""
+        return {stage: render_and_clean(
+            self.template,
+            human_timestamp=_timestampstr(event['time']),
+            raw_event=event,
+            raw_start=self.start,
+            raw_descriptor=self.descriptors.get(event['descriptor'], {}),
+            analyzed_start={'analysis_stage': stage},
+            ext=ext) for stage, ext in self.event_outputs}
+
+    def __call__(self, docs):
+        event = docs[0]
+        if self.start.get('dark_frame'):
+            return True
+        run_uid = self.start['uid']
+        outputs = self.outputs(event)
+        if (self.resume and event['seq_num'] != 1 and
+                all(self.manifest.is_current(run_uid, path)
+                    for path in outputs.values())):
+            self.skipped += 1
+            return False
+        for stage, path in outputs.items():
+            self.manifest.expect(run_uid, event['uid'], stage, path)
+        return True
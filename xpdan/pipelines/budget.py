@@ -0,0 +1,251 @@
+"""Bounds on the documents buffered by the joins of the pipelines"""
+import threading
+import warnings
+import weakref
+from collections import deque
+
+from xpdan.pipelines.executor import ExecutorStage
+from xpdan.pipelines.instrumentation import (walk_graph, node_label,
+                                             _held_arrays, _owner)
+
+
+def _upstream(node):
+    # older streamz keeps the upstream nodes in ``children``
+    up = getattr(node, 'upstreams', None)
+    if up is None:
+        up = getattr(node, 'children', [])
+    return [n for n in up if n is not None]
+
+
+def _buffers(node):
+    """The deques a node buffers documents in"""
+    for attr in vars(node).values():
+        if isinstance(attr, deque):
+            yield attr
+        elif isinstance(attr, (list, tuple, dict)):
+            for v in (attr.values() if isinstance(attr, dict) else attr):
+                if isinstance(v, deque):
+                    yield v
+
+
+def _input_buffers(node, who):
+    """The buffers a document from ``who`` will be held in, if any"""
+    buffers = getattr(node, 'buffers', None)
+    ups = _upstream(node)
+    if isinstance(buffers, dict):
+        pairs = list(buffers.items())
+    elif isinstance(buffers, (list, tuple)) and len(buffers) == len(ups):
+        pairs = list(zip(ups, buffers))
+    else:
+        # zip_latest only buffers its first, lossless, input
+        if ups and who is not ups[0]:
+            return []
+        return list(_buffers(node))
+    if all(buf for up, buf in pairs if up is not who):
+        # completes a tuple
+        return []
+    return [buf for up, buf in pairs if up is who]
+
+
+def _is_event(item):
+    # newer streamz buffers (x, metadata) pairs
+    if (isinstance(item, tuple) and len(item) == 2 and
+            isinstance(item[0], tuple)):
+        item = item[0]
+    return (isinstance(item, tuple) and len(item) == 2 and
+            item[0] == 'event')
+
+
+class JoinBudget(object):
+    """Bound the documents buffered by the joins of a pipeline
+
+    ``zip`` and ``zip_latest`` nodes buffer whole documents, images
+    included, until their other inputs catch up, so a stalled branch
+    makes them grow without bound. Before each document enters a join the
+    buffers are checked against the budget. Once over it the ``'block'``
+    policy waits for other threads to drain the joins, raising a
+    ``RuntimeError`` naming the join and its stalled inputs after
+    ``timeout`` seconds, or at once if no other thread feeds the joins.
+    Documents which complete a tuple, draining the join, are always let
+    in. The ``'drop'`` policy drops the oldest buffered events of
+    the ``zip_latest`` joins (the frames waiting on the latest value of a
+    slow branch), warning once per join. Strict ``zip`` joins pair their
+    inputs one to one, they are never dropped from and always block.
+
+    Parameters
+    ----------
+    source: Stream
+        The source of the pipeline, the graph must be fully built
+    max_bytes: int, optional
+        The bytes of arrays all the joins may buffer together, if None do
+        not bound the bytes. Defaults to None
+    max_buffered: int, optional
+        The number of documents each buffer of a join may hold, if None do
+        not bound the number of documents. Defaults to None
+    policy: {'block', 'drop'}, optional
+        What to do once over the budget, defaults to 'block'
+    timeout: float, optional
+        Seconds to wait for the joins to drain under the 'block' policy,
+        defaults to 30
+
+    Examples
+    --------
+    >>> source = conf_main_pipeline(db, save_dir, max_buffered=16)
+    >>> print(source.join_budget.summary())
+    """
+
+    def __init__(self, source, max_bytes=None, max_buffered=None,
+                 policy='block', timeout=30.):
+        if policy not in ('block', 'drop'):
+            raise ValueError("policy must be 'block' or 'drop', not "
+                             "{!r}".format(policy))
+        self.max_bytes = max_bytes
+        self.max_buffered = max_buffered
+        self.policy = policy
+        self.timeout = timeout
+        self.labels = {}
+        self.joins = []
+        self._feeders = weakref.WeakSet()
+        for i, node in enumerate(walk_graph(source)):
+            self.labels[id(node)] = node_label(node, i)
+            if isinstance(node, ExecutorStage):
+                self._feeders.add(node._thread)
+            if len(_upstream(node)) > 1 and any(True for _ in
+                                                _buffers(node)):
+                self.joins.append(node)
+        self.peak_buffered = {self.labels[id(n)]: 0 for n in self.joins}
+        self.peak_bytes = {self.labels[id(n)]: 0 for n in self.joins}
+        self.dropped = {self.labels[id(n)]: 0 for n in self.joins}
+        self._warned = set()
+        self._condition = threading.Condition()
+        for node in self.joins:
+            self._wrap(node)
+
+    def _wrap(self, node):
+        update = node.update
+
+        def bounded_update(x, *args, **kwargs):
+            self._feeders.add(threading.current_thread())
+            who = kwargs.get('who', args[0] if args else None)
+            self._admit(node, _input_buffers(node, who))
+            try:
+                return update(x, *args, **kwargs)
+            finally:
+                with self._condition:
+                    self._condition.notify_all()
+
+        node.update = bounded_update
+
+    def _over(self, buffers):
+        """The reason the joins are over the budget, None if they are not"""
+        if not buffers:
+            return None
+        if self.max_buffered is not None:
+            n = max(len(b) for b in buffers)
+            if n >= self.max_buffered:
+                return '{} documents buffered'.format(n)
+        if self.max_bytes is not None:
+            total = sum(self.measure().values())
+            if total >= self.max_bytes:
+                return '{:.1f} MiB buffered by the joins'.format(
+                    total / 2 ** 20)
+
+    def _admit(self, node, buffers):
+        reason = self._over(buffers)
+        if reason is None:
+            return
+        if self.policy == 'drop' and self._drop(node):
+            reason = self._over(buffers)
+            if reason is None:
+                return
+        me = threading.current_thread()
+        # only other threads feeding the joins can drain them
+        if any(t is not me and t.is_alive() for t in list(self._feeders)):
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self._over(buffers) is None, self.timeout)
+            reason = self._over(buffers)
+        if reason is not None:
+            raise RuntimeError(self._diagnose(node, reason))
+
+    def _drop(self, node):
+        """Drop the oldest buffered events of the zip_latest joins"""
+        import shed.event_streams as es
+        targets = [node] if self.max_bytes is None else self.joins
+        dropped = False
+        for target in targets:
+            if not isinstance(target, es.zip_latest):
+                continue
+            label = self.labels[id(target)]
+            for buf in _buffers(target):
+                events = [item for item in buf if _is_event(item)]
+                # drop the older half, keeping the latest frames
+                for item in events[:max(len(events) // 2, 1)]:
+                    buf.remove(item)
+                    self.dropped[label] += 1
+                    dropped = True
+            if self.dropped[label] and label not in self._warned:
+                self._warned.add(label)
+                warnings.warn('{!r} is over its buffer budget, dropping '
+                              'events'.format(label), ResourceWarning)
+        return dropped
+
+    def _diagnose(self, node, reason):
+        label = self.labels[id(node)]
+        msg = '{!r} is over its buffer budget ({})'.format(label, reason)
+        buffers = getattr(node, 'buffers', None)
+        if isinstance(buffers, dict):
+            pairs = list(buffers.items())
+        elif isinstance(buffers, (list, tuple)):
+            pairs = list(zip(_upstream(node), buffers))
+        else:
+            pairs = []
+        stalled = [self.labels.get(id(up), repr(up)) for up, buf in pairs
+                   if not buf]
+        if stalled and len(stalled) < len(pairs):
+            msg += ', waiting on {}'.format(', '.join(map(repr, stalled)))
+        worst = max(self.measure().items(), key=lambda x: x[1],
+                    default=None)
+        if worst and worst[1]:
+            msg += ', {!r} holds {:.1f} MiB'.format(worst[0],
+                                                    worst[1] / 2 ** 20)
+        return msg
+
+    def measure(self):
+        """Count the documents and bytes buffered by each join
+
+        Returns
+        -------
+        dict:
+            Maps the join names to the bytes of the arrays they buffer
+        """
+        out = {}
+        for node in self.joins:
+            label = self.labels[id(node)]
+            seen = set()
+            nbytes = 0
+            n = 0
+            for buf in _buffers(node):
+                n = max(n, len(buf))
+                for a in _held_arrays(list(buf), depth=8):
+                    a = _owner(a)
+                    if id(a) not in seen:
+                        seen.add(id(a))
+                        nbytes += a.nbytes
+            out[label] = nbytes
+            self.peak_bytes[label] = max(self.peak_bytes[label], nbytes)
+            self.peak_buffered[label] = max(self.peak_buffered[label], n)
+        return out
+
+    def summary(self):
+        """Table of the buffers of the joins, largest first"""
+        current = self.measure()
+        lines = ['{:<40} {:>12} {:>10} {:>10} {:>8}'.format(
+            'join', 'now (MiB)', 'peak MiB', 'peak docs', 'dropped')]
+        for label, nbytes in sorted(current.items(), key=lambda x: -x[1]):
+            lines.append('{:<40.40} {:>12.1f} {:>10.1f} {:>10d} '
+                         '{:>8d}'.format(label, nbytes / 2 ** 20,
+                                         self.peak_bytes[label] / 2 ** 20,
+                                         self.peak_buffered[label],
+                                         self.dropped[label]))
+        return '\n'.join(lines)
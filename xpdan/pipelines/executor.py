@@ -0,0 +1,260 @@
+"""Executor backed stages for the pipelines"""
+import os
+import threading
+import traceback
+import weakref
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import wraps
+from queue import Queue, Full
+
+from streamz import Stream
+
+_stages = weakref.WeakSet()
+_STOP = object()
+
+
+class ExecutorStage(Stream):
+    """Run everything downstream of this node on a worker thread
+
+    Documents are queued in the order they arrive and a single worker
+    thread emits them, so the downstream nodes see exactly the same
+    documents in the same order, keeping ``zip`` and ``zip_latest``
+    semantics. The upstream only waits for the document to be queued, so
+    it can receive the next frame while the previous one is reduced. When
+    ``max_in_flight`` documents are queued the upstream blocks, bounding
+    the memory held by the queue.
+
+    Parameters
+    ----------
+    child: Stream
+        The upstream node
+    max_in_flight: int, optional
+        The maximum number of queued documents, defaults to 8
+    stream_name: str, optional
+        The name of the node
+
+    Notes
+    -----
+    The whole subgraph below the stage runs on the worker thread, so a
+    stage should only be inserted where nothing downstream joins with a
+    node fed from the calling thread. Process pools are not offered as the
+    nodes keep state (joins, accumulators) which can not cross a process
+    boundary.
+    """
+
+    def __init__(self, child, max_in_flight=8, stream_name=None):
+        Stream.__init__(self, child, stream_name=stream_name)
+        self.queue = Queue(maxsize=max_in_flight)
+        self.errors = []
+        # the thread only holds a weak reference, so a dropped pipeline is
+        # collected and its thread stopped
+        self._thread = threading.Thread(
+            target=_work, args=(weakref.ref(self), self.queue), daemon=True)
+        self._thread.start()
+        weakref.finalize(self, _stop_worker, self.queue)
+        _stages.add(self)
+
+    def update(self, x, who=None):
+        if self.errors:
+            self._raise()
+        self.queue.put(x)
+
+    def _process(self, x):
+        try:
+            self.emit(x)
+        except Exception as e:
+            traceback.print_exc()
+            self.errors.append(e)
+
+    def _raise(self):
+        errors, self.errors = self.errors, []
+        name = getattr(self, 'stream_name', None) or 'Executor stage'
+        raise RuntimeError('{} failed on {} document(s)'.format(
+            name, len(errors))) from errors[0]
+
+    def flush(self):
+        """Wait until all the queued documents have been processed
+
+        Raises
+        ------
+        RuntimeError:
+            If processing any of the documents failed
+        """
+        self.queue.join()
+        if self.errors:
+            self._raise()
+
+    def close(self):
+        """Process the queued documents and stop the worker thread"""
+        if self._thread.is_alive():
+            self.queue.put(_STOP)
+            self._thread.join()
+        _stages.discard(self)
+
+
+def _work(stage_ref, queue):
+    while True:
+        x = queue.get()
+        try:
+            stage = stage_ref()
+            if x is _STOP or stage is None:
+                return
+            stage._process(x)
+            del stage
+        finally:
+            queue.task_done()
+
+
+def _stop_worker(queue):
+    try:
+        queue.put_nowait(_STOP)
+    except Full:
+        # the worker is busy, it stops once it finds the stage gone
+        pass
+
+
+def flush_stages():
+    """Wait until every executor stage has processed its documents"""
+    for stage in list(_stages):
+        stage.flush()
+
+
+def close_stages(source):
+    """Stop the worker thread of a pipeline's executor stage, if it has one
+
+    Parameters
+    ----------
+    source: Stream
+        The source of the pipeline
+    """
+    stage = getattr(source, 'executor_stage', None)
+    if stage is not None:
+        stage.close()
+
+
+class WriterPool(object):
+    """Run file writers on a dedicated thread pool
+
+    Writer jobs are submitted from the graph and return immediately, so a
+    slow file system does not stall the reduction. Once ``max_queued``
+    jobs are pending the submitting node blocks, bounding the memory held
+    by the queued data.
+
+    Parameters
+    ----------
+    n_workers: int, optional
+        The number of writer threads, defaults to 2
+    max_queued: int, optional
+        The maximum number of pending jobs, defaults to 16
+
+    Examples
+    --------
+    >>> pool = WriterPool()
+    >>> save = pool.writer(tifffile.imsave)
+    >>> save('a.tiff', img)  # returns immediately
+    >>> pool.wait()  # raises if any write failed
+    """
+
+    def __init__(self, n_workers=2, max_queued=16):
+        self.n_workers = n_workers
+        self.max_queued = max_queued
+        self._start()
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._executor = ThreadPoolExecutor(self.n_workers)
+        self._slots = threading.BoundedSemaphore(self.max_queued)
+        self._lock = threading.Lock()
+        self._futures = set()
+        self.errors = []
+        self._n_reported = 0
+
+    def submit(self, writer, *args, **kwargs):
+        """Queue a writer job
+
+        Parameters
+        ----------
+        writer: callable
+            The writer
+        args, kwargs:
+            Passed to the writer
+
+        Returns
+        -------
+        concurrent.futures.Future:
+            The future of the job
+        """
+        if os.getpid() != self._pid:
+            # the threads do not survive a fork, eg. into a reprocessing
+            # worker, so start over with a fresh pool
+            self._start()
+        self._slots.acquire()
+        future = self._executor.submit(writer, *args, **kwargs)
+        future.writer = writer
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self._futures.discard(future)
+            if future.exception() is not None:
+                self.errors.append((future.writer, future.exception()))
+        self._slots.release()
+
+    def writer(self, func):
+        """Make a version of a writer which queues its calls"""
+        @wraps(func)
+        def queued_writer(*args, **kwargs):
+            self.submit(func, *args, **kwargs)
+        return queued_writer
+
+    def flush(self):
+        """Wait for the pending jobs and report the new failures
+
+        Returns
+        -------
+        list of tuple:
+            The (writer, exception) pairs of the failures not reported yet
+        """
+        with self._lock:
+            futures = list(self._futures)
+        wait(futures)
+        with self._lock:
+            new = self.errors[self._n_reported:]
+            self._n_reported = len(self.errors)
+        for writer, e in new:
+            print('{} failed: {!r}'.format(
+                getattr(writer, '__name__', writer), e))
+        return new
+
+    def wait(self):
+        """Wait for the pending jobs, raising if any job failed
+
+        Raises
+        ------
+        RuntimeError:
+            If any of the jobs failed since the last wait
+        """
+        self.flush()
+        with self._lock:
+            errors, self.errors = self.errors, []
+            self._n_reported = 0
+        if errors:
+            raise RuntimeError('{} file write(s) failed'.format(
+                len(errors))) from errors[0][1]
+
+
+writer_pool = WriterPool()
+
+
+def wait_for_writes():
+    """Wait until all the queued file writes are done
+
+    Raises
+    ------
+    RuntimeError:
+        If any of the writes failed
+    """
+    writer_pool.wait()
@@ -0,0 +1,468 @@
+"""Instrumentation of the streamz graphs built by the pipelines"""
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+import warnings
+from collections import deque
+
+import numpy as np
+from streamz import Stream
+
+
+def _downstream(node):
+    # older streamz keeps the downstream nodes in ``parents``
+    down = getattr(node, 'downstreams', None)
+    if down is None:
+        down = getattr(node, 'parents', [])
+    return [n for n in down if n is not None]
+
+
+def walk_graph(source):
+    """All the nodes downstream of (and including) a source
+
+    Parameters
+    ----------
+    source: Stream
+        The source of the graph
+
+    Returns
+    -------
+    list of Stream:
+        The nodes, in the order they are first reached
+    """
+    seen = set()
+    nodes = []
+    stack = [source]
+    while stack:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        nodes.append(node)
+        stack.extend(reversed(_downstream(node)))
+    return nodes
+
+
+def node_label(node, i):
+    """The name the statistics of a node are reported under"""
+    name = getattr(node, 'stream_name', None) or getattr(node, 'name', None)
+    if name:
+        return name
+    return '{} {}'.format(type(node).__name__, i)
+
+
+def array_nbytes(x):
+    """Number of bytes in the arrays of a (name, doc) pair or a value"""
+    if isinstance(x, np.ndarray):
+        return x.nbytes
+    if isinstance(x, tuple) and len(x) == 2 and isinstance(x[1], dict):
+        data = x[1].get('data', {})
+        if isinstance(data, dict):
+            return sum(array_nbytes(v) for v in data.values())
+        return 0
+    if isinstance(x, (tuple, list)):
+        return sum(array_nbytes(v) for v in x)
+    return 0
+
+
+class PipelineProfiler(object):
+    """Time every node of a pipeline
+
+    The ``update`` of every node is wrapped to record the number of calls
+    and the node's own wall time, excluding the time spent in the nodes
+    downstream of it. The bytes of the arrays each node emits are counted.
+    The statistics are aggregated by the ``stream_name`` of the nodes.
+
+    Parameters
+    ----------
+    source: Stream
+        The source of the pipeline, the graph must be fully built
+    report: bool, optional
+        If True print the summary when the stop document has gone through
+        the pipeline, defaults to True
+
+    Examples
+    --------
+    >>> source = conf_main_pipeline(db, save_dir, profile=True)
+    >>> for nd in hdr.documents(fill=True):
+    ...     source.emit(nd)
+    >>> source.profiler.stats()['Integrate']['mean']
+    0.0213
+    """
+
+    def __init__(self, source, report=True):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.labels = []
+        self._times = {}
+        self._bytes = {}
+        for i, node in enumerate(walk_graph(source)):
+            label = node_label(node, i)
+            self.labels.append(label)
+            self._times.setdefault(label, [])
+            self._bytes.setdefault(label, 0)
+            self._wrap(node, label)
+        if report:
+            # added after wrapping so the report itself is not profiled
+            source.sink(self._report)
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _wrap(self, node, label):
+        update = node.update
+        emit = node.emit
+
+        def profiled_update(*args, **kwargs):
+            stack = self._stack()
+            # the time of the downstream nodes is added to the frame
+            frame = [0.]
+            stack.append(frame)
+            t0 = time.perf_counter()
+            try:
+                return update(*args, **kwargs)
+            finally:
+                dt = time.perf_counter() - t0
+                stack.pop()
+                if stack:
+                    stack[-1][0] += dt
+                with self._lock:
+                    self._times[label].append(dt - frame[0])
+
+        def profiled_emit(x, *args, **kwargs):
+            nbytes = array_nbytes(x)
+            with self._lock:
+                self._bytes[label] += nbytes
+            return emit(x, *args, **kwargs)
+
+        node.update = profiled_update
+        node.emit = profiled_emit
+
+    def _report(self, nd):
+        if nd[0] == 'stop':
+            print(self.summary())
+
+    def stats(self):
+        """The statistics of the nodes
+
+        Returns
+        -------
+        dict:
+            Maps the node names to dicts of the number of ``calls``, the
+            ``total``, ``mean`` and ``p95`` self time, in seconds, and the
+            ``out_bytes`` of the arrays emitted
+        """
+        with self._lock:
+            times = {k: list(v) for k, v in self._times.items()}
+            out_bytes = dict(self._bytes)
+        stats = {}
+        for label, t in times.items():
+            t = np.asarray(t)
+            stats[label] = dict(
+                calls=len(t), total=t.sum(),
+                mean=t.mean() if len(t) else 0.,
+                p95=np.percentile(t, 95) if len(t) else 0.,
+                out_bytes=out_bytes[label])
+        return stats
+
+    def summary(self):
+        """Table of the node statistics, slowest node first"""
+        stats = self.stats()
+        lines = ['{:<40} {:>7} {:>10} {:>10} {:>10} {:>12}'.format(
+            'node', 'calls', 'total (s)', 'mean (ms)', 'p95 (ms)',
+            'out (MiB)')]
+        for label, s in sorted(stats.items(), key=lambda x: -x[1]['total']):
+            lines.append('{:<40.40} {:>7d} {:>10.3f} {:>10.3f} {:>10.3f} '
+                         '{:>12.1f}'.format(label, s['calls'], s['total'],
+                                            s['mean'] * 1e3, s['p95'] * 1e3,
+                                            s['out_bytes'] / 2 ** 20))
+        return '\n'.join(lines)
+
+    def reset(self):
+        """Forget the recorded statistics"""
+        with self._lock:
+            for label in self._times:
+                self._times[label] = []
+                self._bytes[label] = 0
+
+
+def _held_arrays(x, depth=6):
+    """The arrays held by a node attribute, not crossing into other nodes"""
+    if isinstance(x, np.ndarray):
+        yield x
+    elif depth and not isinstance(x, Stream):
+        if isinstance(x, dict):
+            x = x.values()
+        if isinstance(x, (list, tuple, deque, set, type({}.values()))):
+            for v in x:
+                yield from _held_arrays(v, depth - 1)
+
+
+def _owner(a):
+    """The array owning the memory viewed by an array"""
+    while isinstance(a.base, np.ndarray):
+        a = a.base
+    return a
+
+
+def current_rss():
+    """The resident set size of the process in bytes
+
+    Falls back to the peak resident set size where the current one is not
+    available
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError, IndexError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kB on linux, bytes on mac
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class MemoryProfiler(object):
+    """Account for the memory held by every node of a pipeline
+
+    After each document the arrays retained by the nodes (eg. the buffers
+    of ``zip`` and ``zip_latest`` or the state of accumulators) are
+    counted, each array only once for the first node holding it. The
+    resident set size is sampled to track its peak over the run.
+
+    Parameters
+    ----------
+    source: Stream
+        The source of the pipeline, the graph must be fully built
+    budget: int, optional
+        Number of bytes of retained arrays above which a warning is issued,
+        once per run. If None never warn. Defaults to None
+    trace_allocations: bool, optional
+        If True also record the net bytes allocated by each node call, this
+        uses ``tracemalloc`` which slows the pipeline down. Defaults to
+        False
+    report: bool, optional
+        If True print the summary when the stop document has gone through
+        the pipeline, defaults to True
+    """
+
+    def __init__(self, source, budget=None, trace_allocations=False,
+                 report=True):
+        self.budget = budget
+        self.trace_allocations = trace_allocations
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.nodes = []
+        self.retained = {}
+        self.allocated = {}
+        self.peak_retained = 0
+        self.peak_rss = 0
+        self._warned = False
+        if trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        for i, node in enumerate(walk_graph(source)):
+            label = node_label(node, i)
+            self.nodes.append((label, node))
+            self.retained[label] = 0
+            self.allocated[label] = []
+            self._wrap(node, label)
+        source.sink(self._on_document)
+        self.report = report
+
+    def _wrap(self, node, label):
+        update = node.update
+
+        def accounted_update(*args, **kwargs):
+            if not self.trace_allocations:
+                return update(*args, **kwargs)
+            stack = getattr(self._local, 'stack', None)
+            if stack is None:
+                stack = self._local.stack = []
+            frame = [0]
+            stack.append(frame)
+            m0 = tracemalloc.get_traced_memory()[0]
+            try:
+                return update(*args, **kwargs)
+            finally:
+                dm = tracemalloc.get_traced_memory()[0] - m0
+                stack.pop()
+                if stack:
+                    stack[-1][0] += dm
+                with self._lock:
+                    self.allocated[label].append(dm - frame[0])
+
+        node.update = accounted_update
+
+    def measure(self):
+        """Count the bytes of the arrays retained by each node
+
+        Returns
+        -------
+        dict:
+            Maps the node names to the bytes of the arrays they retain
+        """
+        seen = set()
+        retained = dict.fromkeys(self.retained, 0)
+        for label, node in self.nodes:
+            for attr in vars(node).values():
+                for a in _held_arrays(attr):
+                    # a view keeps all of its base alive, count it once
+                    a = _owner(a)
+                    if id(a) not in seen:
+                        seen.add(id(a))
+                        retained[label] += a.nbytes
+        self.retained = retained
+        return retained
+
+    def _on_document(self, nd):
+        name = nd[0]
+        if name == 'start':
+            self.peak_retained = 0
+            self.peak_rss = 0
+            self._warned = False
+        total = sum(self.measure().values())
+        self.peak_retained = max(self.peak_retained, total)
+        self.peak_rss = max(self.peak_rss, current_rss())
+        if (self.budget is not None and total > self.budget and
+                not self._warned):
+            self._warned = True
+            worst = max(self.retained, key=self.retained.get)
+            warnings.warn('The pipeline retains {:.1f} MiB of arrays, over '
+                          'the {:.1f} MiB budget, {!r} holds {:.1f} MiB'
+                          ''.format(total / 2 ** 20, self.budget / 2 ** 20,
+                                    worst, self.retained[worst] / 2 ** 20),
+                          ResourceWarning)
+        if name == 'stop' and self.report:
+            print(self.summary())
+
+    def stats(self):
+        """The memory statistics of the nodes
+
+        Returns
+        -------
+        dict:
+            Maps the node names to dicts of the currently ``retained`` bytes
+            and, if allocations are traced, the ``calls`` and the ``mean``
+            and ``max`` net bytes allocated per call
+        """
+        stats = {}
+        with self._lock:
+            for label, retained in self.retained.items():
+                alloc = np.asarray(self.allocated[label])
+                stats[label] = dict(
+                    retained=retained, calls=len(alloc),
+                    mean=alloc.mean() if len(alloc) else 0.,
+                    max=alloc.max() if len(alloc) else 0)
+        return stats
+
+    def summary(self):
+        """Table of the node memory, largest retainer first"""
+        stats = self.stats()
+        lines = ['peak retained arrays {:.1f} MiB, peak RSS {:.1f} '
+                 'MiB'.format(self.peak_retained / 2 ** 20,
+                              self.peak_rss / 2 ** 20),
+                 '{:<40} {:>14} {:>12} {:>12}'.format(
+                     'node', 'retained (MiB)', 'mean alloc', 'max alloc')]
+        for label, s in sorted(stats.items(),
+                               key=lambda x: -x[1]['retained']):
+            if not (s['retained'] or s['calls']):
+                continue
+            lines.append('{:<40.40} {:>14.1f} {:>12.1f} {:>12.1f}'.format(
+                label, s['retained'] / 2 ** 20, s['mean'] / 2 ** 20,
+                s['max'] / 2 ** 20))
+        return '\n'.join(lines)
+
+
+def _event_arrays(x):
+    """The arrays in the data of the events of a (name, doc) pair"""
+    if (isinstance(x, tuple) and len(x) == 2 and x[0] == 'event' and
+            isinstance(x[1], dict)):
+        data = x[1].get('data', {})
+        if isinstance(data, dict):
+            for v in data.values():
+                if isinstance(v, np.ndarray):
+                    yield v
+    elif isinstance(x, (tuple, list)):
+        for v in x:
+            yield from _event_arrays(v)
+
+
+class ReadOnlyArrays(object):
+    """Make the arrays in the events of a pipeline read-only
+
+    The arrays every node emits are marked read-only, without copying, so
+    the same image can be handed to all the branches of a fan-out. A stage
+    which writes into its input fails loudly instead of corrupting the
+    other branches, and has to copy explicitly.
+
+    In audit mode every array a node emits is checked against the arrays
+    it was given. An output with the same shape and values as an input,
+    but in new memory, is a copy of the frame and is counted against the
+    node. This compares the arrays, so it is only meant for debugging.
+
+    Parameters
+    ----------
+    source: Stream
+        The source of the pipeline, the graph must be fully built
+    audit: bool, optional
+        If True count the frames copied by every node and print the nodes
+        which copied any when the stop document has gone through the
+        pipeline. Defaults to False
+    """
+
+    def __init__(self, source, audit=False):
+        self.audit = audit
+        self._local = threading.local()
+        self.copies = {}
+        for i, node in enumerate(walk_graph(source)):
+            self._wrap(node, node_label(node, i))
+        if audit:
+            source.sink(self._report)
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _wrap(self, node, label):
+        update = node.update
+        # newer streamz nodes emit their results through ``_emit``
+        emit_name = '_emit' if hasattr(node, '_emit') else 'emit'
+        emit = getattr(node, emit_name)
+
+        def audited_update(x, *args, **kwargs):
+            stack = self._stack()
+            stack.append(list(_event_arrays(x)))
+            try:
+                return update(x, *args, **kwargs)
+            finally:
+                stack.pop()
+
+        def readonly_emit(x, *args, **kwargs):
+            stack = self._stack() if self.audit else None
+            for a in _event_arrays(x):
+                if stack and self._is_copy(a, stack[-1]):
+                    self.copies[label] = self.copies.get(label, 0) + 1
+                a.flags.writeable = False
+            return emit(x, *args, **kwargs)
+
+        if self.audit:
+            node.update = audited_update
+        setattr(node, emit_name, readonly_emit)
+
+    @staticmethod
+    def _is_copy(a, inputs):
+        for b in inputs:
+            if (a is not b and a.shape == b.shape and a.dtype == b.dtype and
+                    not np.shares_memory(a, b) and np.array_equal(a, b)):
+                return True
+        return False
+
+    def _report(self, nd):
+        if nd[0] == 'stop' and self.copies:
+            print('\n'.join('{} copied {} frame(s)'.format(label, n)
+                            for label, n in sorted(self.copies.items())))
@@ -1,29 +1,33 @@
 """Main XPD analysis pipeline"""
 import os
-from operator import sub, truediv
+from functools import partial
+from operator import sub
 from pprint import pprint
 
 import numpy as np
 import shed.event_streams as es
-import tifffile
 from shed.event_streams import dstar, star
-
-from bluesky.callbacks.broker import LiveImage
-from skbeam.core.utils import q_to_twotheta
-from skbeam.io.fit2d import fit2d_save
-from skbeam.io.save_powder_output import save_output
 from streamz import Stream
-from xpdan.db_utils import query_dark, temporal_prox, query_background
+from xpdan.cache import CachedBroker, dark_cache as session_dark_cache
+from xpdan.db_utils import (query_dark, temporal_prox, LazyFiller,
+                            query_nearest_background, average_background)
 from xpdan.dev_utils import _timestampstr
-from xpdan.formatters import render_and_clean
-from xpdan.io import pdf_saver, dump_yml, poni_saver
+from xpdan.formatters import compile_template
+from xpdan.io import (pdf_saver, chi_saver, dump_yml, poni_saver,
+                      RunHDF5Writer, makedirs_for, retry_missing_dir)
+from xpdan.manifest import OutputManifest, ResumeFilter
+from xpdan.pipelines.budget import JoinBudget
+from xpdan.pipelines.executor import (ExecutorStage, WriterPool,
+                                      writer_pool as session_writer_pool)
+from xpdan.pipelines.instrumentation import (PipelineProfiler,
+                                             ReadOnlyArrays,
+                                             MemoryProfiler)
 from xpdan.pipelines.pipeline_utils import (if_dark, if_query_results,
-                                            if_calibration, if_not_calibration)
-from xpdan.tools import (pull_array, event_count,
-                         integrate, generate_binner, load_geo,
-                         polarization_correction, mask_img, add_img,
+                                            if_calibration, if_not_calibration,
+                                            LatestOnly)
+from xpdan.tools import (integrate, generate_binner, load_geo,
+                         polarization_correction, mask_img,
                          pdf_getter, fq_getter, decompress_mask)
-from xpdview.callbacks import LiveWaterfall
 from ..calib import img_calibration
 
 base_template = (''
@@ -48,6 +52,28 @@ def conf_main_pipeline(db, save_dir, *, write_to_disk=False, vis=True,
                        mask_setting='default',
                        mask_kwargs=None,
                        pdf_config=None,
+                       dark_cache=None,
+                       bg_cache=None,
+                       bg_stack_method='mean',
+                       executor_stages=False,
+                       max_in_flight=8,
+                       async_writes=True,
+                       writer_pool=None,
+                       profile=False,
+                       profile_memory=False,
+                       memory_budget=None,
+                       stage_cache=None,
+                       vis_max_rate=10.,
+                       resume=False,
+                       manifest_checksums=False,
+                       buffer_budget=None,
+                       max_buffered=None,
+                       buffer_policy='block',
+                       buffer_timeout=30.,
+                       readonly_arrays=True,
+                       audit_copies=False,
+                       output_format='files',
+                       binary_outputs=False,
                        verbose=False):
     """Total data processing pipeline for XPD
 
@@ -79,6 +105,101 @@ def conf_main_pipeline(db, save_dir, *, write_to_disk=False, vis=True,
     pdf_config: dict, optional
         Configuration for making PDFs, see pdfgetx3 docs. Defaults to
         ``dict(dataformat='QA', qmaxinst=28, qmax=22)``
+    dark_cache: xpdan.cache.RunCache, optional
+        Cache for the filled dark runs, defaults to the session wide
+        ``xpdan.cache.dark_cache`` which is shared between pipelines
+    bg_cache: xpdan.cache.LRUCache, optional
+        Cache for the averaged backgrounds, defaults to the session wide
+        ``xpdan.cache.background_cache`` which is shared between pipelines
+    bg_stack_method: {'mean', 'sigma_clip', 'median'}, optional
+        How to combine the background frames, the robust methods keep a
+        cosmic ray in a single frame out of the background. Defaults to
+        'mean'
+    executor_stages: bool, optional
+        If True fill and reduce the documents on a worker thread, so the
+        caller can receive the next frame while the last one is reduced.
+        Only used if ``vis`` is False, as matplotlib has to draw from the
+        main thread. Use ``xpdan.pipelines.executor.flush_stages`` to wait
+        for the reduction to finish and ``close_stages`` to stop the
+        thread. Defaults to False
+    max_in_flight: int, optional
+        The maximum number of documents waiting for the worker thread
+        before the caller blocks, defaults to 8
+    async_writes: bool, optional
+        If True the files are written by ``xpdan.pipelines.executor``'s
+        writer pool, so the reduction does not wait on the file system.
+        The pending writes are flushed and failures reported at the stop
+        document. Defaults to True
+    writer_pool: xpdan.pipelines.executor.WriterPool, optional
+        The pool writing the files if ``async_writes``, its pending writes
+        are all flushed at each stop document. If None use the pool shared
+        by the session. Defaults to None
+    profile: bool, optional
+        If True time every node of the pipeline and print a summary at the
+        stop document. The ``PipelineProfiler`` is available as the
+        ``profiler`` attribute of the returned source. Defaults to False
+    profile_memory: bool, optional
+        If True account for the arrays retained by every node, trace the
+        allocations of every node call and track the peak RSS, printing a
+        summary at the stop document. The ``MemoryProfiler`` is available
+        as the ``memory_profiler`` attribute of the returned source.
+        Defaults to False
+    memory_budget: int, optional
+        Number of bytes of arrays the nodes may retain before a warning is
+        issued. Setting it turns on the accounting of the retained arrays
+        even if ``profile_memory`` is False. Defaults to None
+    stage_cache: xpdan.cache.DiskCache, optional
+        On disk cache for the results of the polarization correction,
+        masking, binner and integration stages, so re-running with
+        different PDF parameters does not recompute them. If None nothing
+        is cached, defaults to None
+    vis_max_rate: float, optional
+        The maximum number of frames per second each plot is redrawn with,
+        the frames in between are skipped by the plots (but still
+        processed and saved). If None draw every frame. Defaults to 10
+    resume: bool, optional
+        If True skip the events whose files have all been written before,
+        as recorded in the manifests in ``save_dir/manifest``, and are
+        unchanged since. The first event of each run is always reduced.
+        Only used if ``write_to_disk`` is True. Defaults to False
+    manifest_checksums: bool, optional
+        If True the manifests record the checksums of the files, so files
+        which were touched but not changed are not reduced again when
+        resuming. This reads every file back after it is written. Defaults
+        to False
+    buffer_budget: int, optional
+        Number of bytes of arrays the ``zip`` and ``zip_latest`` joins may
+        buffer together while waiting on a slow branch. If None do not
+        bound them, defaults to None
+    max_buffered: int, optional
+        Number of documents each input of a join may buffer. If None do not
+        bound them, defaults to None
+    buffer_policy: {'block', 'drop'}, optional
+        What to do when the joins are over their budget, 'block' waits for
+        them to drain and raises a ``RuntimeError`` naming the join after
+        ``buffer_timeout`` seconds, 'drop' drops the oldest frames waiting
+        in the ``zip_latest`` joins. The ``JoinBudget`` is available as the
+        ``join_budget`` attribute of the returned source. Defaults to
+        'block'
+    buffer_timeout: float, optional
+        Seconds to wait for the joins to drain, defaults to 30
+    readonly_arrays: bool, optional
+        If True the arrays in the events are made read-only as they are
+        emitted, so every branch shares the same frame without copies and
+        a stage writing into its input raises. Defaults to True
+    audit_copies: bool, optional
+        If True report the stages which emit a copy of a frame they were
+        given, at the stop document. This compares the frames, so it is
+        slow. Defaults to False
+    output_format: {'files', 'hdf5', 'both'}, optional
+        How the reduced data is written, if 'files' one file per frame and
+        stage, if 'hdf5' one HDF5 file per run holding every stage as an
+        extensible dataset (this needs h5py), if 'both' the two.
+        Only used if ``write_to_disk`` is True. Defaults to 'files'
+    binary_outputs: bool, optional
+        If True the integrated data and PDFs are saved as npz files, holding
+        the arrays and the text header, rather than as .chi and .gr text
+        files. Defaults to False
     verbose: bool, optional
         If True print many outcomes from the pipeline, for debuging use
         only, defaults to False
@@ -88,20 +209,57 @@ def conf_main_pipeline(db, save_dir, *, write_to_disk=False, vis=True,
     source: Stream
         The source for the graph
 
+    Notes
+    -----
+    The frames are integrated one at a time. Micro-batches of frames
+    integrated as one image stack are only offered by
+    ``xpdan.batch.reduce_headers_batch``: here the writers pair each
+    reduced frame with the latest file name through ``zip_latest``, so
+    holding frames back for a batch would save them under the names of
+    later frames.
+
     See also
     --------
     xpdan.tools.mask_img
+    xpdan.batch.reduce_headers_batch
     """
     if pdf_config is None:
         pdf_config = dict(dataformat='QA', qmaxinst=28, qmax=22)
     if mask_kwargs is None:
         mask_kwargs = {}
+    if dark_cache is None:
+        dark_cache = session_dark_cache
+    # darks are shared by many runs so serve them from memory
+    dark_db = CachedBroker(db, dark_cache)
+    if stage_cache is not None:
+        cached = stage_cache.memoize
+    else:
+        def cached(func):
+            return func
     print('start pipeline configuration')
     light_template = os.path.join(
         save_dir,
         base_template)
     raw_source = Stream(stream_name='Raw Data')  # raw data
-    source = es.fill_events(db, raw_source)  # filled raw data
+    graph_source = raw_source
+    if executor_stages and not vis:
+        graph_source = ExecutorStage(raw_source, max_in_flight=max_in_flight,
+                                     stream_name='Reduction stage')
+        raw_source.executor_stage = graph_source
+    if write_to_disk:
+        # track the outputs of the events, skipping the reduced ones before
+        # their images are loaded
+        manifest = OutputManifest(os.path.join(save_dir, 'manifest'),
+                                  checksums=manifest_checksums)
+        resume_filter = ResumeFilter(manifest, light_template, resume=resume,
+                                     binary=binary_outputs)
+        graph_source.sink(resume_filter.observe)
+        graph_source = es.filter(resume_filter, graph_source,
+                                 input_info=None, full_event=True,
+                                 stream_name='If not reduced')
+    # the images are only read when a stage uses them
+    source = graph_source.map(LazyFiller(db))
+    source.stream_name = 'Fill on demand'
 
     # DARK PROCESSING
 
@@ -118,12 +276,12 @@ def conf_main_pipeline(db, save_dir, *, write_to_disk=False, vis=True,
                                            document_name='descriptor',
                                            stream_name='Primary')
 
-    dark_query = es.Query(db,
+    dark_query = es.Query(dark_db,
                           if_not_dark_stream,
                           query_function=query_dark,
                           query_decider=temporal_prox,
                           stream_name='Query for FG Dark')
-    dark_query_results = es.QueryUnpacker(db, dark_query,
+    dark_query_results = es.QueryUnpacker(dark_db, dark_query,
                                           stream_name='Unpack FG Dark')
     # Do the dark subtraction
     zlid = es.zip_latest(if_not_dark_stream_primary,
@@ -141,7 +299,7 @@ def conf_main_pipeline(db, save_dir, *, write_to_disk=False, vis=True,
     # BACKGROUND PROCESSING
     # Query for background
     bg_query_stream = es.Query(db, if_not_dark_stream,
-                               query_function=query_background,
+                               query_function=query_nearest_background,
                                query_decider=temporal_prox,
                                stream_name='Query for Background')
 
@@ -150,53 +308,20 @@ def conf_main_pipeline(db, save_dir, *, write_to_disk=False, vis=True,
                                      full_event=True, input_info=None,
                                      document_name='start',
                                      stream_name='If background')
-    # if has background do background subtraction
-    bg_stream = es.QueryUnpacker(db, if_background_stream,
-                                 stream_name='Unpack background')
-    bg_dark_stream = es.QueryUnpacker(
-        db, es.Query(db,
-                     bg_stream,
-                     query_function=query_dark,
-                     query_decider=temporal_prox,
-                     stream_name='Query for BG Dark'),
-        stream_name='Unpack background dark')
-    # Perform dark subtraction on everything
-    dark_sub_bg = es.map(sub,
-                         es.zip_latest(bg_stream, bg_dark_stream,
-                                       stream_name='Combine bg and bg dark'),
-                         input_info={0: (image_data_key, 0),
-                                     1: (image_data_key, 1)},
-                         output_info=[('img', {'dtype': 'array',
-                                               'source': 'testing'})],
-                         stream_name='Dark Subtracted Background')
-
-    # bundle the backgrounds into one stream
-    bg_bundle = es.BundleSingleStream(dark_sub_bg, bg_query_stream,
-                                      name='Background Bundle')
-
-    # sum the backgrounds
-
-    summed_bg = es.accumulate(dstar(add_img), bg_bundle,
-                              start=dstar(pull_array),
-                              state_key='img1',
-                              input_info={'img2': 'img'},
-                              output_info=[('img', {
-                                  'dtype': 'array',
-                                  'source': 'testing'})])
-    count_bg = es.accumulate(event_count, bg_bundle, start=1,
-                             state_key='count',
-                             output_info=[('count', {
-                                 'dtype': 'int',
-                                 'source': 'testing'})])
-    ave_bg = es.map(truediv, es.zip(summed_bg, count_bg),
-                    input_info={0: ('img', 0), 1: ('count', 1)},
+    # if has background average the dark subtracted backgrounds, this is
+    # memoized so runs sharing a background don't recompute it
+    ave_bg = es.map(partial(average_background, db=db,
+                            image_data_key=image_data_key,
+                            dark_cache=dark_cache, bg_cache=bg_cache,
+                            method=bg_stack_method),
+                    if_background_stream,
+                    input_info={'hdr_uids': 'hdr_uid'},
                     output_info=[('img', {
                         'dtype': 'array',
                         'source': 'testing'})],
-                    stream_name='Average Background'
-                    )
+                    stream_name='Average Background')
 
-    # combine the fg with the summed_bg
+    # combine the fg with the averaged bg
     fg_bg = es.zip_latest(dark_sub_fg, ave_bg,
                           stream_name='Combine fg with bg')
 
@@ -292,7 +417,7 @@ def conf_main_pipeline(db, save_dir, *, write_to_disk=False, vis=True,
     # SPLIT INTO TWO NODES
     zlfl = es.zip_latest(foreground_stream, loaded_calibration_stream,
                          stream_name='Combine FG and Calibration')
-    p_corrected_stream = es.map(polarization_correction,
+    p_corrected_stream = es.map(cached(polarization_correction),
                                 zlfl,
                                 input_info={'img': ('img', 0),
                                             'geo': ('geo', 1)},
@@ -333,7 +458,7 @@ def conf_main_pipeline(db, save_dir, *, write_to_disk=False, vis=True,
                                  cal_stream)
         else:
             zlfc = es.zip_latest(p_corrected_stream, cal_stream)
-        mask_stream = es.map(mask_img,
+        mask_stream = es.map(cached(mask_img),
                              zlfc,
                              input_info={'img': ('img', 0),
                                          'geo': ('geo', 1)},
@@ -346,7 +471,7 @@ def conf_main_pipeline(db, save_dir, *, write_to_disk=False, vis=True,
     # generate binner stream
     zlmc = es.zip_latest(mask_stream, cal_stream)
 
-    binner_stream = es.map(generate_binner,
+    binner_stream = es.map(cached(generate_binner),
                            zlmc,
                            input_info={'geo': ('geo', 1),
                                        'mask': ('mask', 0)},
@@ -355,7 +480,7 @@ def conf_main_pipeline(db, save_dir, *, write_to_disk=False, vis=True,
                            img_shape=(2048, 2048),
                            stream_name='Binners')
     zlpb = es.zip_latest(p_corrected_stream, binner_stream)
-    iq_stream = es.map(integrate,
+    iq_stream = es.map(cached(integrate),
                        zlpb,
                        input_info={'img': ('img', 0),
                                    'binner': ('binner', 1)},
@@ -385,16 +510,25 @@ def conf_main_pipeline(db, save_dir, *, write_to_disk=False, vis=True,
                         **pdf_config,
                         md=dict(analysis_stage='pdf'))
     if vis:
-        foreground_stream.sink(star(LiveImage('img')))
-        mask_stream.sink(star(LiveImage('mask')))
-        iq_stream.sink(star(LiveWaterfall('q', 'iq', units=('Q (A^-1)',
-                                                            'Arb'))))
-        fq_stream.sink(star(LiveWaterfall('q', 'fq', units=('Q (A^-1)',
-                                                            'F(Q)'))))
-        pdf_stream.sink(star(LiveWaterfall('r', 'pdf', units=('r (A)',
-                                                              'G(r) A^-3'))))
+        from bluesky.callbacks.broker import LiveImage
+        from xpdview.callbacks import LiveWaterfall
+        # the plots skip frames when they can not keep up, the frames are
+        # still processed and saved by the other branches
+        vis_sinks = [
+            (foreground_stream, LiveImage('img')),
+            (mask_stream, LiveImage('mask')),
+            (iq_stream, LiveWaterfall('q', 'iq', units=('Q (A^-1)', 'Arb'))),
+            (fq_stream, LiveWaterfall('q', 'fq', units=('Q (A^-1)',
+                                                        'F(Q)'))),
+            (pdf_stream, LiveWaterfall('r', 'pdf', units=('r (A)',
+                                                          'G(r) A^-3')))]
+        for s, callback in vis_sinks:
+            s.sink(LatestOnly(star(callback), max_rate=vis_max_rate))
 
     if write_to_disk:
+        import tifffile
+        from skbeam.core.utils import q_to_twotheta
+        from skbeam.io.fit2d import fit2d_save
         # convert to tth
         tth_stream = es.map(q_to_twotheta,
                             es.zip_latest(iq_stream, eventify_raw_start),
@@ -413,108 +547,141 @@ def conf_main_pipeline(db, save_dir, *, write_to_disk=False, vis=True,
                                stream_name='Combine tth and iq',
                                md=dict(analysis_stage='iq_tth')
                                )
-        eventify_raw_descriptor = es.Eventify(
-            if_not_dark_stream, stream_name='eventify raw descriptor',
-            document='descriptor')
-        # TODO: add calibration writer for xpdAcq
-        # TODO: add calibration writer for users
-        h_timestamp_stream = es.map(_timestampstr, if_not_dark_stream,
-                                    input_info={0: 'time'},
-                                    output_info=[('human_timestamp',
-                                                  {'dtype': 'str'})],
-                                    full_event=True,
-                                    stream_name='human timestamp')
-
-        exts = ['.tiff', '', '_Q.chi',
-                '_tth.chi', '.gr',
-                '.poni']
-        eventify_input_streams = [dark_sub_fg, mask_stream, iq_stream,
-                                  tth_iq_stream, pdf_stream,
-                                  calibration_stream]
-        iis = [
-            {'data': ('img', 0), 'file': ('filename', 1)},
-            {'mask': ('mask', 0), 'filename': ('filename', 1)},
-            {'tth': ('q', 0), 'intensity': ('iq', 0),
-             'output_name': ('filename', 1)},
-            {'tth': ('tth', 0), 'intensity': ('iq', 0),
-             'output_name': ('filename', 1)},
-            {'r': ('r', 0), 'pdf': ('pdf', 0), 'filename': ('filename', 1),
-             'config': ('config', 0)},
-            {'calibration': ('calibration', 0), 'filename': ('filename', 1)}
-        ]
-        saver_kwargs = [{}, {}, {'q_or_2theta': 'Q', 'ext': ''},
-                        {'q_or_2theta': '2theta', 'ext': ''}, {}, {}]
-        eventifies = [
-            es.Eventify(s,
-                        stream_name='eventify {}'.format(s.stream_name)) for s
-            in
-            eventify_input_streams]
-
-        mega_render = [
-            es.map(render_and_clean,
-                   es.zip_latest(
-                       es.zip(h_timestamp_stream,
-                              # human readable event timestamp
-                              if_not_dark_stream  # raw events
-                              ),
-                       eventify_raw_start,
-                       eventify_raw_descriptor,
-                       analysed_eventify
-                   ),
-                   string=light_template,
-                   input_info={
-                       'human_timestamp': (('data', 'human_timestamp'), 0),
-                       'raw_event': ((), 1),
-                       'raw_start': (('data',), 2),
-                       'raw_descriptor': (('data',), 3),
-                       'analyzed_start': (('data',), 4)
-                   },
-                   ext=ext,
-                   full_event=True,
-                   output_info=[('filename', {'dtype': 'str'})],
-                   stream_name='mega render '
-                               '{}'.format(analysed_eventify.stream_name)
-                   )
-            for ext, analysed_eventify in zip(exts, eventifies)]
-
-        md_render = es.map(render_and_clean,
+        writer_pool = writer_pool or session_writer_pool
+        pools = [writer_pool]
+        if async_writes:
+            queue_writer = writer_pool.writer
+        else:
+            def queue_writer(writer):
+                return writer
+
+        if output_format != 'hdf5':
+            eventify_raw_descriptor = es.Eventify(
+                if_not_dark_stream, stream_name='eventify raw descriptor',
+                document='descriptor')
+            # TODO: add calibration writer for xpdAcq
+            # TODO: add calibration writer for users
+            h_timestamp_stream = es.map(_timestampstr, if_not_dark_stream,
+                                        input_info={0: 'time'},
+                                        output_info=[('human_timestamp',
+                                                      {'dtype': 'str'})],
+                                        full_event=True,
+                                        stream_name='human timestamp')
+
+            exts = (['.tiff', ''] +
+                    [ext for _, ext in resume_filter.event_outputs[1:]] +
+                    ['.poni'])
+            eventify_input_streams = [dark_sub_fg, mask_stream, iq_stream,
+                                      tth_iq_stream, pdf_stream,
+                                      calibration_stream]
+            iis = [
+                {'data': ('img', 0), 'file': ('filename', 1)},
+                {'mask': ('mask', 0), 'filename': ('filename', 1)},
+                {'tth': ('q', 0), 'intensity': ('iq', 0),
+                 'output_name': ('filename', 1)},
+                {'tth': ('tth', 0), 'intensity': ('iq', 0),
+                 'output_name': ('filename', 1)},
+                {'r': ('r', 0), 'pdf': ('pdf', 0),
+                 'filename': ('filename', 1), 'config': ('config', 0)},
+                {'calibration': ('calibration', 0),
+                 'filename': ('filename', 1)}
+            ]
+            saver_kwargs = [{}, {},
+                            {'q_or_2theta': 'Q', 'ext': '',
+                             'binary': binary_outputs},
+                            {'q_or_2theta': '2theta', 'ext': '',
+                             'binary': binary_outputs},
+                            {'binary': binary_outputs}, {}]
+            eventifies = [
+                es.Eventify(s,
+                            stream_name='eventify {}'.format(s.stream_name))
+                for s in eventify_input_streams]
+
+            # parsed once, the outputs of an event share its rendering
+            render_filename = compile_template(light_template)
+            mega_render = [
+                es.map(render_filename,
+                       es.zip_latest(
+                           es.zip(h_timestamp_stream,
+                                  # human readable event timestamp
+                                  if_not_dark_stream  # raw events
+                                  ),
                            eventify_raw_start,
-                           string=light_template,
-                           input_info={'raw_start': (('data',), 0), },
-                           output_info=[('filename', {'dtype': 'str'})],
-                           ext='.yml',
-                           full_event=True)
-
-        make_dirs = [es.map(lambda x: os.makedirs(os.path.split(x)[0],
-                                                  exist_ok=True),
-                            cs,
-                            input_info={0: 'filename'},
-                            output_info=[('filename', {'dtype': 'str'})],
-                            stream_name='Make dirs {}'.format(cs.stream_name)
-                            ) for cs in mega_render]
-
-        [es.map(writer_templater,
-                es.zip_latest(s1, s2, made_dir),
-                input_info=ii,
-                output_info=[('final_filename', {'dtype': 'str'})],
-                stream_name='Write {}'.format(s1.stream_name),
-                **kwargs) for s1, s2, made_dir, ii, writer_templater, kwargs
-         in
-         zip(
-             [dark_sub_fg, mask_stream, iq_stream, tth_iq_stream,
-              pdf_stream],
-             mega_render,
-             make_dirs,  # prevent run condition btwn dirs and files
-             iis,
-             [tifffile.imsave, fit2d_save, save_output, save_output,
-              pdf_saver, poni_saver],
-             saver_kwargs
-         )]
-
-        es.map(dump_yml, es.zip(eventify_raw_start, md_render),
-               input_info={0: (('data', 'filename'), 1),
-                           1: (('data',), 0)},
-               full_event=True)
+                           eventify_raw_descriptor,
+                           analysed_eventify
+                       ),
+                       input_info={
+                           'human_timestamp': (('data', 'human_timestamp'), 0),
+                           'raw_event': ((), 1),
+                           'raw_start': (('data',), 2),
+                           'raw_descriptor': (('data',), 3),
+                           'analyzed_start': (('data',), 4)
+                       },
+                       ext=ext,
+                       full_event=True,
+                       output_info=[('filename', {'dtype': 'str'})],
+                       stream_name='mega render '
+                                   '{}'.format(analysed_eventify.stream_name)
+                       )
+                for ext, analysed_eventify in zip(exts, eventifies)]
+
+            md_render = es.map(render_filename,
+                               eventify_raw_start,
+                               input_info={'raw_start': (('data',), 0), },
+                               output_info=[('filename', {'dtype': 'str'})],
+                               ext='.yml',
+                               full_event=True)
+
+            # the folders are only created once per session
+            make_dirs = [es.map(makedirs_for,
+                                cs,
+                                input_info={0: 'filename'},
+                                output_info=[('filename', {'dtype': 'str'})],
+                                stream_name='Make dirs {}'.format(
+                                    cs.stream_name)
+                                ) for cs in mega_render]
+
+            [es.map(queue_writer(manifest.recording(
+                retry_missing_dir(writer_templater, filename_kwarg),
+                filename_kwarg)),
+                    es.zip_latest(s1, s2, made_dir),
+                    input_info=ii,
+                    output_info=[('final_filename', {'dtype': 'str'})],
+                    stream_name='Write {}'.format(s1.stream_name),
+                    **kwargs) for (s1, s2, made_dir, ii, writer_templater,
+                                   filename_kwarg, kwargs)
+             in
+             zip(
+                 [dark_sub_fg, mask_stream, iq_stream, tth_iq_stream,
+                  pdf_stream],
+                 mega_render,
+                 make_dirs,  # prevent run condition btwn dirs and files
+                 iis,
+                 [tifffile.imsave, fit2d_save, chi_saver, chi_saver,
+                  pdf_saver, poni_saver],
+                 ['file', 'filename', 'output_name', 'output_name',
+                  'filename'],
+                 saver_kwargs
+             )]
+
+            es.map(queue_writer(retry_missing_dir(dump_yml, 'filename')),
+                   es.zip(eventify_raw_start, md_render),
+                   input_info={0: (('data', 'filename'), 1),
+                               1: (('data',), 0)},
+                   full_event=True)
+
+        if output_format != 'files':
+            pools.append(_hdf5_sinks(
+                light_template, if_not_dark_stream,
+                {'dark_sub': dark_sub_fg, 'mask': mask_stream,
+                 'iq_q': iq_stream, 'iq_tth': tth_iq_stream,
+                 'pdf': pdf_stream},
+                async_writes=async_writes))
+
+        if async_writes:
+            # registered last so the run's writes are all queued by now
+            source.sink(lambda nd: nd[0] == 'stop' and
+                        [pool.flush() for pool in pools])
     if verbose:
         source.sink(pprint)
         if_not_dark_stream.sink(pprint)
@@ -530,9 +697,57 @@ def conf_main_pipeline(db, save_dir, *, write_to_disk=False, vis=True,
         zlpb.sink(pprint)
         iq_stream.sink(pprint)
         pdf_stream.sink(pprint)
-        if write_to_disk:
+        if write_to_disk and output_format != 'hdf5':
             md_render.sink(pprint)
             [es.map(lambda **x: pprint(x['data']['filename']), cs,
                     full_event=True) for cs in mega_render]
-
+    _instrument(raw_source, profile=profile, profile_memory=profile_memory,
+                memory_budget=memory_budget, buffer_budget=buffer_budget,
+                max_buffered=max_buffered, buffer_policy=buffer_policy,
+                buffer_timeout=buffer_timeout,
+                readonly_arrays=readonly_arrays or audit_copies,
+                audit_copies=audit_copies)
     return raw_source
+
+
+def _hdf5_sinks(template, raw_stream, stage_streams, async_writes):
+    """Write the reduced data of each run to one HDF5 file
+
+    Returns
+    -------
+    WriterPool:
+        The pool writing the file, flushed at the stop document
+    """
+    h5_writer = RunHDF5Writer(template)
+    # one writer thread, so the appends land in order
+    h5_pool = WriterPool(n_workers=1)
+    if async_writes:
+        queue_h5 = h5_pool.writer
+    else:
+        def queue_h5(writer):
+            return writer
+    for stage, stream in stage_streams.items():
+        stream.sink(queue_h5(h5_writer.sink(stage)))
+    # registered after the data sinks, so the run is complete when the file
+    # is closed at its stop
+    raw_stream.sink(queue_h5(h5_writer.observe))
+    return h5_pool
+
+
+def _instrument(raw_source, *, profile, profile_memory, memory_budget,
+                buffer_budget, max_buffered, buffer_policy, buffer_timeout,
+                readonly_arrays, audit_copies):
+    """Attach the array guard, the budget and the profilers to a pipeline"""
+    if readonly_arrays:
+        raw_source.readonly_arrays = ReadOnlyArrays(raw_source,
+                                                    audit=audit_copies)
+    if buffer_budget is not None or max_buffered is not None:
+        raw_source.join_budget = JoinBudget(
+            raw_source, max_bytes=buffer_budget, max_buffered=max_buffered,
+            policy=buffer_policy, timeout=buffer_timeout)
+    if profile:
+        raw_source.profiler = PipelineProfiler(raw_source)
+    if profile_memory or memory_budget is not None:
+        raw_source.memory_profiler = MemoryProfiler(
+            raw_source, budget=memory_budget,
+            trace_allocations=profile_memory, report=profile_memory)
@@ -1,4 +1,5 @@
 import os
+import time
 from pathlib import Path
 
 from xpdan.dev_utils import _timestampstr
@@ -75,3 +76,61 @@ def templater2_func(doc, template, aux=None, short_aux=None):
 def templater3_func(template, analysis_stage='raw', ext='.tiff'):
     return Path(template.format(analysis_stage=analysis_stage,
                                 ext=ext)).as_posix()
+
+
+class LatestOnly(object):
+    """Only pass the latest event to a slow callback, at a bounded rate
+
+    Events arriving less than ``1 / max_rate`` seconds after the callback
+    returned from the last one are held back, each replacing the previous
+    one, so a slow visualization skips frames instead of holding up the
+    pipeline. The held event is passed on before any other document, so
+    the last frame of a run is always shown. All the other documents are
+    passed on.
+
+    Parameters
+    ----------
+    callback: callable
+        The callback, which takes (name, doc) pairs
+    max_rate: float, optional
+        The maximum number of events passed on per second. If None pass on
+        every event. Defaults to 10
+
+    Examples
+    --------
+    >>> iq_stream.sink(LatestOnly(star(LiveWaterfall('q', 'iq'))))
+    """
+
+    def __init__(self, callback, max_rate=10.):
+        self.callback = callback
+        self.min_interval = 1. / max_rate if max_rate else 0.
+        self.dropped = 0
+        self._last = None
+        self._pending = None
+
+    def __call__(self, nd):
+        name, doc = nd
+        if name == 'event':
+            now = time.monotonic()
+            if (self._last is not None and
+                    now - self._last < self.min_interval):
+                self._drop_pending()
+                self._pending = nd
+                return
+            self._drop_pending()
+            try:
+                return self.callback(nd)
+            finally:
+                # a draw slower than the interval must not let every frame
+                # through, so wait from the end of the draw
+                self._last = time.monotonic()
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            self.callback(pending)
+            self._last = time.monotonic()
+        return self.callback(nd)
+
+    def _drop_pending(self):
+        if self._pending is not None:
+            self.dropped += 1
+            self._pending = None
@@ -6,21 +6,22 @@ from operator import sub
 from pathlib import Path
 
 import shed.event_streams as es
-import tifffile
 import yaml
 from shed.event_streams import star
 
-from bluesky.callbacks.broker import LiveImage
 from streamz import Stream
-from xpdan.db_utils import query_dark, temporal_prox
+from xpdan.cache import CachedBroker, dark_cache as session_dark_cache
+from xpdan.db_utils import query_dark, temporal_prox, LazyFiller
 from xpdan.dev_utils import _timestampstr
 from xpdan.formatters import PartialFormatter, CleanFormatter
-from xpdan.pipelines.pipeline_utils import (if_dark)
+from xpdan.io import makedirs_for
+from xpdan.pipelines.pipeline_utils import if_dark, LatestOnly
 
 
 # TODO: refactor templating
 def conf_save_tiff_pipeline(db, save_dir, *, write_to_disk=False, vis=True,
-                            image_data_key='pe1_image'):
+                            image_data_key='pe1_image', dark_cache=None,
+                            vis_max_rate=10.):
     """Total data processing pipeline for XPD
 
     Parameters
@@ -37,6 +38,13 @@ def conf_save_tiff_pipeline(db, save_dir, *, write_to_disk=False, vis=True,
         If True visualize the data. Defaults to False
     image_data_key: str, optional
         The key for the image data, defaults to `pe1_image`
+    dark_cache: xpdan.cache.RunCache, optional
+        Cache for the filled dark runs, defaults to the session wide
+        ``xpdan.cache.dark_cache`` which is shared between pipelines
+    vis_max_rate: float, optional
+        The maximum number of frames per second the image is redrawn with,
+        the frames in between are skipped by the plot (but still saved).
+        If None draw every frame. Defaults to 10
 
     Returns
     -------
@@ -57,20 +65,26 @@ def conf_save_tiff_pipeline(db, save_dir, *, write_to_disk=False, vis=True,
         '_{uid:.6}'
         '_{seq_num:03d}{ext}')
     fmt = PartialFormatter()
+    if dark_cache is None:
+        dark_cache = session_dark_cache
+    dark_db = CachedBroker(db, dark_cache)
     source = Stream(stream_name='Raw Data')
     # source.sink(pprint)
+    # the images are only read when a stage uses them
+    filled_source = source.map(LazyFiller(db))
+    filled_source.stream_name = 'Fill on demand'
 
     # if not dark do dark subtraction
-    if_not_dark_stream = es.filter(lambda x: not if_dark(x), source,
+    if_not_dark_stream = es.filter(lambda x: not if_dark(x), filled_source,
                                    input_info=None,
                                    document_name='start',
                                    stream_name='If not dark')
-    dark_query = es.Query(db,
+    dark_query = es.Query(dark_db,
                           if_not_dark_stream,
                           query_function=query_dark,
                           query_decider=temporal_prox,
                           stream_name='Query for FG Dark')
-    dark_query_results = es.QueryUnpacker(db, dark_query,
+    dark_query_results = es.QueryUnpacker(dark_db, dark_query,
                                           stream_name='Unpack FG Dark')
     # Do the dark subtraction
     dark_sub_fg = es.map(sub,
@@ -85,7 +99,9 @@ def conf_save_tiff_pipeline(db, save_dir, *, write_to_disk=False, vis=True,
                                  analysis_stage='dark_sub'))
     # pdf_stream.sink(pprint)
     if vis:
-        dark_sub_fg.sink(star(LiveImage('img')))
+        from bluesky.callbacks.broker import LiveImage
+        dark_sub_fg.sink(LatestOnly(star(LiveImage('img')),
+                                    max_rate=vis_max_rate))
 
     eventify_raw = es.Eventify(if_not_dark_stream, stream_name='eventify raw')
 
@@ -157,8 +173,7 @@ def conf_save_tiff_pipeline(db, save_dir, *, write_to_disk=False, vis=True,
                             stream_name='clean template '
                                         '{}'.format(s.stream_name)
                             ) for s in render_2]
-    [es.map(lambda x: os.makedirs(os.path.split(x)[0],
-                                  exist_ok=True), cs,
+    [es.map(makedirs_for, cs,
             input_info={0: 'filename'},
             stream_name='Make dirs {}'.format(cs.stream_name)
             ) for cs in clean_streams]
@@ -178,6 +193,7 @@ def conf_save_tiff_pipeline(db, save_dir, *, write_to_disk=False, vis=True,
 
     # """
     if write_to_disk:
+        import tifffile
         iis = [{'data': ('img', 0), 'file': ('filename', 1)}, ]
 
         [
@@ -0,0 +1,310 @@
+"""Live reduction server, reducing the documents published over zmq"""
+import argparse
+import threading
+import time
+import traceback
+from functools import partial
+from queue import Queue
+
+from xpdan.pipelines.executor import close_stages
+
+_STOP = object()
+
+
+class _Worker(object):
+    """A thread feeding the documents of its queue into its own pipeline"""
+
+    def __init__(self, make_pipeline, max_queued, name):
+        self.make_pipeline = make_pipeline
+        self.queue = Queue(maxsize=max_queued)
+        self.source = make_pipeline()
+        self.processed = 0
+        self.events = 0
+        self.errors = 0
+        self._skip_run = False
+        self._thread = threading.Thread(target=self._work, name=name,
+                                        daemon=True)
+        self._thread.start()
+
+    def _work(self):
+        while True:
+            nd = self.queue.get()
+            try:
+                if nd is _STOP:
+                    close_stages(self.source)
+                    return
+                self._process(nd)
+            finally:
+                self.queue.task_done()
+
+    def _process(self, nd):
+        name = nd[0]
+        if name == 'start':
+            self._skip_run = False
+        if self._skip_run:
+            return
+        try:
+            self.source.emit(nd)
+        except Exception:
+            traceback.print_exc()
+            self.errors += 1
+            # the pipeline may hold part of the failed run, start fresh and
+            # leave out the rest of the run
+            close_stages(self.source)
+            self.source = self.make_pipeline()
+            self._skip_run = name != 'stop'
+            return
+        self.processed += 1
+        if name == 'event':
+            self.events += 1
+
+
+class ReductionServer(object):
+    """Reduce runs on a pool of pipelines, decoupled from their receipt
+
+    The server is a callback taking (name, doc) pairs. Each document is
+    only put in the queue of a worker thread, so receiving the next frame
+    does not wait for the reduction of the last one. A run is assigned to
+    the least busy worker at its start document and all of its documents
+    go to that worker, in order, as the pipelines keep state over a run.
+    When a worker's queue holds ``max_queued`` documents the caller blocks
+    until the worker catches up, bounding the memory held by the queues.
+
+    Parameters
+    ----------
+    make_pipeline: callable
+        Returns the source of a new pipeline, called once for every worker
+        and again after a pipeline failed
+    n_workers: int, optional
+        The number of workers, defaults to 1
+    max_queued: int, optional
+        The maximum number of documents queued for each worker, defaults
+        to 64
+
+    Examples
+    --------
+    >>> server = ReductionServer(partial(worker_pipeline, db, save_dir,
+    ...                                  vis=False, write_to_disk=True),
+    ...                          n_workers=2)
+    >>> dispatcher = RemoteDispatcher('127.0.0.1:5568')
+    >>> dispatcher.subscribe(server)
+    >>> dispatcher.start()
+    """
+
+    def __init__(self, make_pipeline, n_workers=1, max_queued=64):
+        self.workers = [_Worker(make_pipeline, max_queued,
+                                'xpdan-reduction-{}'.format(i))
+                        for i in range(n_workers)]
+        self.received = 0
+        self.orphaned = 0
+        self._runs = {}
+        self._descriptors = {}
+        self._last = (time.monotonic(), 0)
+        self._reporting = None
+
+    def _route(self, name, doc):
+        if name == 'start':
+            worker = min(self.workers, key=lambda w: w.queue.qsize())
+            self._runs[doc['uid']] = (worker, [])
+            return worker
+        if name == 'descriptor':
+            worker, descriptors = self._runs.get(doc['run_start'],
+                                                 (None, None))
+            if worker is not None:
+                descriptors.append(doc['uid'])
+                self._descriptors[doc['uid']] = worker
+            return worker
+        if name == 'event':
+            return self._descriptors.get(doc['descriptor'])
+        if name == 'stop':
+            worker, descriptors = self._runs.pop(doc['run_start'],
+                                                 (None, []))
+            for uid in descriptors:
+                self._descriptors.pop(uid, None)
+            return worker
+
+    def __call__(self, name, doc):
+        self.received += 1
+        worker = self._route(name, doc)
+        if worker is None:
+            # eg. the run started before the server
+            self.orphaned += 1
+            return
+        worker.queue.put((name, doc))
+
+    def metrics(self):
+        """The throughput and queue metrics of the server
+
+        Returns
+        -------
+        dict:
+            The numbers of documents ``received``, ``processed`` and
+            ``orphaned`` (not part of a run the server saw start), of
+            pipeline ``errors`` and of reduced ``events``, the
+            ``events_per_second`` since the last call, the number of
+            ``active_runs`` and the ``queue_depths`` of the workers
+        """
+        now = time.monotonic()
+        events = sum(w.events for w in self.workers)
+        t0, events0 = self._last
+        self._last = (now, events)
+        return dict(
+            received=self.received,
+            processed=sum(w.processed for w in self.workers),
+            orphaned=self.orphaned,
+            errors=sum(w.errors for w in self.workers),
+            events=events,
+            events_per_second=(events - events0) / max(now - t0, 1e-9),
+            active_runs=len(self._runs),
+            queue_depths=[w.queue.qsize() for w in self.workers])
+
+    def report(self):
+        """Print the metrics on one line"""
+        m = self.metrics()
+        print('received {received} processed {processed} events {events} '
+              '({events_per_second:.2f}/s) runs {active_runs} queues '
+              '{queue_depths} errors {errors} orphaned {orphaned}'.format(**m))
+
+    def start_reporting(self, interval=10.):
+        """Print the metrics every ``interval`` seconds, on a thread"""
+        stop = threading.Event()
+
+        def report():
+            while not stop.wait(interval):
+                self.report()
+
+        self._reporting = stop
+        threading.Thread(target=report, daemon=True).start()
+
+    def join(self):
+        """Wait until all the queued documents have been processed"""
+        for worker in self.workers:
+            worker.queue.join()
+
+    def stop(self):
+        """Process the queued documents and stop the workers"""
+        if self._reporting is not None:
+            self._reporting.set()
+        for worker in self.workers:
+            worker.queue.put(_STOP)
+        for worker in self.workers:
+            worker._thread.join()
+
+
+def worker_pipeline(db, save_dir, **pipeline_kwargs):
+    """A pipeline writing through its own writer pool
+
+    The pipelines flush their writer pool at each stop document, with a
+    shared pool a worker would also wait on the writes of the other
+    workers' runs.
+
+    Parameters
+    ----------
+    db: databroker.broker.Broker instance
+        The databroker holding the data
+    save_dir: str
+        The folder in which to save the data
+    pipeline_kwargs:
+        Passed to ``conf_main_pipeline``
+
+    Returns
+    -------
+    Stream:
+        The source of the pipeline
+    """
+    from xpdan.pipelines.executor import WriterPool
+    from xpdan.pipelines.main import conf_main_pipeline
+    return conf_main_pipeline(db, save_dir, writer_pool=WriterPool(),
+                              **pipeline_kwargs)
+
+
+def serve(db, save_dir, *, proxy='127.0.0.1:5568', n_workers=1,
+          max_queued=64, metrics_interval=10., **pipeline_kwargs):
+    """Reduce the runs published through a zmq proxy until interrupted
+
+    Parameters
+    ----------
+    db: databroker.broker.Broker instance
+        The databroker holding the data
+    save_dir: str
+        The folder in which to save the data
+    proxy: str, optional
+        The address of the outbound side of the zmq proxy, defaults to
+        ``'127.0.0.1:5568'``
+    n_workers: int, optional
+        The number of pipelines reducing runs in parallel, defaults to 1
+    max_queued: int, optional
+        The maximum number of documents queued for each pipeline, defaults
+        to 64
+    metrics_interval: float, optional
+        Seconds between the metrics reports, if None do not report.
+        Defaults to 10
+    pipeline_kwargs:
+        Passed to ``conf_main_pipeline``, by default the files are written.
+        The pipelines run on worker threads, from which matplotlib can not
+        draw, so ``vis`` must not be True
+
+    Returns
+    -------
+    ReductionServer:
+        The server, stopped
+
+    Raises
+    ------
+    ValueError:
+        If ``vis`` is True
+    """
+    if pipeline_kwargs.get('vis'):
+        # matplotlib must draw from the main thread
+        raise ValueError('The server can not visualize, run '
+                         'conf_main_pipeline on the main thread instead')
+    from bluesky.callbacks.zmq import RemoteDispatcher
+    pipeline_kwargs.setdefault('write_to_disk', True)
+    pipeline_kwargs['vis'] = False
+    server = ReductionServer(partial(worker_pipeline, db, save_dir,
+                                     **pipeline_kwargs),
+                             n_workers=n_workers, max_queued=max_queued)
+    if metrics_interval:
+        server.start_reporting(metrics_interval)
+    dispatcher = RemoteDispatcher(proxy)
+    dispatcher.subscribe(server)
+    print('serving {} on {} worker(s)'.format(proxy, n_workers))
+    try:
+        dispatcher.start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        server.report()
+    return server
+
+
+def main(argv=None):
+    """Entry point of ``xpdan-serve``"""
+    parser = argparse.ArgumentParser(
+        description='Reduce the runs published through a zmq proxy')
+    parser.add_argument('--proxy', default='127.0.0.1:5568',
+                        help='address of the outbound side of the proxy')
+    parser.add_argument('--db', default='xpd',
+                        help='name of the databroker configuration')
+    parser.add_argument('--save-dir', required=True,
+                        help='folder in which to save the data')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of runs reduced in parallel')
+    parser.add_argument('--queue-size', type=int, default=64,
+                        help='documents queued for each worker')
+    parser.add_argument('--metrics-interval', type=float, default=10.,
+                        help='seconds between metrics reports, 0 for none')
+    parser.add_argument('--no-write', action='store_true',
+                        help='do not write the reduced data to disk')
+    args = parser.parse_args(argv)
+
+    from databroker import Broker
+    serve(Broker.named(args.db), args.save_dir, proxy=args.proxy,
+          n_workers=args.workers, max_queued=args.queue_size,
+          metrics_interval=args.metrics_interval,
+          write_to_disk=not args.no_write)
+
+
+if __name__ == '__main__':
+    main()
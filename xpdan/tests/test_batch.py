@@ -0,0 +1,20 @@
+import os
+
+import pytest
+
+from xpdan.data_reduction_core import integrate_and_save
+from .utils import assert_same_outputs
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'batch_size': 2},
+                                    {'scheduler': 'threads'}])
+def test_reduce_headers_batch_matches_pipeline(exp_db, fast_tmp_dir, kwargs):
+    pytest.importorskip('dask')
+    from xpdan.batch import reduce_headers_batch
+    hdrs = [exp_db[-1], exp_db[-3]]
+    dirs = [os.path.join(fast_tmp_dir, d) for d in ['pipeline', 'batch']]
+    integrate_and_save(hdrs, db=exp_db, save_dir=dirs[0], mask_setting=None)
+    res = reduce_headers_batch(hdrs, db=exp_db, save_dir=dirs[1],
+                               mask_setting=None, **kwargs)
+    assert set(res) == {h['start']['uid'] for h in hdrs}
+    assert_same_outputs(dirs)
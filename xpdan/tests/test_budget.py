@@ -0,0 +1,54 @@
+import time
+
+import numpy as np
+import pytest
+from streamz import Stream
+
+from xpdan.pipelines.budget import JoinBudget
+from xpdan.pipelines.executor import ExecutorStage
+
+
+def test_join_budget_block():
+    source = Stream()
+    a = source.filter(lambda x: True, stream_name='fast')
+    b = source.filter(lambda x: x < 2, stream_name='stalled')
+    L = []
+    a.zip(b, stream_name='join').sink(L.append)
+    budget = JoinBudget(source, max_buffered=4)
+    for i in range(6):
+        source.emit(i)
+    with pytest.raises(RuntimeError) as excinfo:
+        source.emit(6)
+    assert "'join'" in str(excinfo.value)
+    assert "'stalled'" in str(excinfo.value)
+    assert len(L) == 2
+    assert budget.peak_buffered['join'] == 4
+
+
+def test_join_budget_bytes():
+    source = Stream()
+    a = source.filter(lambda x: True)
+    b = source.filter(lambda x: False)
+    z = a.zip(b, stream_name='join')
+    budget = JoinBudget(source, max_bytes=3 * 800)
+    for i in range(3):
+        source.emit(np.ones(100))
+    with pytest.raises(RuntimeError):
+        source.emit(np.ones(100))
+    assert budget.measure()['join'] == 3 * 800
+    assert z.buffers
+    assert 'join' in budget.summary()
+
+
+def test_join_budget_waits_for_other_threads():
+    source = Stream()
+    stage = ExecutorStage(source)
+    slow = stage.map(lambda x: time.sleep(.01) or x)
+    L = []
+    source.filter(lambda x: True).zip(slow).sink(L.append)
+    JoinBudget(source, max_buffered=2, timeout=10)
+    for i in range(10):
+        source.emit(i)
+    stage.flush()
+    assert L == [(i, i) for i in range(10)]
+    stage.close()
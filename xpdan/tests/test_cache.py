@@ -0,0 +1,75 @@
+import numpy as np
+
+from xpdan.cache import RunCache, CachedBroker, DiskCache
+
+
+def test_run_cache_hits(exp_db):
+    cache = RunCache()
+    cdb = CachedBroker(exp_db, cache)
+    dark_uid = exp_db[-1]['start']['sc_dk_field_uid']
+    docs = list(cdb[dark_uid].documents(fill=True))
+    docs2 = list(cdb[dark_uid].documents(fill=True))
+    info = cache.cache_info()
+    assert info.misses == 1
+    assert info.hits == 1
+    assert info.size == 1
+    assert [n for n, d in docs] == [n for n, d in docs2]
+    assert [d['uid'] for n, d in docs] == [d['uid'] for n, d in docs2]
+    assert cdb[dark_uid]['start']['uid'] == dark_uid
+
+
+def test_run_cache_eviction(exp_db):
+    dark_uids = [exp_db[i]['start']['sc_dk_field_uid'] for i in [-1, -3]]
+    nbytes = sum(d['data']['pe1_image'].nbytes for n, d in
+                 exp_db[dark_uids[0]].documents(fill=True) if n == 'event')
+    cache = RunCache(max_bytes=nbytes)
+    cdb = CachedBroker(exp_db, cache)
+    for uid in dark_uids:
+        list(cdb[uid].documents(fill=True))
+    info = cache.cache_info()
+    assert info.evictions == 1
+    assert info.size == 1
+    assert dark_uids[-1] in cache
+    assert dark_uids[0] not in cache
+    assert info.currbytes <= info.maxbytes
+
+
+def test_disk_cache(tmpdir):
+    cache = DiskCache(str(tmpdir))
+    calls = []
+
+    def double(img, factor=2):
+        calls.append(factor)
+        return img * factor
+
+    cached_double = cache.memoize(double)
+    img = np.arange(10.)
+    a = cached_double(img)
+    b = cached_double(img.copy())
+    np.testing.assert_array_equal(a, b)
+    assert calls == [2]
+    cached_double(img, factor=3)
+    assert calls == [2, 3]
+    # the results of a stage are passed on without hashing them again
+    cached_double(b)
+    cached_double(b)
+    assert calls == [2, 3, 2]
+    # the cache persists between sessions
+    cache2 = DiskCache(str(tmpdir))
+    cache2.memoize(double)(img)
+    assert calls == [2, 3, 2]
+    assert cache2.cache_info().size == 3
+
+
+def test_disk_cache_eviction(tmpdir):
+    cache = DiskCache(str(tmpdir))
+    cached_copy = cache.memoize(np.copy, name='copy')
+    cached_copy(np.zeros(1000))
+    nbytes = cache.cache_info().currbytes
+    cache = DiskCache(str(tmpdir), max_bytes=2 * nbytes)
+    cached_copy = cache.memoize(np.copy, name='copy')
+    for i in range(3):
+        cached_copy(np.ones(1000) * (i + 1))
+    info = cache.cache_info()
+    assert info.evictions == 2
+    assert info.currbytes <= info.maxbytes
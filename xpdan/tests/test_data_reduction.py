@@ -13,7 +13,10 @@
 #
 ##############################################################################
 import os
+import sys
+import types
 
+from xpdan import data_reduction_core
 from xpdan.data_reduction import (integrate_and_save, integrate_and_save_last,
                                   save_tiff, save_last_tiff)
 
@@ -66,3 +69,22 @@ def test_save_last_tiff_core_smoke(exp_db, fast_tmp_dir):
             old_times) != set(
             [os.path.getmtime(os.path.join(fast_tmp_dir, f)) for f in
              os.listdir(fast_tmp_dir)]))
+
+
+def test_last_functions_get_glbl_defaults(monkeypatch):
+    glbl = types.ModuleType('xpdan.glbl')
+    glbl.an_glbl = {'exp_db': 'db', 'tiff_base': 'base',
+                    'mask_kwargs': {'alpha': 2}, 'image_data_key': 'img',
+                    'polarization_factor': .5}
+    monkeypatch.setitem(sys.modules, 'xpdan.glbl', glbl)
+    calls = []
+    for name in ['integrate_and_save_last', 'save_last_tiff']:
+        monkeypatch.setattr(data_reduction_core, name,
+                            lambda **kwargs: calls.append(kwargs))
+    integrate_and_save_last(mask_setting=None)
+    save_last_tiff()
+    assert calls[0] == dict(db='db', save_dir='base', mask_setting=None,
+                            mask_kwargs={'alpha': 2}, image_data_key='img',
+                            polarization_factor=.5)
+    assert calls[1]['db'] == 'db'
+    assert calls[1]['image_data_key'] == 'img'
@@ -19,7 +19,7 @@ import pytest
 from xpdan.data_reduction_core import (integrate_and_save,
                                        integrate_and_save_last,
                                        save_tiff, save_last_tiff)
-from .utils import integrate_kwargs
+from .utils import integrate_kwargs, assert_same_outputs
 
 
 @pytest.mark.parametrize(("kwargs", 'known_fail_bool'), integrate_kwargs)
@@ -78,3 +78,14 @@ def test_save_last_tiff_core_smoke(exp_db, fast_tmp_dir):
             old_times) != set(
             [os.path.getmtime(os.path.join(fast_tmp_dir, f)) for f in
              os.listdir(fast_tmp_dir)]))
+
+
+def test_integrate_parallel_matches_serial(exp_db, fast_tmp_dir):
+    hdrs = [exp_db[-1], exp_db[-3]]
+    dirs = [os.path.join(fast_tmp_dir, d) for d in ['serial', 'parallel']]
+    integrate_and_save(hdrs, db=exp_db, save_dir=dirs[0], mask_setting=None)
+    summary = integrate_and_save(hdrs, db=exp_db, save_dir=dirs[1],
+                                 mask_setting=None, n_workers=2)
+    assert not summary['failed']
+    assert set(summary['processed']) == {h['start']['uid'] for h in hdrs}
+    assert_same_outputs(dirs)
@@ -1,4 +1,16 @@
-from xpdan.db_utils import sort_scans_by_hdr_key, scan_diff, scan_summary
+import threading
+import time
+
+import numpy as np
+import pytest
+from numpy.testing import assert_array_equal
+
+from xpdan.cache import LRUCache, RunCache
+from xpdan.db_utils import (sort_scans_by_hdr_key, scan_diff, scan_summary,
+                            average_background, query_background,
+                            query_nearest_background, temporal_prox,
+                            TemporalIndex, LazyFiller, prefetch_documents,
+                            broker_config, open_broker)
 
 
 def test_sort_scans_by_hdr_key(exp_db):
@@ -25,3 +37,120 @@ def test_scan_summary(exp_db):
     hdrs = exp_db()
     d = scan_summary(hdrs)
     assert len(d) != 0
+
+
+def test_average_background(exp_db, img_size):
+    bg_cache = LRUCache()
+    bg_uid = exp_db[2]['start']['uid']
+    ave = average_background(bg_uid, exp_db, dark_cache=RunCache(),
+                             bg_cache=bg_cache)
+    assert_array_equal(ave, np.zeros(img_size))
+    assert not ave.flags.writeable
+    ave2 = average_background([bg_uid], exp_db, bg_cache=bg_cache)
+    assert ave2 is ave
+    assert bg_cache.cache_info().hits == 1
+    # a hit does not touch the databroker
+    assert average_background(bg_uid, None, bg_cache=bg_cache) is ave
+
+
+def test_query_nearest_background(exp_db):
+    index = TemporalIndex()
+    start = exp_db[-1]['start']
+    hdr = query_nearest_background(exp_db, (start,), index=index)
+    assert hdr['start']['uid'] == exp_db[2]['start']['uid']
+    assert temporal_prox(hdr, (start,)) is hdr
+    # the index gives the same answer as searching all the results
+    res = query_background(exp_db, (start,))
+    assert temporal_prox(res, (start,))['start']['uid'] == \
+        hdr['start']['uid']
+    # repeated lookups are served from the index
+    assert query_nearest_background(exp_db, (start,), index=index) is hdr
+
+
+class FakeBroker(dict):
+    """Maps uids to headers, found by sample name"""
+
+    def __call__(self, **query):
+        return [hdr for hdr in self.values() if all(
+            hdr['start'].get(k) == v for k, v in query.items())]
+
+
+def test_temporal_index_is_bounded():
+    db = FakeBroker((str(i), {'start': {'uid': str(i), 'time': i,
+                                        'sample_name': str(i)}})
+                    for i in range(10))
+    index = TemporalIndex(max_entries=3)
+    for i in range(10):
+        assert index.nearest(db, {'sample_name': str(i)}, 0) is db[str(i)]
+    assert len(index._index) == 3
+    assert len(index._hdrs) == 3
+    assert index.nearest(db, {'sample_name': '9'}, 0) is db['9']
+
+
+def test_lazy_filler(exp_db):
+    hdr = exp_db[-1]
+    filled = [doc for name, doc in hdr.documents(fill=True)
+              if name == 'event']
+    filler = LazyFiller(exp_db)
+    events = [filler(nd)[1] for nd in hdr.documents(fill=False)
+              if nd[0] in ('start', 'descriptor', 'event')]
+    events = [doc for doc in events if 'seq_num' in doc]
+    assert len(events) == len(filled)
+    for event, filled_event in zip(events, filled):
+        # nothing is loaded until the image is used
+        assert not event['data'].filled
+        assert_array_equal(event['data']['pe1_image'],
+                           filled_event['data']['pe1_image'])
+        assert event['data'].filled
+
+
+def test_open_broker(exp_db):
+    db = open_broker(broker_config(exp_db))
+    assert db is not exp_db
+    hdr = db[-1]
+    assert hdr['start'] == exp_db[-1]['start']
+    assert_array_equal(next(hdr.data('pe1_image')),
+                       next(exp_db[-1].data('pe1_image')))
+
+
+class FakeHeader(dict):
+    def __init__(self, n, dark=False, fail=False):
+        dict.__init__(self, start={'uid': str(n), 'dark_frame': dark})
+        self.fail = fail
+        self.read = []
+
+    def documents(self, fill=False):
+        yield 'start', self['start']
+        for i in range(5):
+            self.read.append((i, fill, threading.current_thread()))
+            if self.fail and i == 2:
+                raise IOError()
+            yield 'event', {'seq_num': i, 'data': {'img': np.ones(10)}}
+        yield 'stop', {}
+
+
+def test_prefetch_documents():
+    hdrs = [FakeHeader(0), FakeHeader(1, dark=True)]
+    docs = []
+    for nd in prefetch_documents(hdrs, depth=3):
+        time.sleep(.01)
+        docs.append(nd)
+    # the darks are not filled
+    assert {fill for _, fill, _ in hdrs[0].read} == {True}
+    assert {fill for _, fill, _ in hdrs[1].read} == {False}
+    assert threading.current_thread() not in {t for _, _, t in
+                                              hdrs[0].read}
+    expected = [nd for hdr in hdrs for nd in hdr.documents()]
+    assert [nd[0] for nd in docs] == [nd[0] for nd in expected]
+
+    # the bytes read ahead are bounded
+    hdr = FakeHeader(0)
+    it = prefetch_documents([hdr], depth=10, max_bytes=80)
+    next(it)
+    time.sleep(.05)
+    # one event is queued, the next one waits for room
+    assert len(hdr.read) == 2
+    it.close()
+
+    with pytest.raises(IOError):
+        list(prefetch_documents([FakeHeader(0, fail=True)]))
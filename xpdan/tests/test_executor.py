@@ -0,0 +1,85 @@
+import gc
+import threading
+import time
+
+import pytest
+from streamz import Stream
+
+from xpdan.pipelines.executor import (ExecutorStage, flush_stages,
+                                      close_stages, WriterPool)
+
+
+def test_executor_stage_order():
+    source = Stream()
+    stage = ExecutorStage(source, max_in_flight=2)
+    threads = set()
+    L = []
+
+    def slow_append(x):
+        time.sleep(.01)
+        threads.add(threading.current_thread())
+        L.append(x)
+
+    stage.sink(slow_append)
+    for i in range(10):
+        source.emit(i)
+    flush_stages()
+    assert L == list(range(10))
+    assert threading.current_thread() not in threads
+    stage.close()
+
+
+def test_executor_stage_errors():
+    source = Stream()
+    stage = ExecutorStage(source)
+
+    def fail(x):
+        if x == 2:
+            raise ValueError()
+
+    stage.sink(fail)
+    for i in range(5):
+        source.emit(i)
+    with pytest.raises(RuntimeError):
+        stage.flush()
+    # the errors are only reported once
+    stage.flush()
+    stage.close()
+
+
+def test_executor_stage_threads_stop():
+    source = Stream()
+    source.executor_stage = ExecutorStage(source)
+    thread = source.executor_stage._thread
+    close_stages(source)
+    thread.join(1)
+    assert not thread.is_alive()
+
+    # a dropped pipeline does not keep its thread (and graph) alive
+    source = Stream()
+    stage = ExecutorStage(source)
+    thread = stage._thread
+    del source, stage
+    gc.collect()
+    thread.join(1)
+    assert not thread.is_alive()
+
+
+def test_writer_pool():
+    pool = WriterPool(max_queued=2)
+    L = []
+
+    def slow_write(x):
+        time.sleep(.01)
+        if x == 3:
+            raise IOError()
+        L.append(x)
+
+    write = pool.writer(slow_write)
+    for i in range(5):
+        assert write(i) is None
+    assert len(pool.flush()) == 1
+    assert sorted(L) == [0, 1, 2, 4]
+    with pytest.raises(RuntimeError):
+        pool.wait()
+    pool.wait()
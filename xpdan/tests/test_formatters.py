@@ -0,0 +1,52 @@
+import pytest
+
+from xpdan.formatters import (CompiledTemplate, _render_and_clean,
+                              render_and_clean)
+
+template = ('{raw_start[sample_name]}/'
+            '{analyzed_start[analysis_stage]}/'
+            '{raw_start[sample_name]}_'
+            '{human_timestamp}_'
+            '[temp={raw_event[data][temperature]:1.2f}'
+            '{raw_descriptor[data_keys][temperature][units]}]_'
+            '{raw_start[uid]:.6}_'
+            '{raw_event[seq_num]:03d}{ext}')
+
+start = {'sample_name': 'Ni', 'uid': 'abcdef123'}
+event = {'data': {'temperature': 300.}, 'seq_num': 3}
+descriptor = {'data_keys': {'temperature': {'units': 'K'}}}
+
+
+@pytest.mark.parametrize('kwargs', [
+    dict(raw_start=start, raw_event=event, raw_descriptor=descriptor,
+         analyzed_start={'analysis_stage': 'pdf'}, ext='.gr',
+         human_timestamp='20170101-101010'),
+    # missing values are cleaned out
+    dict(raw_start=start, raw_event={'data': {}}, ext='.tiff'),
+    dict(raw_start={'sample_name': None, 'uid': 'abcdef123'}, ext='.yml'),
+    # values which are parsed again by the cleaning
+    dict(raw_start={'sample_name': 'a{b}c__d', 'uid': '{x}'},
+         raw_event=event, ext='.chi'),
+])
+def test_compiled_template(kwargs):
+    render = CompiledTemplate(template)
+    assert render.fields is not None
+    expected = _render_and_clean(template, **kwargs)
+    for i in range(2):
+        assert render(**kwargs) == expected
+    assert render_and_clean(template, **kwargs) == expected
+
+
+def test_compiled_template_reuses_event():
+    render = CompiledTemplate(template)
+    names = [render(raw_start=start, raw_event=event,
+                    raw_descriptor=descriptor, human_timestamp='t',
+                    analyzed_start={'analysis_stage': stage}, ext=ext)
+             for stage, ext in [('iq_q', '_Q.chi'), ('pdf', '.gr')]]
+    assert names == ['Ni/iq_q/Ni_t_temp=300.00K_abcdef_003_Q.chi',
+                     'Ni/pdf/Ni_t_temp=300.00K_abcdef_003.gr']
+    # a new event is rendered again
+    assert render(raw_start=start, raw_event=dict(event, seq_num=4),
+                  raw_descriptor=descriptor, human_timestamp='t',
+                  analyzed_start={'analysis_stage': 'pdf'},
+                  ext='.gr') == 'Ni/pdf/Ni_t_temp=300.00K_abcdef_004.gr'
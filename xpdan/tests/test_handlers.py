@@ -0,0 +1,44 @@
+import os
+
+import numpy as np
+import tifffile
+from numpy.testing import assert_array_equal
+
+from xpdan.cache import LRUCache
+from xpdan.handlers import MemmapTiffHandler
+
+
+def test_memmap_tiff_handler(tmpdir):
+    tmpdir = str(tmpdir)
+    imgs = [np.random.random((8, 6)).astype(np.float32) for _ in range(3)]
+    for i, img in enumerate(imgs):
+        tifffile.imsave(os.path.join(tmpdir, 'a_{}.tiff'.format(i)), img)
+    maps = LRUCache(2)
+    handler = MemmapTiffHandler(tmpdir, '%s%s_%d.tiff', 'a', maps=maps)
+    for i, img in enumerate(imgs):
+        frame = handler(i)
+        assert_array_equal(frame, img)
+        assert not frame.flags.writeable
+        assert not frame.flags.owndata
+    # the maps are reused, up to the size of the cache
+    hits = maps.hits
+    assert np.shares_memory(handler(2), handler(2))
+    assert maps.hits == hits + 2
+    assert len(maps) == 2
+    assert handler.get_file_list([{'point_number': 1}]) == [
+        os.path.join(tmpdir, 'a_1.tiff')]
+
+    handler = MemmapTiffHandler(tmpdir, '%s%s_%d.tiff', 'a',
+                                frame_per_point=3, maps=maps)
+    assert_array_equal(handler(0), np.array(imgs))
+
+
+def test_memmap_tiff_handler_compressed(tmpdir):
+    tmpdir = str(tmpdir)
+    img = np.random.random((8, 6)).astype(np.float32)
+    tifffile.imsave(os.path.join(tmpdir, 'a_0.tiff'), img, compress=6)
+    handler = MemmapTiffHandler(tmpdir, '%s%s_%d.tiff', 'a',
+                                maps=LRUCache(2))
+    frame = handler(0)
+    assert_array_equal(frame, img)
+    assert not frame.flags.writeable
@@ -0,0 +1,42 @@
+import subprocess
+import sys
+
+import pytest
+
+GUI_MODULES = ['pyFAI', 'matplotlib', 'bluesky', 'xpdview']
+WRITER_MODULES = ['skbeam', 'tifffile']
+
+IMPORT_CODE = '''
+import sys
+import time
+t0 = time.time()
+import {}
+print(time.time() - t0)
+print(' '.join(sys.modules))
+'''
+
+
+@pytest.mark.parametrize(('module', 'lazy', 'max_time'), [
+    ('xpdan.data_reduction',
+     GUI_MODULES + WRITER_MODULES + ['databroker', 'shed', 'xpdan.glbl',
+                                     'xpdan.pipelines.main'],
+     2.),
+    ('xpdan.pipelines.main', GUI_MODULES + WRITER_MODULES, 10.),
+])
+def test_import_is_lazy(module, lazy, max_time):
+    out = subprocess.check_output(
+        [sys.executable, '-c', IMPORT_CODE.format(module)]).decode()
+    dt, modules = out.splitlines()[-2:]
+    loaded = {m for m in modules.split() if
+              any(m == p or m.startswith(p + '.') for p in lazy)}
+    assert not loaded
+    assert float(dt) < max_time
+
+
+def test_lazy_attributes():
+    import xpdan.tools
+    from scipy.sparse import csr_matrix
+    assert 'csr_matrix' in dir(xpdan.tools)
+    assert xpdan.tools.csr_matrix is csr_matrix
+    with pytest.raises(AttributeError):
+        xpdan.tools.not_an_attribute
@@ -0,0 +1,91 @@
+import time
+
+import numpy as np
+import pytest
+from streamz import Stream
+
+from xpdan.pipelines.instrumentation import (PipelineProfiler,
+                                             MemoryProfiler, ReadOnlyArrays,
+                                             walk_graph)
+
+
+def slow_double(x):
+    time.sleep(.01)
+    return x * 2
+
+
+def test_profiler():
+    source = Stream()
+    doubled = source.map(slow_double)
+    doubled.sink(lambda x: time.sleep(.02))
+    assert len(walk_graph(source)) == 3
+    profiler = PipelineProfiler(source, report=False)
+    for i in range(3):
+        source.emit(np.ones(10))
+    stats = profiler.stats()
+    assert len(stats) == 3
+    map_stats = [v for k, v in stats.items() if k.startswith('map')][0]
+    assert map_stats['calls'] == 3
+    # the sink's time is not attributed to the map
+    assert .01 <= map_stats['mean'] < .02
+    assert stats[profiler.labels[0]]['out_bytes'] == 3 * 80
+    assert 'calls' in profiler.summary()
+
+
+def test_memory_profiler():
+    source = Stream()
+    # the zip holds on to the frames of the first input until the second
+    # input arrives
+    z = source.zip(source.filter(lambda x: False))
+    z.sink(print)
+    profiler = MemoryProfiler(source, budget=3 * 80 - 1,
+                              trace_allocations=True, report=False)
+    img = np.ones(10)
+    source.emit(img)
+    source.emit(img[:5])
+    assert sum(profiler.measure().values()) == 80
+    with pytest.warns(ResourceWarning):
+        for i in range(2):
+            source.emit(np.ones(10))
+    assert profiler.peak_retained == 3 * 80
+    assert profiler.peak_rss > 0
+    zip_stats = [v for k, v in profiler.stats().items()
+                 if k.startswith('zip')][0]
+    assert zip_stats['calls'] == 4
+
+
+def event_map(func):
+    def f(nd):
+        name, doc = nd
+        if name != 'event':
+            return nd
+        return name, dict(doc, data={'img': func(doc['data']['img'])})
+    return f
+
+
+def test_readonly_arrays():
+    source = Stream()
+    copied = source.map(event_map(np.copy), stream_name='copy')
+    viewed = source.map(event_map(lambda x: x[::2]), stream_name='view')
+    L = []
+    for s in [copied, viewed, source.map(event_map(lambda x: x + 1))]:
+        s.sink(L.append)
+
+    def increment(nd):
+        if nd[0] == 'event':
+            nd[1]['data']['img'] += 1
+
+    ro = ReadOnlyArrays(source, audit=True)
+    source.emit(('start', {}))
+    img = np.ones((4, 4))
+    source.emit(('event', {'data': {'img': img}}))
+    source.emit(('stop', {}))
+    assert not img.flags.writeable
+    assert all(not nd[1]['data']['img'].flags.writeable for nd in L
+               if nd[0] == 'event')
+    assert ro.copies == {'copy': 1}
+
+    # a stage writing into its input fails
+    viewed.sink(increment)
+    with pytest.raises(ValueError):
+        source.emit(('event', {'data': {'img': np.ones((4, 4))}}))
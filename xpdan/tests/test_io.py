@@ -0,0 +1,104 @@
+import os
+
+import numpy as np
+import pytest
+from numpy.testing import assert_array_equal
+
+from xpdan.io import (RunHDF5Writer, chi_saver, pdf_saver, made_dirs,
+                      makedirs_for, retry_missing_dir)
+
+
+class Config(object):
+    wavelength = .1843
+    composition = 'Ni'
+    qmax = 22
+    rstep = .01
+
+
+def read(fn):
+    with open(fn, 'rb') as f:
+        return f.read()
+
+
+def test_run_hdf5_writer(tmpdir):
+    h5py = pytest.importorskip('h5py')
+    template = os.path.join(str(tmpdir), '{raw_start[sample_name]}_'
+                                         '{raw_start[uid]:.6}{ext}')
+    writer = RunHDF5Writer(template)
+    iq = writer.sink('iq_q')
+    start = {'uid': 'abcdef123', 'sample_name': 'Ni', 'bt_piLast': 'Doe',
+             'sc_dk_field_uid': None, 'wavelength': .1843,
+             'calibration_md': {'poni1': .1}}
+    writer.observe(('start', start))
+    qs = np.linspace(0, 10, 20)
+    iqs = [np.random.random(20) for _ in range(3)]
+    for i, y in enumerate(iqs):
+        iq(('event', {'seq_num': i + 1, 'time': float(i),
+                      'data': {'q': qs, 'iq': y}}))
+    writer.observe(('stop', {'run_start': 'abcdef123'}))
+    # data arriving after the stop is not written
+    iq(('event', {'seq_num': 4, 'time': 4., 'data': {'q': qs, 'iq': qs}}))
+
+    fn = os.path.join(str(tmpdir), 'Ni_abcdef.h5')
+    assert writer.filename == fn
+    with h5py.File(fn, 'r') as f:
+        assert_array_equal(f['iq_q/iq'][:], np.array(iqs))
+        assert_array_equal(f['iq_q/q'][1], qs)
+        assert_array_equal(f['iq_q/seq_num'][:], [1, 2, 3])
+        assert f['iq_q/iq'].chunks == (1, 20)
+        assert f['iq_q/iq'].maxshape == (None, 20)
+        assert f.attrs['sample_name'] == 'Ni'
+        assert f.attrs['wavelength'] == .1843
+        assert 'poni1' in f.attrs['calibration_md']
+
+
+def test_chi_saver(tmpdir):
+    spo = pytest.importorskip('skbeam.io.save_powder_output')
+    q = np.linspace(0, 10, 100).astype(np.float32)
+    iq = np.random.random(100)
+    fn = os.path.join(str(tmpdir), 'a_Q.chi')
+    spo.save_output(q, iq, fn, 'Q', ext='')
+    expected = read(fn)
+    chi_saver(q, iq, fn, 'Q', ext='')
+    assert read(fn) == expected
+
+    chi_saver(q, iq, fn, '2theta', ext='', binary=True)
+    d = np.load(fn)
+    assert_array_equal(d['tth'], q)
+    assert_array_equal(d['iq'], iq)
+    assert 'two theta' in str(d['header'])
+
+
+def test_pdf_saver(tmpdir):
+    r = np.linspace(0, 30, 100)
+    pdf = np.random.random(100)
+    fn = os.path.join(str(tmpdir), 'a.gr')
+    pdf_saver(r, pdf, fn, Config)
+    text = read(fn).decode('utf-8')
+    assert '# qmax = 22\n' in text
+    # the rows np.savetxt writes
+    assert text.endswith(''.join('{:.18e} {:.18e}\n'.format(*row)
+                                 for row in zip(r, pdf)))
+    assert_array_equal(np.loadtxt(fn), np.c_[r, pdf])
+
+    pdf_saver(r, pdf, fn, Config, binary=True)
+    d = np.load(fn)
+    assert_array_equal(d['pdf'], pdf)
+    assert 'qmax = 22\n' in str(d['header'])
+
+
+def test_retry_missing_dir(tmpdir):
+    import shutil
+    folder = os.path.join(str(tmpdir), 'a', 'b')
+    fn = os.path.join(folder, 'c.npy')
+    makedirs_for(fn)
+    assert folder in made_dirs
+    # cached, the folder is not created again
+    shutil.rmtree(os.path.join(str(tmpdir), 'a'))
+    makedirs_for(fn)
+    assert not os.path.exists(folder)
+
+    save = retry_missing_dir(np.save, 'file')
+    save(file=fn, arr=np.arange(3))
+    assert_array_equal(np.load(fn), np.arange(3))
+    assert folder in made_dirs
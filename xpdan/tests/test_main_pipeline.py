@@ -1,6 +1,8 @@
 import os
 import time
 
+from xpdan.manifest import OutputManifest
+from xpdan.pipelines.executor import flush_stages, wait_for_writes
 from xpdan.pipelines.main import conf_main_pipeline
 
 
@@ -31,3 +33,39 @@ def test_master_pipeline(exp_db, fast_tmp_dir, start_uid3):
     for f in ['dark_sub', 'mask', 'iq_q', 'iq_tth', 'pdf']:
         assert f in os.listdir(
             os.path.join(fast_tmp_dir, 'Au'))
+
+
+def test_master_pipeline_executor_stages(exp_db, fast_tmp_dir, start_uid3):
+    source = conf_main_pipeline(exp_db, fast_tmp_dir,
+                                vis=False,
+                                write_to_disk=True,
+                                mask_setting=None,
+                                executor_stages=True)
+    for nd in exp_db[-1].documents():
+        source.emit(nd)
+    flush_stages()
+    for f in ['dark_sub', 'mask', 'iq_q', 'iq_tth', 'pdf']:
+        assert f in os.listdir(
+            os.path.join(fast_tmp_dir, 'Au'))
+
+
+def test_master_pipeline_resume(exp_db, fast_tmp_dir, start_uid3):
+    kwargs = dict(vis=False, write_to_disk=True, mask_setting=None)
+    source = conf_main_pipeline(exp_db, fast_tmp_dir, **kwargs)
+    for nd in exp_db[-1].documents(fill=True):
+        source.emit(nd)
+    wait_for_writes()
+    manifest = OutputManifest(os.path.join(fast_tmp_dir, 'manifest'))
+    entries = manifest.entries(exp_db[-1].start['uid'])
+    assert entries
+    times = {p: os.path.getmtime(p) for p in entries}
+
+    source = conf_main_pipeline(exp_db, fast_tmp_dir, resume=True, **kwargs)
+    for nd in exp_db[-1].documents():
+        source.emit(nd)
+    wait_for_writes()
+    # only the first event is reduced again
+    for path, entry in entries.items():
+        if not path.endswith(('_001.tiff', '_001_Q.chi', '_001_tth.chi',
+                              '_001.gr')):
+            assert os.path.getmtime(path) == times[path]
@@ -0,0 +1,77 @@
+import os
+import time
+
+from xpdan.manifest import OutputManifest, ResumeFilter
+
+
+def test_output_manifest(tmpdir):
+    tmpdir = str(tmpdir)
+    manifest = OutputManifest(os.path.join(tmpdir, 'manifest'),
+                              checksums=True)
+    path = os.path.join(tmpdir, 'a.chi')
+
+    def write(output_name, data):
+        with open(output_name, 'w') as f:
+            f.write(data)
+
+    recording_write = manifest.recording(write, 'output_name')
+    # outputs which are not expected are not recorded
+    recording_write(output_name=path, data='1 2 3')
+    assert not manifest.is_current('run', path)
+
+    manifest.expect('run', 'event', 'iq_q', path)
+    recording_write(output_name=path, data='1 2 3')
+    assert manifest.is_current('run', path)
+    assert manifest.entries('run')[path]['event_uid'] == 'event'
+
+    # the entries are read back from disk
+    manifest.close()
+    assert not manifest._runs
+    manifest = OutputManifest(os.path.join(tmpdir, 'manifest'))
+    assert manifest.is_current('run', path)
+    # touching the file does not change it
+    t = time.time() + 10
+    os.utime(path, (t, t))
+    assert manifest.is_current('run', path)
+    write(path, '1 2 4')
+    assert not manifest.is_current('run', path)
+    os.remove(path)
+    assert not manifest.is_current('run', path)
+
+
+def test_output_manifest_without_checksums(tmpdir):
+    tmpdir = str(tmpdir)
+    manifest = OutputManifest(os.path.join(tmpdir, 'manifest'))
+    path = os.path.join(tmpdir, 'a.chi')
+    with open(path, 'w') as f:
+        f.write('1 2 3')
+    manifest.expect('run', 'event', 'iq_q', path)
+    manifest.record(path)
+    assert manifest.entries('run')[path]['checksum'] is None
+    assert manifest.is_current('run', path)
+    # without a checksum a touched file is reduced again
+    t = time.time() + 10
+    os.utime(path, (t, t))
+    assert not manifest.is_current('run', path)
+
+
+def test_resume_filter(tmpdir):
+    tmpdir = str(tmpdir)
+    manifest = OutputManifest(os.path.join(tmpdir, 'manifest'))
+    template = os.path.join(tmpdir, '{raw_start[uid]:.6}_'
+                                    '{raw_event[seq_num]:03d}_'
+                                    '{analyzed_start[analysis_stage]}{ext}')
+    start = {'uid': 'abcdefgh', 'time': 0.}
+    descriptor = {'uid': 'desc', 'name': 'primary'}
+    events = [{'uid': str(i), 'seq_num': i, 'time': 0., 'data': {},
+               'descriptor': 'desc'} for i in range(1, 4)]
+    resume_filter = ResumeFilter(manifest, template, resume=True)
+    resume_filter.observe(('start', start))
+    resume_filter.observe(('descriptor', descriptor))
+    assert all(resume_filter((e,)) for e in events)
+    for path in resume_filter.outputs(events[1]).values():
+        with open(path, 'w') as f:
+            f.write(path)
+        manifest.record(path)
+    # the first event is always kept, for the mask
+    assert [resume_filter((e,)) for e in events] == [True, False, True]
@@ -0,0 +1,42 @@
+import time
+
+from xpdan.pipelines.pipeline_utils import LatestOnly
+
+
+def test_latest_only():
+    L = []
+    sink = LatestOnly(L.append, max_rate=1e-3)
+    docs = ([('start', {}), ('descriptor', {})] +
+            [('event', {'seq_num': i}) for i in range(1, 6)] +
+            [('stop', {})])
+    for nd in docs:
+        sink(nd)
+    # the first and last events are shown, the ones in between skipped
+    assert [n for n, d in L] == ['start', 'descriptor', 'event', 'event',
+                                 'stop']
+    assert [d['seq_num'] for n, d in L if n == 'event'] == [1, 5]
+    assert sink.dropped == 3
+
+
+def test_latest_only_unlimited():
+    L = []
+    sink = LatestOnly(L.append, max_rate=None)
+    for i in range(5):
+        sink(('event', {'seq_num': i}))
+    assert len(L) == 5
+
+
+def test_latest_only_slow_callback():
+    L = []
+
+    def draw(nd):
+        time.sleep(.2)
+        L.append(nd)
+
+    sink = LatestOnly(draw, max_rate=10)
+    for i in range(15):
+        sink(('event', {'seq_num': i}))
+        time.sleep(.02)
+    # the interval starts once the slow draw is done, so frames are dropped
+    assert len(L) < 8
+    assert sink.dropped == 15 - len(L) - (sink._pending is not None)
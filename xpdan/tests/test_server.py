@@ -0,0 +1,68 @@
+import threading
+import time
+
+import pytest
+from streamz import Stream
+
+from xpdan.server import ReductionServer, serve
+
+
+def run_documents(uid, n_events):
+    yield 'start', {'uid': uid}
+    yield 'descriptor', {'uid': uid + 'd', 'run_start': uid}
+    for i in range(n_events):
+        yield 'event', {'uid': '{}{}'.format(uid, i), 'seq_num': i + 1,
+                        'descriptor': uid + 'd'}
+    yield 'stop', {'uid': uid + 's', 'run_start': uid}
+
+
+def test_reduction_server():
+    received = []
+    threads = {}
+
+    def make_pipeline():
+        source = Stream()
+
+        def reduce(nd):
+            name, doc = nd
+            time.sleep(.001)
+            if doc.get('seq_num') == 2 and doc['uid'].startswith('bad'):
+                raise ValueError()
+            threads.setdefault(threading.current_thread(), []).append(nd)
+            received.append(nd)
+
+        source.sink(reduce)
+        return source
+
+    server = ReductionServer(make_pipeline, n_workers=2, max_queued=4)
+    runs = [run_documents(uid, 5) for uid in ['a', 'bad', 'c']]
+    # interleave the runs
+    for nds in zip(*runs):
+        for nd in nds:
+            server(*nd)
+    # documents of a run which started before the server
+    server('event', {'uid': 'x', 'descriptor': 'unknown'})
+    server.join()
+    m = server.metrics()
+    server.stop()
+
+    assert m['received'] == 3 * 8 + 1
+    assert m['orphaned'] == 1
+    assert m['errors'] == 1
+    assert m['active_runs'] == 0
+    assert m['queue_depths'] == [0, 0]
+    # the rest of the failed run is left out
+    assert m['events'] == 5 + 1 + 5
+    assert threading.current_thread() not in threads
+    # each run is reduced in order, by one worker
+    for uid in ['a', 'c']:
+        docs = [nd for nd in received if nd[1].get('uid', '')[0] == uid]
+        assert [nd[0] for nd in docs] == (['start', 'descriptor'] +
+                                          ['event'] * 5 + ['stop'])
+        assert sum(any(nd in v for nd in docs)
+                   for v in threads.values()) == 1
+
+
+def test_serve_does_not_visualize():
+    with pytest.raises(ValueError):
+        serve(None, 'save_dir', vis=True)
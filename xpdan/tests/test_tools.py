@@ -13,9 +13,13 @@
 #
 ##############################################################################
 import numpy as np
-from numpy.testing import assert_array_equal
+import pytest
+from numpy.testing import assert_array_equal, assert_allclose
 
-from xpdan.tools import margin, binned_outlier, compress_mask, decompress_mask
+from skbeam.core.accumulators.binned_statistic import BinnedStatistic1D
+from xpdan.tools import (margin, binned_outlier, compress_mask,
+                         decompress_mask, ImageStack, StackIntegrator,
+                         integrate)
 
 
 def test_margin():
@@ -76,3 +80,49 @@ def test_compression_decompression():
     a, b, c = compress_mask(mask)
     mask2 = decompress_mask(a, b, c, mask.shape)
     assert_array_equal(mask, mask2)
+
+
+@pytest.mark.parametrize('method', ['mean', 'sigma_clip', 'median'])
+def test_image_stack(method):
+    np.random.seed(10)
+    imgs = [np.random.normal(100, 1, (50, 40)) for _ in range(7)]
+    dark = np.ones((50, 40)) * 5
+    # a cosmic ray in one frame
+    imgs[3][10, 10] = 1e6
+    # small chunks to exercise the chunking
+    stack = ImageStack(method, chunk_bytes=7 * 8 * 40 * 3)
+    for img in imgs:
+        stack.add(img, offset=dark)
+    res = stack.result()
+    expected = np.stack(imgs) - dark
+    if method == 'mean':
+        assert_allclose(res, expected.mean(axis=0))
+    else:
+        assert abs(res[10, 10] - 95) < 5
+    if method == 'median':
+        assert_allclose(res, np.median(expected, axis=0))
+
+
+def test_image_stack_sigma():
+    with pytest.raises(ValueError):
+        ImageStack('sigma_clip', sigma=.5)
+    with pytest.raises(ValueError):
+        ImageStack('sigma_clip', sigma=float('nan'))
+    # the smallest threshold still keeps a pixel's frames
+    stack = ImageStack('sigma_clip', sigma=1)
+    for value in [1., 2., 4., 8.]:
+        stack.add(np.full((2, 2), value))
+    assert np.all(np.isfinite(stack.result()))
+
+
+def test_stack_integrator():
+    rs = np.random.RandomState(0)
+    q = rs.random_sample((50, 40)) * 10
+    mask = rs.random_sample((50, 40)) > .2
+    binner = BinnedStatistic1D(q.ravel(), bins=np.linspace(0, 10, 30),
+                               mask=mask.ravel())
+    integrator = StackIntegrator(binner, mask)
+    assert integrator.matrix is not None
+    stack = rs.random_sample((4, 50, 40))
+    assert_allclose(integrator(stack),
+                    [integrate(img, binner)[1] for img in stack])
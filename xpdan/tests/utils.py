@@ -12,11 +12,14 @@
 # See LICENSE.txt for license information.
 #
 ##############################################################################
+import os
 import tempfile
 from itertools import product
 from uuid import uuid4
 
 import numpy as np
+import tifffile
+from numpy.testing import assert_array_equal
 
 from bluesky.examples import ReaderWithRegistry
 from bluesky.plans import count
@@ -165,3 +168,27 @@ save_tiff_kwargs = []
 for d in [save_tiff_kwargs, integrate_kwargs]:
     for d2 in d:
         d2[0]['image_data_key'] = 'pe1_image'
+
+
+def assert_same_outputs(dirs):
+    """Check that two save folders hold the same files, with the same data
+
+    The manifests are only compared by name, they hold modification times
+    """
+    files = [set(os.path.relpath(os.path.join(root, f), d)
+                 for root, _, fs in os.walk(d) for f in fs) for d in dirs]
+    assert files[0]
+    assert files[0] == files[1]
+    for fn in files[0]:
+        if fn.startswith('manifest'):
+            continue
+        paths = [os.path.join(d, fn) for d in dirs]
+        if fn.endswith('.tiff'):
+            assert_array_equal(*[tifffile.imread(p) for p in paths])
+            continue
+        contents = []
+        for d, p in zip(dirs, paths):
+            with open(p, 'rb') as f:
+                # the .chi headers hold the full file name
+                contents.append(f.read().replace(d.encode(), b''))
+        assert contents[0] == contents[1], fn
@@ -12,18 +12,37 @@
 # See LICENSE.txt for license information.
 #
 ##############################################################################
+from functools import partial
+
 import numpy as np
 
-try:
-    from diffpy.pdfgetx import PDFGetter
-except ImportError:
-    from xpdan.tests.utils import PDFGetterShim as PDFGetter
-from matplotlib.path import Path
-from scipy.sparse import csr_matrix
 from multiprocessing import Pool, cpu_count
 
-from skbeam.core.accumulators.binned_statistic import BinnedStatistic1D
-from skbeam.core.mask import margin, binned_outlier
+from xpdan.dev_utils import import_attribute, lazy_attributes
+
+# The heavier dependencies (matplotlib, scipy, scikit-beam, diffpy) are
+# imported where they are used, so importing xpdan stays fast
+
+
+def _pdf_getter_class():
+    try:
+        from diffpy.pdfgetx import PDFGetter
+    except ImportError:
+        from xpdan.tests.utils import PDFGetterShim as PDFGetter
+    return PDFGetter
+
+
+# still available from this module, imported on first use
+lazy_attributes(__name__, {
+    'PDFGetter': _pdf_getter_class,
+    'Path': partial(import_attribute, 'matplotlib.path', 'Path'),
+    'csr_matrix': partial(import_attribute, 'scipy.sparse', 'csr_matrix'),
+    'BinnedStatistic1D': partial(
+        import_attribute, 'skbeam.core.accumulators.binned_statistic',
+        'BinnedStatistic1D'),
+    'margin': partial(import_attribute, 'skbeam.core.mask', 'margin'),
+    'binned_outlier': partial(import_attribute, 'skbeam.core.mask',
+                              'binned_outlier')})
 
 
 # TODO: speed this up
@@ -81,6 +100,7 @@ def new_masking_method(img, geo, alpha=3, tmsk=None):
     np.ndarray:
         The mask
     """
+    from skbeam.core.accumulators.binned_statistic import BinnedStatistic1D
     r = geo.rArray(img.shape)
     q = geo.qArray(img.shape) / 10  # type: np.ndarray
     delta_q = geo.deltaQ(img.shape) / 10  # type: np.ndarray
@@ -171,6 +191,7 @@ def old_mask_img(img, geo,
         are masked out.
 
     """
+    from skbeam.core.mask import margin, binned_outlier
 
     r = geo.rArray(img.shape)
     pixel_size = [getattr(geo, a) for a in ['pixel1', 'pixel2']]
@@ -201,6 +222,7 @@ def old_mask_img(img, geo,
 
         points = np.vstack((x, y)).T
 
+        from matplotlib.path import Path
         path = Path(mask_verts)
         grid = path.contains_points(points)
         # Plug msk_grid into into next (edge-mask) step in automask
@@ -263,6 +285,7 @@ def mask_img(img, geo,
         are masked out.
 
     """
+    from skbeam.core.mask import margin
 
     if tmsk is None:
         working_mask = np.ones(img.shape).astype(bool)
@@ -289,6 +312,7 @@ def mask_img(img, geo,
 
         points = np.vstack((x, y)).T
 
+        from matplotlib.path import Path
         path = Path(mask_verts)
         grid = path.contains_points(points)
         # Plug msk_grid into into next (edge-mask) step in automask
@@ -322,6 +346,7 @@ def compress_mask(mask):
     ---------
     scipy.sparse.csr_matrix
     """
+    from scipy.sparse import csr_matrix
     cmask = csr_matrix(~mask)
     # FIXME: we may need to also return the mask shape
     return cmask.data.tolist(), cmask.indices.tolist(), cmask.indptr.tolist()
@@ -350,6 +375,7 @@ def decompress_mask(data, indices, indptr, shape):
     ---------
     scipy.sparse.csr_matrix
     """
+    from scipy.sparse import csr_matrix
     cmask = csr_matrix(
         tuple([np.asarray(a) for a in [data, indices, indptr]]), shape=shape)
     return ~cmask.toarray().astype(bool)
@@ -360,6 +386,7 @@ def pull_array(img2):
 
 
 def generate_binner(geo, img_shape, mask=None):
+    from skbeam.core.accumulators.binned_statistic import BinnedStatistic1D
     r = geo.rArray(img_shape)
     q = geo.qArray(img_shape) / 10  # type: np.ndarray
     q_dq = geo.deltaQ(img_shape) / 10  # type: np.ndarray
@@ -381,6 +408,7 @@ def generate_binner(geo, img_shape, mask=None):
 
 def z_score_image(img, binner):
     img_shape = img.shape
+    # copy, the frame is normalized in place
     img = img.flatten()
     xy = binner.xy
     binner.statistic = 'mean'
@@ -396,7 +424,70 @@ def z_score_image(img, binner):
 
 
 def integrate(img, binner):
-    return binner.bin_centers, np.nan_to_num(binner(img.flatten()))
+    # ravel does not copy the (read-only) frame
+    return binner.bin_centers, np.nan_to_num(binner(img.ravel()))
+
+
+class StackIntegrator(object):
+    """Integrate a stack of images at once
+
+    The binner's mean is written as a sparse matrix, so a stack of frames
+    is integrated with a single sparse matrix product instead of one
+    binner call per frame. The matrix is checked against the binner on a
+    random frame and the binner is used if they do not agree.
+
+    Parameters
+    ----------
+    binner: BinnedStatistic1D
+        The binner, as made by ``generate_binner``
+    mask: np.ndarray, optional
+        The mask the binner was made with, True are good pixels
+
+    Examples
+    --------
+    >>> integrator = StackIntegrator(binner)
+    >>> iqs = integrator(stack)  # iqs[i] == integrate(stack[i], binner)[1]
+    """
+
+    def __init__(self, binner, mask=None):
+        from scipy.sparse import csr_matrix, diags
+        self.bin_centers = binner.bin_centers
+        nbins = len(self.bin_centers)
+        # the binner numbers the bins from 1, 0 and nbins + 1 are outliers
+        xy = np.asarray(binner.xy).ravel() - 1
+        good = (xy >= 0) & (xy < nbins)
+        if mask is not None:
+            good &= np.asarray(mask, dtype=bool).ravel()
+        pixels = np.nonzero(good)[0]
+        m = csr_matrix((np.ones(len(pixels)), (xy[pixels], pixels)),
+                       shape=(nbins, len(xy)))
+        counts = np.asarray(m.sum(axis=1)).ravel()
+        counts[counts == 0] = np.inf
+        self.matrix = diags(1. / counts).dot(m).tocsr()
+        self.binner = None
+        probe = np.random.RandomState(42).random_sample(len(xy))
+        if not np.allclose(self(probe[np.newaxis])[0],
+                           np.nan_to_num(binner(probe))):
+            self.matrix = None
+            self.binner = binner
+
+    def __call__(self, stack):
+        """The integrated intensities of a stack of images
+
+        Parameters
+        ----------
+        stack: np.ndarray
+            The images, stacked on the first axis
+
+        Returns
+        -------
+        np.ndarray:
+            The intensities, one row per image
+        """
+        flat = np.asarray(stack).reshape(len(stack), -1)
+        if self.matrix is None:
+            return np.array([np.nan_to_num(self.binner(f)) for f in flat])
+        return self.matrix.dot(flat.T).T
 
 
 def polarization_correction(img, geo, polarization_factor=.99):
@@ -419,14 +510,112 @@ def add_img(img1, img2):
     return img1 + img2
 
 
+class ImageStack(object):
+    """Stack images into a single image, one frame at a time
+
+    The mean is accumulated in place in a single float64 buffer. The robust
+    methods keep references to the frames and combine them in row chunks
+    so only ``chunk_bytes`` of temporary memory is used.
+
+    Parameters
+    ----------
+    method: {'mean', 'sigma_clip', 'median'}, optional
+        How to combine the frames. 'sigma_clip' is the mean of the pixels
+        which are within ``sigma`` robust standard deviations (scaled median
+        absolute deviation) of the median, 'median' is the per pixel median.
+        Defaults to 'mean'
+    sigma: float, optional
+        The clipping threshold for 'sigma_clip', at least 1 so at least half
+        of the frames are kept for every pixel. Defaults to 3
+    chunk_bytes: int, optional
+        The size of the temporary arrays used for the robust methods,
+        defaults to 64 MiB
+
+    Examples
+    --------
+    >>> stack = ImageStack('sigma_clip')
+    >>> for img in imgs:
+    ...     stack.add(img, offset=dark)
+    >>> bg = stack.result()
+    """
+
+    def __init__(self, method='mean', sigma=3., chunk_bytes=2 ** 26):
+        if method not in ('mean', 'sigma_clip', 'median'):
+            raise ValueError('method must be one of mean, sigma_clip or '
+                             'median, not {}'.format(method))
+        if not sigma >= 1:
+            # a smaller threshold can clip every frame of a pixel
+            raise ValueError('sigma must be at least 1, not {}'.format(sigma))
+        self.method = method
+        self.sigma = sigma
+        self.chunk_bytes = chunk_bytes
+        self.count = 0
+        self._sum = None
+        self._frames = []
+
+    def add(self, img, offset=None):
+        """Add a frame to the stack
+
+        Parameters
+        ----------
+        img: np.ndarray
+            The frame
+        offset: np.ndarray, optional
+            Subtracted from the frame before stacking, eg. the dark
+        """
+        self.count += 1
+        if self.method != 'mean':
+            self._frames.append((img, offset))
+            return
+        if self._sum is None:
+            self._sum = np.zeros(img.shape, dtype=np.float64)
+        np.add(self._sum, img, out=self._sum)
+        if offset is not None:
+            np.subtract(self._sum, offset, out=self._sum)
+
+    def result(self):
+        """Combine the frames
+
+        Returns
+        -------
+        np.ndarray:
+            The stacked image
+        """
+        if self.count == 0:
+            raise ValueError('No frames have been added to the stack')
+        if self.method == 'mean':
+            return self._sum / self.count
+        shape = self._frames[0][0].shape
+        out = np.empty(shape, dtype=np.float64)
+        row_bytes = self.count * 8 * int(np.prod(shape[1:]))
+        step = max(1, self.chunk_bytes // max(row_bytes, 1))
+        for i in range(0, shape[0], step):
+            chunk = np.empty((self.count, min(step, shape[0] - i)) +
+                             shape[1:])
+            for j, (img, offset) in enumerate(self._frames):
+                chunk[j] = img[i:i + step]
+                if offset is not None:
+                    chunk[j] -= offset[i:i + step]
+            med = np.median(chunk, axis=0)
+            if self.method == 'median':
+                out[i:i + step] = med
+                continue
+            mad = 1.4826 * np.median(np.abs(chunk - med), axis=0)
+            good = np.abs(chunk - med) <= self.sigma * mad
+            # for sigma >= 1 at least half of the frames are kept
+            out[i:i + step] = (np.sum(chunk * good, axis=0) /
+                               np.sum(good, axis=0))
+        return out
+
+
 def pdf_getter(*args, **kwargs):
-    pg = PDFGetter()
+    pg = _pdf_getter_class()()
     res = pg(*args, **kwargs)
     return res[0], res[1], pg.config
 
 
 def fq_getter(*args, **kwargs):
-    pg = PDFGetter()
+    pg = _pdf_getter_class()()
     pg(*args, **kwargs)
     res = pg.fq
     return res[0], res[1], pg.config